@@ -6,6 +6,7 @@ from aiohttp import web
 from config import (
     QUEST_CONFIG_2, PROJ_ROOT, CSP_HEADER, BOT_TOKEN
 )
+from utils.fastjson import json_response, read_json, loads as json_loads
 
 # Проверка подписи WebApp
 try:
@@ -36,7 +37,7 @@ async def check_subscription_status(telegram_id: int, channel_username: str, ses
         async with session.get(url, params=params, timeout=5) as resp:
             if resp.status != 200:
                 return False
-            result = await resp.json()
+            result = await resp.json(loads=json_loads)
             status = result.get('result', {}).get('status')
             # 'left' или 'kicked' означают отсутствие подписки
             return status in ['member', 'creator', 'administrator']
@@ -63,46 +64,44 @@ async def get_quests_statuses(request: web.Request):
     """GET /api/quest/statuses?telegram_id=..."""
     telegram_id = request.query.get("telegram_id")
     if not telegram_id:
-        return web.json_response({"error": "Missing telegram_id"}, status=400)
+        return json_response({"error": "Missing telegram_id"}, status=400)
     
     db_manager = request.app['db_manager']
     t_id = int(telegram_id)
     
-    quests_statuses = await db_manager.quests_db.get_user_quest_statuses(t_id)
-    user = await db_manager.users_db.get_user_by_telegram_id(t_id)
+    # Баланс, квесты и счетчики одним запросом (или из короткого кеша)
+    snapshot = await db_manager.users_db.get_snapshot(t_id)
     
-    if not user:
-        return web.json_response({"error": "User not found"}, status=404)
-        
-    videos_watched_count = await db_manager.counters_db.get_counter(t_id, 'videos_watched')
+    if not snapshot:
+        return json_response({"error": "User not found"}, status=404)
     
-    return web.json_response({
+    return json_response({
         "status": "ok",
-        "balance": float(user['balance']),
-        "quests": quests_statuses,
-        "counters": {"videos_watched": videos_watched_count}
+        "balance": snapshot["balance"],
+        "quests": snapshot["quests"],
+        "counters": {"videos_watched": snapshot["counters"].get("videos_watched", 0)}
     })
 
 async def get_quest_config_list(request: web.Request):
     """GET /api/quest/get_list"""
     # Теперь отдаем список из единого конфига QUEST_CONFIG_2
     quest_list = [{"id": k, **v} for k, v in QUEST_CONFIG_2.items()]
-    return web.json_response(quest_list)
+    return json_response(quest_list)
 
 async def mark_quest_visited(request: web.Request):
     """POST /api/quest/visited"""
-    data = await request.json()
+    data = await read_json(request)
     t_id = int(data.get('telegram_id'))
     q_id = data.get('quest_id')
     
     await request.app['db_manager'].quests_db.set_quest_status(t_id, q_id, 'visited')
-    return web.json_response({'status': 'ok'})
+    return json_response({'status': 'ok'})
 
 async def verify_quest_handler(request: web.Request):
     """
     УНИВЕРСАЛЬНЫЙ хендлер проверки (заменяет complete_quest_handler и check_follow_quest_status_handler)
     """
-    data = await request.json()
+    data = await read_json(request)
     quest_id = data.get("quest_id")
     telegram_id = int(data.get("telegram_id"))
     
@@ -110,13 +109,13 @@ async def verify_quest_handler(request: web.Request):
     config = QUEST_CONFIG_2.get(quest_id)
     
     if not config:
-        return web.json_response({"error": "Unknown quest"}, status=400)
+        return json_response({"error": "Unknown quest"}, status=400)
 
     user_statuses = await db_manager.quests_db.get_user_quest_statuses(telegram_id)
     current_status = next((s['status'] for s in user_statuses if s['quest_id'] == quest_id), None)
 
     if current_status == 'completed':
-        return web.json_response({"isCompleted": True, "reward": 0, "message": "Already rewarded"})
+        return json_response({"isCompleted": True, "reward": 0, "message": "Already rewarded"})
 
     is_valid = False
     
@@ -126,7 +125,7 @@ async def verify_quest_handler(request: web.Request):
         if not is_valid:
             # СБРОС СТАТУСА: если не подписан, ставим статус обратно в None или начальный
             await db_manager.quests_db.set_quest_status(telegram_id, quest_id, 'started') # или None
-            return web.json_response({"isCompleted": False, "resetStatus": True})
+            return json_response({"isCompleted": False, "resetStatus": True})
     
     elif config['type'] == 'milestone':
         if current_status == 'ready_to_claim':
@@ -136,7 +135,7 @@ async def verify_quest_handler(request: web.Request):
             is_valid = current_count >= config.get('goal', 999)
     
     elif config['type'] == 'cpa':
-        return web.json_response({
+        return json_response({
             "isCompleted": False, 
             "message": "CPA quests are verified automatically via postback"
         })
@@ -146,14 +145,14 @@ async def verify_quest_handler(request: web.Request):
         # Атомарно прибавляем баланс
         await db_manager.users_db.update_balance(telegram_id, reward)
         await db_manager.quests_db.set_quest_status(telegram_id, quest_id, 'completed')
-        return web.json_response({"isCompleted": True, "reward": reward})
+        return json_response({"isCompleted": True, "reward": reward})
     
-    return web.json_response({"isCompleted": False})
+    return json_response({"isCompleted": False})
 
 async def video_watched_handler(request: web.Request):
     """POST /api/video/watched"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         t_id = int(data.get("telegram_id"))
         v_id = data.get("video_id")
         
@@ -171,10 +170,10 @@ async def video_watched_handler(request: web.Request):
                     await db_manager.quests_db.set_quest_status(t_id, q_id, 'ready_to_claim')
                     newly_ready.append(q_id)
 
-        return web.json_response({"status": "ok", "videos_watched_count": new_count, "newly_ready": newly_ready})
+        return json_response({"status": "ok", "videos_watched_count": new_count, "newly_ready": newly_ready})
     except Exception as e:
         logger.error(f"Error: {e}")
-        return web.json_response({"error": "Internal error"}, status=500)
+        return json_response({"error": "Internal error"}, status=500)
 
 async def get_random_video(request: web.Request):
     """GET /api/video/random"""
@@ -182,29 +181,29 @@ async def get_random_video(request: web.Request):
     bot = request.app['bot']
     
     if check_webapp_signature and not check_webapp_signature(bot.token, init_data):
-        return web.json_response({"error": "Invalid auth"}, status=403)
+        return json_response({"error": "Invalid auth"}, status=403)
 
     video = await request.app['db_manager'].videos_db.get_random_video()
     if not video:
-        return web.json_response({"error": "No videos"}, status=404)
+        return json_response({"error": "No videos"}, status=404)
 
     vurl = video["video_url"]
     if not vurl.startswith("http"):
         host = request.headers.get("Host")
         vurl = f"https://{host}/{vurl.lstrip('/')}"
 
-    return web.json_response({"id": video["id"], "title": video["title"], "video_url": vurl})
+    return json_response({"id": video["id"], "title": video["title"], "video_url": vurl})
 
 async def generate_cpa_link_handler(request: web.Request):
     """POST /api/quest/generate_cpa_link"""
     try:
-        data = await request.json()
+        data = await read_json(request)
         t_id = int(data.get('telegram_id'))
         q_id = data.get('quest_id')
         
         config = QUEST_CONFIG_2.get(q_id)
         if not config or config.get('type') != 'cpa':
-            return web.json_response({"error": "Invalid CPA quest"}, status=400)
+            return json_response({"error": "Invalid CPA quest"}, status=400)
 
         # Генерация click_id: c_юзер_рандом
         unique_id = uuid.uuid4().hex[:8]
@@ -220,10 +219,10 @@ async def generate_cpa_link_handler(request: web.Request):
         # Формируем ссылку. {subid1} — макрос для 1win/Jetton
         final_link = f"{config['link']}?subid1={click_id}"
         
-        return web.json_response({'status': 'ok', 'link': final_link})
+        return json_response({'status': 'ok', 'link': final_link})
     except Exception as e:
         logger.error(f"CPA Link Gen Error: {e}")
-        return web.json_response({"error": "Internal error"}, status=500)
+        return json_response({"error": "Internal error"}, status=500)
 
 async def cpa_postback_handler(request: web.Request):
     """GET /api/cpa/postback (Входящий от партнерки)"""
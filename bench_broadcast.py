@@ -0,0 +1,221 @@
+"""
+Бенчмарк рассылки против локальной заглушки Bot API (fake_bot_api.py):
+
+    python fake_bot_api.py --p403 0.05 --p429 0.001 &
+    python bench_broadcast.py --users 20000 --rate 200 --concurrency 50
+
+Создает синтетических пользователей (timezone='bench', ID из отдельного диапазона),
+запускает прогон через run_broadcast только по ним и печатает сообщений/с,
+p50/p99 задержки запросов к API и нагрузку на БД. Запускать на dev-базе:
+прогон пишет статистику и помечает «заблокировавших» как is_alive = FALSE.
+
+Режим вебхука — синтетические апдейты в handle_webhook запущенного приложения:
+
+    python bench_broadcast.py --webhook http://127.0.0.1:8080 --updates 20000 --concurrency 100
+
+Печатает подтверждений/с, p50/p99 времени ответа вебхука и из GET {WEBHOOK_PATH}/stats
+глубину очереди и p50/p99 ожидания и обработки апдейта. Под serve.py /stats отвечает
+один из процессов — его цифры, а не сумма. Апдейты — текст от пользователей из
+диапазона BENCH_ID_BASE; ответы бота лучше направить в fake_bot_api.py.
+"""
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import statistics
+
+import aiohttp
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from config import WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN
+from db import db_manager, MigrationRunner
+from utils.helpers import run_broadcast
+
+BENCH_TIMEZONE = "bench"
+BENCH_ID_BASE = 9_000_000_000_000
+
+
+async def db_counters(pool) -> dict:
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT xact_commit, tup_inserted, tup_updated, tup_deleted "
+            "FROM pg_stat_database WHERE datname = current_database();"
+        )
+    return dict(row)
+
+
+async def create_audience(pool, users: int):
+    records = [(BENCH_ID_BASE + i, BENCH_TIMEZONE, True) for i in range(users)]
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM tg_users WHERE timezone = $1 AND telegram_id >= $2;",
+                           BENCH_TIMEZONE, BENCH_ID_BASE)
+        await conn.copy_records_to_table("tg_users", records=records,
+                                         columns=["telegram_id", "timezone", "is_alive"])
+
+
+async def cleanup(pool, mailing_id: int):
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM mailings WHERE id = $1;", mailing_id)
+        await conn.execute("DELETE FROM tg_users WHERE timezone = $1 AND telegram_id >= $2;",
+                           BENCH_TIMEZONE, BENCH_ID_BASE)
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def synthetic_update(update_id: int, user_id: int, text: str) -> bytes:
+    """Текстовое сообщение в личке, как его присылает Telegram"""
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "from": user, "chat": {"id": user_id, "type": "private", "first_name": "Bench"},
+        },
+    }).encode()
+
+
+async def webhook_stats(session: aiohttp.ClientSession, url: str) -> dict:
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def bench_webhook(args):
+    base = args.webhook.rstrip("/")
+    secret = args.secret or WEBHOOK_SECRET_TOKEN
+    hook_url = f"{base}{WEBHOOK_PATH}/telegram/{secret}"
+    stats_url = f"{base}{WEBHOOK_PATH}/stats/{secret}"
+    # update_id растут от текущего времени, чтобы повторный запуск не упирался в дедупликацию
+    update_ids = itertools.count(int(time.time() * 1000))
+    remaining = itertools.count()
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+
+    async with aiohttp.ClientSession() as session:
+        before = await webhook_stats(session, stats_url)
+
+        async def sender():
+            while next(remaining) < args.updates:
+                update_id = next(update_ids)
+                body = synthetic_update(update_id, BENCH_ID_BASE + update_id % args.users, args.text)
+                started = time.perf_counter()
+                async with session.post(hook_url, data=body,
+                                        headers={"Content-Type": "application/json"}) as response:
+                    await response.read()
+                latencies.append((time.perf_counter() - started) * 1000)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+        # Подтверждение — еще не обработка: ждем, пока очередь опустеет
+        deadline = time.monotonic() + 60
+        after = await webhook_stats(session, stats_url)
+        while (after["depth"] or after["in_flight"]) and time.monotonic() < deadline:
+            await asyncio.sleep(0.5)
+            after = await webhook_stats(session, stats_url)
+        drained = time.perf_counter() - started
+
+    acked = statuses.get(200, 0)
+    print("—" * 40)
+    print(f"Апдейтов:         {len(latencies)}, ответы {dict(sorted(statuses.items()))}")
+    print(f"Подтверждений/с:  {acked / elapsed:.1f}")
+    print(f"Ответ p50/p99:    {percentile(latencies, 0.50):.1f} / {percentile(latencies, 0.99):.1f} мс")
+    print(f"Очередь пуста за: {drained:.1f} с (отправка {elapsed:.1f} с)")
+    print(f"Ожидание p50/p99: {after['wait_ms_p50']} / {after['wait_ms_p99']} мс")
+    print(f"Обработка p50/p99: {after['handle_ms_p50']} / {after['handle_ms_p99']} мс")
+    print(f"Макс. глубина:    {after['max_depth']} из {after['maxsize']}")
+    for counter in ("processed", "failed", "dropped", "duplicates"):
+        print(f"{counter + ':':<18}{after[counter] - before[counter]}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылки против fake_bot_api.py и вебхука")
+    parser.add_argument("--api", default="http://127.0.0.1:8081", help="адрес заглушки Bot API")
+    parser.add_argument("--token", default="123456:bench-token")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--rate", type=float, default=100.0, help="лимит рассылки, сообщений/с")
+    parser.add_argument("--concurrency", type=int, default=20, help="отправителей рассылки или запросов к вебхуку")
+    parser.add_argument("--keep", action="store_true", help="не удалять синтетических пользователей и прогон")
+    parser.add_argument("--webhook", help="адрес запущенного приложения: бенчмарк вебхука вместо рассылки")
+    parser.add_argument("--secret", help="секрет вебхука (по умолчанию WEBHOOK_SECRET_TOKEN_NEW)")
+    parser.add_argument("--updates", type=int, default=10000, help="апдейтов в режиме --webhook")
+    parser.add_argument("--text", default="bench", help="текст синтетических сообщений")
+    args = parser.parse_args()
+
+    if args.webhook:
+        await bench_webhook(args)
+        return
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(args.api))
+    bot = Bot(token=args.token, session=session)
+
+    latencies: list[float] = []
+
+    async def timing_middleware(make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    bot.session.middleware(timing_middleware)
+
+    await db_manager.connect()
+    await MigrationRunner(db_manager.pool).run()
+
+    mailing_id = await db_manager.mailing_db.add_broadcast(
+        name="bench", title="Bench", text="Нагрузочный тест рассылки"
+    )
+    try:
+        print(f"Создаем {args.users} синтетических пользователей...")
+        await create_audience(db_manager.pool, args.users)
+
+        run_id = await db_manager.mailing_db.start_new_run(mailing_id, timezones=[BENCH_TIMEZONE], rate=args.rate)
+        calls_before = sum(q["calls"] for q in db_manager.queries.get_stats().values())
+        db_before = await db_counters(db_manager.pool)
+
+        started = time.perf_counter()
+        result = await run_broadcast(run_id, bot, db_manager, concurrency=args.concurrency)
+        elapsed = time.perf_counter() - started
+
+        # pg_stat_database обновляется с задержкой до секунды
+        await asyncio.sleep(1.0)
+        db_after = await db_counters(db_manager.pool)
+        calls_after = sum(q["calls"] for q in db_manager.queries.get_stats().values())
+
+        print("—" * 40)
+        print(f"Прогон #{run_id}: {result.counts}")
+        print(f"Сообщений/с:      {result.total / elapsed:.1f} (лимит {args.rate})")
+        print(f"Время:            {elapsed:.1f} с")
+        print(f"Запросов к API:   {len(latencies)}")
+        print(f"Задержка p50:     {percentile(latencies, 0.50):.1f} мс")
+        print(f"Задержка p99:     {percentile(latencies, 0.99):.1f} мс")
+        if latencies:
+            print(f"Задержка средняя: {statistics.fmean(latencies):.1f} мс")
+        print(f"БД транзакций:    {db_after['xact_commit'] - db_before['xact_commit']}")
+        print(f"БД строк ins/upd: {db_after['tup_inserted'] - db_before['tup_inserted']}"
+              f"/{db_after['tup_updated'] - db_before['tup_updated']}")
+        print(f"Подготовл. вызовов: {calls_after - calls_before}")
+        if result.total:
+            print(f"Транзакций на сообщение: "
+                  f"{(db_after['xact_commit'] - db_before['xact_commit']) / result.total:.3f}")
+    finally:
+        if not args.keep:
+            await cleanup(db_manager.pool, mailing_id)
+        await db_manager.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
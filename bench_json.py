@@ -0,0 +1,109 @@
+"""
+Микробенчмарк JSON-слоя (utils/fastjson.py) на типичных телах запросов и ответов:
+
+    python bench_json.py --number 20000
+    JSON_BACKEND=msgspec python bench_json.py
+
+Для каждого эндпоинта сравнивает путь aiohttp по умолчанию (request.json() —
+декодирование в str и json.loads, web.json_response — json.dumps и encode)
+с выбранным бэкендом. Для вебхука — json.loads + Update.model_validate против
+Update.model_validate_json по сырым байтам.
+"""
+import json
+import timeit
+import argparse
+
+from utils import fastjson
+
+QUEST_LIST = [
+    {"id": f"quest_{i}", "type": "milestone", "title": f"Посмотри {i * 5} видео",
+     "reward": 0.5 + i, "goal": i * 5, "icon": "🎬", "description": "Смотри видео и получай награду"}
+    for i in range(12)
+]
+
+# (эндпоинт, тело запроса или None, тело ответа)
+ENDPOINTS = [
+    ("GET /api/quest/statuses", None, {
+        "status": "ok", "balance": 12.5,
+        # Как отдает users.snapshot (db.py): список объектов, а не словарь
+        "quests": [{"quest_id": f"quest_{i}", "status": "completed" if i % 2 else "visited"} for i in range(12)],
+        "counters": {"videos_watched": 42},
+    }),
+    ("GET /api/quest/get_list", None, QUEST_LIST),
+    ("POST /api/quest/visited", {"telegram_id": 123456789, "quest_id": "quest_3"}, {"status": "ok"}),
+    ("POST /api/quest/verify", {"telegram_id": 123456789, "quest_id": "quest_3"},
+     {"isCompleted": True, "reward": 0.5}),
+    ("POST /api/video/watched", {"telegram_id": 123456789, "video_id": 17},
+     {"status": "ok", "videos_watched_count": 43, "newly_ready": ["quest_4"]}),
+    ("GET /api/video/random", None,
+     {"id": 17, "title": "Смешное видео про котов", "video_url": "https://example.com/vids/cat_17.mp4"}),
+    ("POST /api/quest/generate_cpa_link", {"telegram_id": 123456789, "quest_id": "quest_cpa"},
+     {"status": "ok", "link": "https://partner.example.com/ref?subid1=c_123456789_deadbeef"}),
+]
+
+WEBHOOK_UPDATE = {
+    "update_id": 987654321,
+    "message": {
+        "message_id": 4242, "date": 1760000000,
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "last_name": "Петров",
+                 "username": "ivan_petrov", "language_code": "ru", "is_premium": True},
+        "chat": {"id": 123456789, "type": "private", "first_name": "Иван", "last_name": "Петров",
+                 "username": "ivan_petrov"},
+        "text": "/start ref_555",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
+def stdlib_request(raw: bytes):
+    return json.loads(raw.decode("utf-8"))
+
+
+def stdlib_response(data) -> bytes:
+    return json.dumps(data).encode("utf-8")
+
+
+def fast_response(data) -> bytes:
+    return fastjson.dumps_bytes(data)
+
+
+def per_call_us(func, arg, number: int) -> float:
+    return timeit.timeit(lambda: func(arg), number=number) / number * 1e6
+
+
+def report(name: str, before: float, after: float):
+    print(f"{name:<36} {before:>9.2f} {after:>9.2f} {before / after if after else 0:>7.2f}x")
+
+
+def bench_webhook(number: int):
+    try:
+        from aiogram.types import Update
+    except ImportError:
+        print("aiogram не установлен — вебхук пропущен")
+        return
+    raw = json.dumps(WEBHOOK_UPDATE).encode()
+    before = per_call_us(lambda r: Update.model_validate(json.loads(r)), raw, number)
+    after = per_call_us(Update.model_validate_json, raw, number)
+    report("POST webhook (Update)", before, after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк JSON-слоя API")
+    parser.add_argument("--number", type=int, default=20000, help="повторов на замер")
+    args = parser.parse_args()
+
+    print(f"Бэкенд: {fastjson.BACKEND}, мкс на вызов (запрос + ответ)")
+    print(f"{'эндпоинт':<36} {'stdlib':>9} {fastjson.BACKEND:>9} {'выигрыш':>8}")
+    for name, request_body, response_body in ENDPOINTS:
+        before = per_call_us(stdlib_response, response_body, args.number)
+        after = per_call_us(fast_response, response_body, args.number)
+        if request_body is not None:
+            raw = json.dumps(request_body).encode()
+            before += per_call_us(stdlib_request, raw, args.number)
+            after += per_call_us(fastjson.loads, raw, args.number)
+        report(name, before, after)
+    bench_webhook(args.number)
+
+
+if __name__ == "__main__":
+    main()
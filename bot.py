@@ -553,11 +553,8 @@ async def fetch_bot_stats() -> str:
         # 1. СТАТИСТИКА ПОЛЬЗОВАТЕЛЕЙ
         users = await conn.fetchval("SELECT count(*) FROM tg_users") or 0
         today_users = await conn.fetchval("SELECT count(*) FROM tg_users WHERE created_at::date = current_date") or 0
-        refs = await conn.fetchval("""
-            SELECT count(*) 
-            FROM (SELECT unnest(referrals) FROM tg_users) s(id) 
-            WHERE id IS NOT NULL
-        """) or 0
+        # Колонку tg_users.referrals заменила таблица user_referrals (миграция 4)
+        refs = await conn.fetchval("SELECT count(*) FROM user_referrals") or 0
         
         # 2. СТАТИСТИКА ВИДЕО (ПРОСМОТРЫ)
         # Total watched (берется из таблицы videos, столбец watched)
@@ -0,0 +1,150 @@
+"""
+Воркер рассылок: забирает задания из broadcast_jobs и отправляет их.
+Запускается отдельно от веб-приложения, можно держать несколько процессов
+на одной или разных машинах (нужен BROADCAST_MODE=queue в боте):
+
+    python broadcast_worker.py --rate 10 --concurrency 5
+"""
+import os
+import socket
+import signal
+import asyncio
+import argparse
+import logging
+
+from init_bot import bot
+from db import db_manager
+from config import BROADCAST_WORKER_RATE, BROADCAST_CONCURRENCY
+from utils.broadcast import BroadcastEngine
+from utils.helpers import build_broadcast_sender, build_broadcast_report
+
+logger = logging.getLogger("broadcast_worker")
+
+
+class BroadcastWorker:
+    """
+    Цикл: взять задание (FOR UPDATE SKIP LOCKED) → отправить через BroadcastEngine
+    с чекпоинтами в курсор задания → отметить выполненным. Пауза прогона
+    возвращает задание в очередь с курсором, пропавшие воркеры — по stale_after.
+    """
+    def __init__(self, bot, db_manager, worker_id: str, rate: float, concurrency: int,
+                 poll_interval: float = 2.0, stale_after: float = 300.0):
+        self.bot = bot
+        self.db = db_manager
+        self.worker_id = worker_id
+        self.rate = rate
+        self.engine = BroadcastEngine(bot, db_manager, rate=rate, concurrency=concurrency)
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        # run_id -> (send, скорость прогона или None)
+        self._runs: dict[int, tuple] = {}
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    async def run_forever(self):
+        logger.info(f"Воркер {self.worker_id} запущен")
+        while not self._stopping.is_set():
+            try:
+                job = await self.db.jobs_db.claim(self.worker_id)
+                if job:
+                    await self._process(job)
+                    continue
+                reclaimed = await self.db.jobs_db.reclaim_stale(self.stale_after)
+                if reclaimed:
+                    logger.warning(f"Возвращено в очередь зависших заданий: {reclaimed}")
+                    continue
+            except Exception:
+                logger.exception("Ошибка цикла воркера")
+            # Очередь пуста — ждем следующего опроса или сигнала остановки
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+        logger.info(f"Воркер {self.worker_id} остановлен")
+
+    async def _run_context(self, run_id: int):
+        context = self._runs.get(run_id)
+        if context is None:
+            run = await self.db.mailing_db.get_run(run_id)
+            mailing_data = await self.db.mailing_db.get_mailing_by_run_id(run_id)
+            # Исходное сообщение рендерит бот при раскладке; без него шлем напрямую
+            send = build_broadcast_sender(
+                mailing_data, self.bot, run['source_chat_id'], run['source_message_id']
+            )
+            context = self._runs[run_id] = (send, run['rate'])
+        return context
+
+    async def _job_rate(self, run_id: int, run_rate: float | None) -> float:
+        """
+        Скорость на задание: у отложенного прогона своя (растянута на окно отправки),
+        она делится между воркерами, которые сейчас шлют этот прогон; не выше --rate.
+        """
+        if not run_rate:
+            return self.rate
+        workers = await self.db.jobs_db.count_run_workers(run_id)
+        return min(self.rate, run_rate / max(workers, 1))
+
+    async def _process(self, job: dict):
+        job_id, run_id, cursor = job['id'], job['run_id'], job['cursor']
+        recipients = [uid for uid in job['recipient_ids'] if cursor is None or uid > cursor]
+
+        async def chunks():
+            yield recipients
+
+        async def checkpoint(last_id: int) -> bool:
+            # Остановка воркера тоже выходит через чекпоинт: задание вернется в очередь
+            state = await self.db.jobs_db.checkpoint(job_id, last_id)
+            return state == 'running' and not self._stopping.is_set()
+
+        try:
+            send, run_rate = await self._run_context(run_id)
+            self.engine.bucket.set_base_rate(await self._job_rate(run_id, run_rate))
+            result = await self.engine.run(run_id, chunks(), send, checkpoint=checkpoint)
+        except Exception:
+            logger.exception(f"Задание #{job_id} рассылки #{run_id} прервано")
+            await self.db.jobs_db.release(job_id)
+            return
+
+        if result.stopped:
+            await self.db.jobs_db.yield_job(job_id)
+            return
+
+        await self.db.jobs_db.complete(job_id)
+        closed, admin_id = await self.db.jobs_db.finish_run(run_id)
+        if closed:
+            self._runs.pop(run_id, None)
+            logger.info(f"Рассылка #{run_id} завершена воркером {self.worker_id}")
+            if admin_id:
+                report = await build_broadcast_report(run_id, self.db)
+                await self.bot.send_message(admin_id, report, parse_mode="HTML")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Воркер очереди рассылок")
+    parser.add_argument("--rate", type=float, default=BROADCAST_WORKER_RATE, help="сообщений в секунду на воркер")
+    parser.add_argument("--concurrency", type=int, default=BROADCAST_CONCURRENCY)
+    parser.add_argument("--id", default=f"{socket.gethostname()}:{os.getpid()}")
+    args = parser.parse_args()
+
+    # Схему накатывает основное приложение, воркеру нужен только пул и буферы
+    await db_manager.connect()
+    worker = BroadcastWorker(bot, db_manager, args.id, rate=args.rate, concurrency=args.concurrency)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            pass
+
+    try:
+        await worker.run_forever()
+    finally:
+        await db_manager.close()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -18,6 +18,39 @@ WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN_NEW")
 
 WEBHOOK_URL_FINAL = os.getenv("WEBHOOK_URL_NEW_FINAL")
 
+# Размер чанка при потоковой выборке аудитории рассылки
+AUDIENCE_CHUNK_SIZE = int(os.getenv("AUDIENCE_CHUNK_SIZE", "1000"))
+
+# Общий лимит рассылки (сообщений в секунду, у Telegram ~30) и число параллельных отправителей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Как часто (в получателях) сохранять курсор рассылки для возобновления после рестарта
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "200"))
+# Рендерить рассылку один раз в чат-источник и рассылать copy_message (медиа не теряется на ретраях)
+BROADCAST_COPY_MODE = os.getenv("BROADCAST_COPY_MODE", "1") == "1"
+# Чат-источник для copy_message (служебный канал/чат); по умолчанию — чат запустившего админа
+BROADCAST_SOURCE_CHAT_ID = int(os.getenv("BROADCAST_SOURCE_CHAT_ID", "0")) or None
+# Попыток доставки одному получателю (сетевые ошибки, 5xx, flood limit) с экспоненциальной паузой
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+# Не чаще раза в столько секунд обновлять сообщение с прогрессом рассылки
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+# Пояс для отложенных рассылок по абсолютному времени и для пользователей без tg_users.timezone
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Moscow")
+# Как часто планировщик проверяет наступившие отложенные рассылки, секунд
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "30"))
+# inline — рассылает процесс бота, queue — задания в Postgres для процессов broadcast_worker.py
+BROADCAST_MODE = os.getenv("BROADCAST_MODE", "inline")
+# Лимит одного воркера; при нескольких воркерах суммарная скорость — сумма их лимитов
+BROADCAST_WORKER_RATE = float(os.getenv("BROADCAST_WORKER_RATE", str(BROADCAST_RATE)))
+# Вебхук отвечает сразу, апдейты обрабатывают столько задач из очереди такого размера
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Сколько последних update_id помнить, чтобы отбрасывать повторные доставки
+WEBHOOK_DEDUP_WINDOW = int(os.getenv("WEBHOOK_DEDUP_WINDOW", "10000"))
+# serve.py: число процессов веб-приложения и общий лимит соединений с БД на все их пулы
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+DB_POOL_BUDGET = int(os.getenv("DB_POOL_BUDGET", "20"))
+
 admin_ids_raw = os.getenv("ADMIN_IDS", "")
 
 try:
@@ -1,56 +1,761 @@
 import os
+import json
+import time
 import asyncio
 import asyncpg
 import random
+import hashlib
+import bisect
+import inspect
 import logging
+import contextlib
+from array import array
+from collections import OrderedDict
 from dotenv import load_dotenv
-from datetime import datetime, date
+from datetime import datetime, date, timezone
+
+from utils.fsm_schema import FSM_STATES_DDL
+from utils.write_behind import WriteBehindBuffer
 
 load_dotenv()
 DB_URL = os.getenv("DATABASE_DSN")
 if not DB_URL:
     raise ValueError("Ссылка на базу данных (PG_LINK) не указана в .env")
 
+# Сколько месяцев храним партиции mailing_stats
+MAILING_STATS_RETENTION_MONTHS = int(os.getenv("MAILING_STATS_RETENTION_MONTHS", "6"))
+# Сегменты: как часто догружать новых пользователей и как часто пересобирать целиком, секунд
+SEGMENTS_REFRESH_INTERVAL = float(os.getenv("SEGMENTS_REFRESH_INTERVAL", "60"))
+SEGMENTS_REBUILD_INTERVAL = float(os.getenv("SEGMENTS_REBUILD_INTERVAL", "1800"))
+# Версии примененных миграций, чье изменение подтверждено вручную ("3,11"): новая
+# контрольная сумма записывается один раз, без этого измененная миграция роняет старт
+MIGRATIONS_ACCEPT_CHANGED = {int(v) for v in os.getenv("MIGRATIONS_ACCEPT_CHANGED", "").replace(",", " ").split()}
+
 logger = logging.getLogger(__name__)
 
-# ------------------ USERS ------------------
-class UsersDBManager:
-    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None):
-        self.db_url = db_url
+# ------------------ PREPARED STATEMENTS ------------------
+class RegistryConnection(asyncpg.Connection):
+    """
+    Соединение пула DatabaseManager (connection_class в create_pool): подготовленные
+    запросы реестра живут на самом соединении и умирают вместе с ним.
+    PoolConnectionProxy отдает атрибут через свой __getattr__, поэтому к нему
+    доступ одинаковый и у прокси из пула, и у «сырого» соединения в хуке init.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.registry_statements: dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+
+class QueryRegistry:
+    """
+    Центральный реестр запросов. Каждый менеджер объявляет свои запросы в QUERIES,
+    реестр готовит их один раз на каждое соединение пула (хук init) и дальше
+    вызывает по имени, без повторного разбора и планирования SQL на сервере.
+    """
+    def __init__(self):
+        self._queries: dict[str, str] = {}
+        self.stats: dict[str, dict] = {}
+
+    def register(self, queries: dict[str, str]):
+        for name, sql in queries.items():
+            if name in self._queries and self._queries[name] != sql:
+                raise ValueError(f"Запрос {name} уже зарегистрирован с другим SQL")
+            self._queries[name] = sql
+            self.stats.setdefault(name, {"calls": 0, "prepares": 0, "prepare_ms": 0.0})
+
+    async def init_connection(self, conn: asyncpg.Connection):
+        """Хук init для asyncpg.create_pool(connection_class=RegistryConnection): готовит все запросы"""
+        for name in self._queries:
+            try:
+                await self._prepare(conn, name)
+            except asyncpg.PostgresError as e:
+                # На холодной БД таблиц еще нет — такой запрос подготовим при первом вызове
+                logger.debug(f"Отложенная подготовка {name}: {e}")
+
+    @staticmethod
+    def _statements(conn) -> dict:
+        # Соединение не из пула DatabaseManager — готовим без кеша (остается кеш самого asyncpg)
+        statements = getattr(conn, "registry_statements", None)
+        return statements if statements is not None else {}
+
+    async def _prepare(self, conn, name: str):
+        started = time.perf_counter()
+        stmt = await conn.prepare(self._queries[name])
+        stat = self.stats[name]
+        stat["prepares"] += 1
+        stat["prepare_ms"] += (time.perf_counter() - started) * 1000
+        self._statements(conn)[name] = stmt
+        return stmt
+
+    async def _call(self, conn, name: str, method: str, args):
+        stmt = self._statements(conn).get(name)
+        if stmt is None:
+            stmt = await self._prepare(conn, name)
+        self.stats[name]["calls"] += 1
+        try:
+            return await getattr(stmt, method)(*args)
+        except (asyncpg.exceptions.InvalidCachedStatementError, asyncpg.exceptions.OutdatedSchemaCacheError):
+            # Схема поменялась (например, ALTER TABLE) — готовим заново один раз
+            stmt = await self._prepare(conn, name)
+            return await getattr(stmt, method)(*args)
+
+    async def execute(self, conn, name: str, *args):
+        # У PreparedStatement нет execute, для DML без RETURNING fetch вернет пустой список
+        await self._call(conn, name, "fetch", args)
+
+    async def fetch(self, conn, name: str, *args):
+        return await self._call(conn, name, "fetch", args)
+
+    async def fetchrow(self, conn, name: str, *args):
+        return await self._call(conn, name, "fetchrow", args)
+
+    async def fetchval(self, conn, name: str, *args):
+        return await self._call(conn, name, "fetchval", args)
+
+    def get_stats(self) -> dict[str, dict]:
+        """Число вызовов, подготовок и оценка сэкономленного времени разбора по каждому запросу"""
+        report = {}
+        for name, stat in self.stats.items():
+            avg_prepare_ms = stat["prepare_ms"] / stat["prepares"] if stat["prepares"] else 0.0
+            report[name] = {
+                "calls": stat["calls"],
+                "prepares": stat["prepares"],
+                "avg_prepare_ms": round(avg_prepare_ms, 3),
+                "saved_ms": round(max(stat["calls"] - stat["prepares"], 0) * avg_prepare_ms, 3),
+            }
+        return report
+
+queries = QueryRegistry()
+
+# ------------------ SNAPSHOT CACHE ------------------
+class SnapshotCache:
+    """
+    Короткоживущий кеш снимков пользователя (баланс, квесты, счетчики).
+    Записи живут ttl секунд; пути записи вызывают invalidate(telegram_id).
+    """
+    def __init__(self, ttl: float = 10.0, max_size: int = 20000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+
+    def get(self, telegram_id: int) -> dict | None:
+        item = self._items.get(telegram_id)
+        if not item:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._items[telegram_id]
+            return None
+        return value
+
+    def set(self, telegram_id: int, value: dict):
+        self._items[telegram_id] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(telegram_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def invalidate(self, telegram_id: int):
+        self._items.pop(telegram_id, None)
+
+# ------------------ PARTITIONS ------------------
+def _month_start(day: date, shift: int = 0) -> datetime:
+    """Начало месяца (UTC), сдвинутого на shift месяцев от day"""
+    month_index = day.year * 12 + day.month - 1 + shift
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+async def _list_partitions(conn, table: str) -> list[str]:
+    rows = await conn.fetch(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = $1::text::regclass;", table
+    )
+    return [row['relname'] for row in rows]
+
+async def ensure_monthly_partitions(conn, table: str, column: str, start: date, months_ahead: int = 2):
+    """
+    Создает помесячные партиции table (RANGE по column) от месяца start
+    до months_ahead месяцев вперед. Строки, успевшие попасть в {table}_default,
+    переносятся в новую партицию перед ATTACH.
+    """
+    existing = set(await _list_partitions(conn, table))
+    month = _month_start(start)
+    last = _month_start(date.today(), months_ahead)
+    while month <= last:
+        upper = _month_start(month, 1)
+        name = f"{table}_y{month.year}m{month.month:02d}"
+        if name not in existing:
+            async with conn.transaction():
+                await conn.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS);")
+                await conn.execute(
+                    f"WITH moved AS (DELETE FROM {table}_default WHERE {column} >= $1 AND {column} < $2 RETURNING *) "
+                    f"INSERT INTO {name} SELECT * FROM moved;", month, upper
+                )
+                await conn.execute(
+                    f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{month.isoformat()}') TO ('{upper.isoformat()}');"
+                )
+            logger.info(f"Создана партиция {name}")
+        month = upper
+
+async def drop_expired_partitions(conn, table: str, keep_months: int) -> list[str]:
+    """
+    Отсоединяет и удаляет помесячные партиции старше keep_months.
+    DROP целой партиции не оставляет мертвых строк, в отличие от DELETE + VACUUM.
+    """
+    cutoff = _month_start(date.today(), -keep_months)
+    dropped = []
+    for name in await _list_partitions(conn, table):
+        suffix = name[len(table) + 1:]
+        if not (suffix.startswith("y") and "m" in suffix):
+            continue  # DEFAULT-партиция и чужие таблицы
+        year, month = suffix[1:].split("m")
+        if _month_start(date(int(year), int(month), 1), 1) <= cutoff:
+            await conn.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            await conn.execute(f"DROP TABLE {name};")
+            dropped.append(name)
+            logger.info(f"Удалена устаревшая партиция {name}")
+    return dropped
+
+# ------------------ MIGRATIONS ------------------
+# Шаг миграции — либо SQL-строка, либо async-функция(conn). Версии только растут,
+# примененные шаги не редактируем: их контрольная сумма сверяется при каждом старте.
+
+BASELINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tg_users (
+    telegram_id BIGINT PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    language_code TEXT,
+    timezone TEXT,
+    is_premium BOOLEAN DEFAULT FALSE,
+    referrer_id BIGINT,
+    is_alive BOOLEAN DEFAULT TRUE,
+    balance NUMERIC(18,2) DEFAULT 0,
+    cash_out_used BIGINT[] DEFAULT '{}',
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+-- Таблица могла быть создана ранее без referrer_id
+ALTER TABLE tg_users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;
+
+CREATE TABLE IF NOT EXISTS videos (
+    id BIGSERIAL PRIMARY KEY,
+    title TEXT,
+    video_url TEXT UNIQUE NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    watched INTEGER DEFAULT 0,
+    clicked INTEGER DEFAULT 0
+);
+CREATE OR REPLACE FUNCTION notify_videos_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('videos_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS videos_changed ON videos;
+-- watched/clicked сюда не входят: сброс счетчиков не должен перезагружать каталог
+CREATE TRIGGER videos_changed
+    AFTER INSERT OR DELETE OR UPDATE OF title, video_url, is_active ON videos
+    FOR EACH ROW EXECUTE FUNCTION notify_videos_changed();
+
+CREATE TABLE IF NOT EXISTS mailings (
+    id BIGSERIAL PRIMARY KEY,
+    name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    text TEXT NOT NULL,
+    media_url TEXT,
+    media_type TEXT,
+    button_text TEXT,
+    button_link TEXT,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS mailing_runs (
+    id BIGSERIAL PRIMARY KEY,
+    mailing_id BIGINT REFERENCES mailings(id) ON DELETE CASCADE,
+    users_count INTEGER DEFAULT 0,
+    start_time TIMESTAMPTZ DEFAULT now()
+);
+CREATE TABLE IF NOT EXISTS mailing_run_summary (
+    run_id BIGINT REFERENCES mailing_runs(id) ON DELETE CASCADE,
+    status TEXT NOT NULL,
+    cnt BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, status)
+);
+
+CREATE TABLE IF NOT EXISTS user_quest_statuses (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+    quest_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    UNIQUE (telegram_id, quest_id)
+);
+CREATE TABLE IF NOT EXISTS user_counters (
+    id BIGSERIAL PRIMARY KEY,
+    telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+    counter_key TEXT NOT NULL,
+    value INTEGER DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    UNIQUE (telegram_id, counter_key)
+);
+
+CREATE TABLE IF NOT EXISTS daily_statistics (
+    stat_date DATE PRIMARY KEY, new_users BIGINT DEFAULT 0, videos_watched BIGINT DEFAULT 0,
+    total_balance NUMERIC(18,2) DEFAULT 0, quests_done BIGINT DEFAULT 0, cash_outs BIGINT DEFAULT 0
+);
+"""
+
+async def _partition_mailing_stats(conn):
+    """mailing_stats -> помесячные партиции; старая обычная таблица переливается целиком"""
+    legacy = await conn.fetchval(
+        "SELECT to_regclass('mailing_stats') IS NOT NULL AND "
+        "(SELECT relkind FROM pg_class WHERE oid = to_regclass('mailing_stats')) = 'r';"
+    )
+    if legacy:
+        await conn.execute("ALTER TABLE mailing_stats RENAME TO mailing_stats_legacy;")
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS mailing_stats (
+        id BIGSERIAL,
+        run_id BIGINT REFERENCES mailing_runs(id) ON DELETE CASCADE,
+        telegram_id BIGINT NOT NULL,
+        status TEXT NOT NULL,
+        timestamp TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+    CREATE TABLE IF NOT EXISTS mailing_stats_default PARTITION OF mailing_stats DEFAULT;
+    """)
+    start = date.today()
+    if legacy:
+        oldest = await conn.fetchval("SELECT min(timestamp) FROM mailing_stats_legacy;")
+        start = oldest.date() if oldest else start
+    await ensure_monthly_partitions(conn, "mailing_stats", "timestamp", start)
+    if legacy:
+        await conn.execute("""
+        INSERT INTO mailing_stats (run_id, telegram_id, status, timestamp)
+        SELECT run_id, telegram_id, status, COALESCE(timestamp, now()) FROM mailing_stats_legacy;
+        INSERT INTO mailing_run_summary (run_id, status, cnt)
+        SELECT run_id, status, count(*) FROM mailing_stats_legacy WHERE run_id IS NOT NULL GROUP BY run_id, status
+        ON CONFLICT (run_id, status) DO UPDATE SET cnt = EXCLUDED.cnt;
+        DROP TABLE mailing_stats_legacy;
+        """)
+
+async def _create_user_events(conn):
+    """Журнал событий пользователей вместо растущего массива tg_users.logs"""
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_events (
+        id BIGSERIAL,
+        telegram_id BIGINT NOT NULL,
+        event JSONB NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    CREATE TABLE IF NOT EXISTS user_events_default PARTITION OF user_events DEFAULT;
+    CREATE INDEX IF NOT EXISTS user_events_user_idx ON user_events (telegram_id, id DESC);
+    """)
+    await ensure_monthly_partitions(conn, "user_events", "created_at", date.today())
+    has_logs = await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'tg_users' AND column_name = 'logs');"
+    )
+    if has_logs:
+        await conn.execute("""
+        INSERT INTO user_events (telegram_id, event)
+        SELECT u.telegram_id, e.value
+        FROM tg_users u, jsonb_array_elements(u.logs) AS e
+        WHERE jsonb_typeof(u.logs) = 'array' AND jsonb_array_length(u.logs) > 0;
+        -- Обнуляем, чтобы TOAST-данные освободились обычным autovacuum
+        UPDATE tg_users SET logs = NULL WHERE logs IS NOT NULL AND logs <> '[]'::jsonb;
+        ALTER TABLE tg_users DROP COLUMN logs;
+        """)
+
+async def _normalize_referrals_and_quests(conn):
+    """Рефералы и выполненные квесты отдельными таблицами вместо массивов в tg_users"""
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS user_referrals (
+        referrer_id BIGINT NOT NULL REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+        referral_id BIGINT NOT NULL REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (referrer_id, referral_id)
+    );
+    CREATE INDEX IF NOT EXISTS user_referrals_referral_idx ON user_referrals (referral_id);
+    CREATE TABLE IF NOT EXISTS user_quests_done (
+        telegram_id BIGINT NOT NULL REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+        quest_id TEXT NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        PRIMARY KEY (telegram_id, quest_id)
+    );
+    """)
+    columns = {r['column_name'] for r in await conn.fetch(
+        "SELECT column_name FROM information_schema.columns "
+        "WHERE table_name = 'tg_users' AND column_name IN ('referrals', 'quests_done');"
+    )}
+    # Разовый перенос из массивов; JOIN отбрасывает ссылки на несуществующих юзеров
+    if 'referrals' in columns:
+        await conn.execute("""
+        INSERT INTO user_referrals (referrer_id, referral_id)
+        SELECT u.telegram_id, r.referral_id
+        FROM tg_users u
+        CROSS JOIN LATERAL unnest(u.referrals) AS r(referral_id)
+        JOIN tg_users ref ON ref.telegram_id = r.referral_id
+        ON CONFLICT DO NOTHING;
+        ALTER TABLE tg_users DROP COLUMN referrals;
+        """)
+    if 'quests_done' in columns:
+        await conn.execute("""
+        INSERT INTO user_quests_done (telegram_id, quest_id)
+        SELECT u.telegram_id, q.quest_id::text
+        FROM tg_users u, unnest(u.quests_done) AS q(quest_id)
+        ON CONFLICT DO NOTHING;
+        ALTER TABLE tg_users DROP COLUMN quests_done;
+        """)
+
+def non_transactional(step):
+    """
+    Шаг миграции сам управляет транзакциями (пачки, CREATE INDEX CONCURRENTLY).
+    Такой шаг должен быть идемпотентным: после падения на середине он запустится заново.
+    """
+    step.transactional = False
+    return step
+
+ORD_BACKFILL_BATCH = 10000
+
+@non_transactional
+async def _backfill_user_ordinals(conn):
+    """
+    tg_users.ord по порядку регистрации пачками по ORD_BACKFILL_BATCH, каждая в своей
+    транзакции: блокируются только строки пачки. Курсор — (created_at, telegram_id),
+    так что зарегистрированные во время раздачи попадают в хвост по порядку.
+    Остаток (created_at IS NULL и самые свежие) добирается под SHARE ROW EXCLUSIVE —
+    чтения идут, записи ждут — вместе с DEFAULT из последовательности.
+    """
+    if await conn.fetchval(
+        "SELECT atthasdef FROM pg_attribute WHERE attrelid = 'tg_users'::regclass AND attname = 'ord';"
+    ):
+        # DEFAULT ставится последним в той же транзакции, что и остаток: раздача закончена
+        return
+    base = await conn.fetchval("SELECT COALESCE(max(ord), 0) FROM tg_users;")
+    cursor = None
+    while True:
+        rows = await conn.fetch(f"""
+        WITH batch AS (
+            SELECT telegram_id, created_at, row_number() OVER (ORDER BY created_at, telegram_id) AS rn
+            FROM (SELECT telegram_id, created_at FROM tg_users
+                  WHERE ord IS NULL AND created_at IS NOT NULL
+                  {"AND (created_at, telegram_id) > ($3, $4)" if cursor else ""}
+                  ORDER BY created_at, telegram_id LIMIT $2) s
+        )
+        UPDATE tg_users u SET ord = $1 + b.rn FROM batch b WHERE u.telegram_id = b.telegram_id
+        RETURNING b.rn, b.created_at, b.telegram_id;
+        """, base, ORD_BACKFILL_BATCH, *(cursor or ()))
+        if not rows:
+            break
+        last = max(rows, key=lambda r: r['rn'])
+        cursor = (last['created_at'], last['telegram_id'])
+        base += len(rows)
+    async with conn.transaction():
+        await conn.execute("LOCK TABLE tg_users IN SHARE ROW EXCLUSIVE MODE;")
+        await conn.execute("""
+        UPDATE tg_users u SET ord = $1 + s.rn
+        FROM (SELECT telegram_id, row_number() OVER (ORDER BY created_at, telegram_id) AS rn
+              FROM tg_users WHERE ord IS NULL AND (created_at IS NULL OR created_at >= $2)) s
+        WHERE u.telegram_id = s.telegram_id;
+        """, base, cursor[0] if cursor else datetime.min.replace(tzinfo=timezone.utc))
+        await conn.execute(
+            "SELECT setval('tg_users_ord_seq', COALESCE((SELECT max(ord) FROM tg_users), 0) + 1, false);"
+        )
+        await conn.execute("ALTER TABLE tg_users ALTER COLUMN ord SET DEFAULT nextval('tg_users_ord_seq');")
+
+@non_transactional
+async def _create_user_ordinals_index(conn):
+    """Уникальный индекс по ord без блокировки записей; недостроенный после падения пересоздается"""
+    invalid = await conn.fetchval(
+        "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass('tg_users_ord_idx');"
+    )
+    if invalid:
+        await conn.execute("DROP INDEX CONCURRENTLY IF EXISTS tg_users_ord_idx;")
+    await conn.execute("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS tg_users_ord_idx ON tg_users (ord);")
+
+@non_transactional
+async def _user_ordinals_not_null(conn):
+    """
+    NOT NULL без полного скана под ACCESS EXCLUSIVE: CHECK ... NOT VALID (только каталог),
+    VALIDATE под SHARE UPDATE EXCLUSIVE (записи идут), затем SET NOT NULL берет
+    доказательство из проверенного CHECK и таблицу не сканирует.
+    """
+    if await conn.fetchval(
+        "SELECT attnotnull FROM pg_attribute WHERE attrelid = 'tg_users'::regclass AND attname = 'ord';"
+    ):
+        return
+    await conn.execute("""
+    ALTER TABLE tg_users DROP CONSTRAINT IF EXISTS tg_users_ord_not_null;
+    ALTER TABLE tg_users ADD CONSTRAINT tg_users_ord_not_null CHECK (ord IS NOT NULL) NOT VALID;
+    """)
+    await conn.execute("ALTER TABLE tg_users VALIDATE CONSTRAINT tg_users_ord_not_null;")
+    async with conn.transaction():
+        await conn.execute("ALTER TABLE tg_users ALTER COLUMN ord SET NOT NULL;")
+        await conn.execute("ALTER TABLE tg_users DROP CONSTRAINT tg_users_ord_not_null;")
+
+MIGRATIONS = [
+    (1, "baseline_schema", BASELINE_SCHEMA),
+    (2, "partition_mailing_stats", _partition_mailing_stats),
+    # Шаг уже применен: текст не меняем (см. MigrationRunner). UPDATE logs = NULL
+    # переписывает строки с логами, а DROP COLUMN только прячет колонку в каталоге —
+    # данные остаются в строках, пока таблицу не перепишут (VACUUM FULL, pg_repack)
+    (3, "user_events", _create_user_events),
+    (4, "normalize_referrals_and_quests", _normalize_referrals_and_quests),
+    # Дрейф схемы: collect_and_save пишет cpa_profit, а cpa_clicks раньше не создавалась вовсе
+    (5, "cpa_clicks_and_cpa_profit", """
+    ALTER TABLE daily_statistics ADD COLUMN IF NOT EXISTS cpa_profit NUMERIC(18,2) DEFAULT 0;
+    CREATE TABLE IF NOT EXISTS cpa_clicks (
+        id BIGSERIAL PRIMARY KEY,
+        click_id TEXT UNIQUE NOT NULL,
+        telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
+        offer_name TEXT NOT NULL,
+        status TEXT DEFAULT 'click', -- click, registration, deposit
+        amount NUMERIC(18,2) DEFAULT 0,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    );
+    """),
+    (6, "hot_path_indexes", """
+    CREATE INDEX IF NOT EXISTS tg_users_created_at_idx ON tg_users (created_at);
+    CREATE INDEX IF NOT EXISTS tg_users_alive_idx ON tg_users (telegram_id) WHERE is_alive;
+    CREATE INDEX IF NOT EXISTS cpa_clicks_updated_at_idx ON cpa_clicks (updated_at);
+    CREATE INDEX IF NOT EXISTS mailing_stats_run_status_idx ON mailing_stats (run_id, status);
+    """),
+    # Состояние и курсор прогона для возобновления; старые прогоны считаем завершенными
+    (7, "mailing_runs_checkpoints", """
+    ALTER TABLE mailing_runs
+        ADD COLUMN IF NOT EXISTS state TEXT NOT NULL DEFAULT 'done',
+        ADD COLUMN IF NOT EXISTS cursor BIGINT,
+        ADD COLUMN IF NOT EXISTS admin_id BIGINT,
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now(),
+        ADD COLUMN IF NOT EXISTS finished_at TIMESTAMPTZ;
+    ALTER TABLE mailing_runs ALTER COLUMN state SET DEFAULT 'running';
+    CREATE INDEX IF NOT EXISTS mailing_runs_unfinished_idx ON mailing_runs (state) WHERE state <> 'done';
+    """),
+    # Очередь заданий рассылки для отдельных процессов-воркеров (broadcast_worker.py).
+    # mode='queue': cursor прогона — последний ID, разложенный по заданиям, planned — раскладка закончена
+    (8, "broadcast_jobs", """
+    ALTER TABLE mailing_runs
+        ADD COLUMN IF NOT EXISTS mode TEXT NOT NULL DEFAULT 'inline',
+        ADD COLUMN IF NOT EXISTS planned BOOLEAN NOT NULL DEFAULT FALSE;
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        run_id BIGINT NOT NULL REFERENCES mailing_runs(id) ON DELETE CASCADE,
+        recipient_ids BIGINT[] NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending', -- pending, claimed, done, failed
+        cursor BIGINT,
+        claimed_by TEXT,
+        claimed_at TIMESTAMPTZ,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMPTZ DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS broadcast_jobs_open_idx ON broadcast_jobs (run_id, id)
+        WHERE state IN ('pending', 'claimed');
+    """),
+    # Исходное сообщение прогона, которое рассылается через copy_message
+    (9, "mailing_runs_source_message", """
+    ALTER TABLE mailing_runs
+        ADD COLUMN IF NOT EXISTS source_chat_id BIGINT,
+        ADD COLUMN IF NOT EXISTS source_message_id BIGINT;
+    """),
+    # Отложенные рассылки. Расписание разворачивается в слоты: один слот — один будущий
+    # прогон на группу часовых поясов (tz_filter; '' — пользователи без пояса), rate растягивает его на окно
+    (10, "mailing_schedules", """
+    ALTER TABLE mailing_runs
+        ADD COLUMN IF NOT EXISTS tz_filter TEXT[],
+        ADD COLUMN IF NOT EXISTS rate REAL;
+    CREATE TABLE IF NOT EXISTS mailing_schedules (
+        id BIGSERIAL PRIMARY KEY,
+        mailing_id BIGINT NOT NULL REFERENCES mailings(id) ON DELETE CASCADE,
+        admin_id BIGINT,
+        kind TEXT NOT NULL, -- absolute, local
+        local_time TIMESTAMP, -- для local: дата и время на часах пользователя
+        spread_minutes INTEGER NOT NULL DEFAULT 0,
+        cancelled BOOLEAN NOT NULL DEFAULT FALSE,
+        created_at TIMESTAMPTZ DEFAULT now()
+    );
+    CREATE TABLE IF NOT EXISTS mailing_schedule_slots (
+        id BIGSERIAL PRIMARY KEY,
+        schedule_id BIGINT NOT NULL REFERENCES mailing_schedules(id) ON DELETE CASCADE,
+        fire_at TIMESTAMPTZ NOT NULL,
+        tz_filter TEXT[],
+        audience INTEGER NOT NULL DEFAULT 0,
+        run_id BIGINT REFERENCES mailing_runs(id) ON DELETE SET NULL
+    );
+    CREATE INDEX IF NOT EXISTS mailing_schedule_slots_due_idx ON mailing_schedule_slots (fire_at)
+        WHERE run_id IS NULL;
+    """),
+    # Плотный порядковый номер пользователя для битмапов сегментов (см. SegmentIndex).
+    # Разбит на шаги 11, 14-16, чтобы не держать ACCESS EXCLUSIVE на tg_users дольше
+    # изменения каталога: здесь только nullable-колонка и последовательность, номера
+    # раздает шаг 14, индекс — 15, NOT NULL — 16. Прежний единый шаг 11 (см.
+    # MigrationRunner.REWRITTEN) приводил к той же схеме, шаги 14-16 на таких БД пустые
+    (11, "user_ordinals_and_run_segments", """
+    ALTER TABLE tg_users ADD COLUMN IF NOT EXISTS ord BIGINT;
+    CREATE SEQUENCE IF NOT EXISTS tg_users_ord_seq OWNED BY tg_users.ord;
+    ALTER TABLE mailing_runs ADD COLUMN IF NOT EXISTS segment JSONB;
+    """),
+    # Состояния FSM aiogram (utils/fsm_storage.PgStorage): переживают рестарт и общие для процессов
+    (12, "fsm_states", FSM_STATES_DDL),
+    # Момент последней смены is_alive: отложенная отметка «заблокировал» из буфера
+    # (UserStatusBuffer) не перетирает более поздний /start. Колонка без DEFAULT —
+    # только каталог, tg_users не переписывается
+    (13, "tg_users_alive_changed_at", """
+    ALTER TABLE tg_users ADD COLUMN IF NOT EXISTS alive_changed_at TIMESTAMPTZ;
+    """),
+    (14, "backfill_user_ordinals", _backfill_user_ordinals),
+    (15, "user_ordinals_index", _create_user_ordinals_index),
+    (16, "user_ordinals_not_null", _user_ordinals_not_null),
+]
+
+class MigrationRunner:
+    """
+    Применяет недостающие миграции из MIGRATIONS ровно один раз.
+    Теплый старт — один SELECT из schema_migrations без блокировок; если есть
+    что применять, берется advisory lock, чтобы параллельные процессы не
+    накатывали одно и то же. Каждый шаг идет в своей транзакции, кроме
+    помеченных non_transactional.
+
+    Примененные шаги не редактируются — изменения схемы идут новой миграцией.
+    Если контрольная сумма примененного шага не совпала, старт падает
+    (RuntimeError), пока версия не подтверждена в accept_changed.
+    """
+    LOCK_KEY = 7_231_908_114  # произвольная константа для pg_advisory_lock
+    # Осознанно переписанные примененные шаги: версия -> прежние суммы, которые
+    # считаются равнозначными (схема та же, менялся только способ ее получить)
+    REWRITTEN = {
+        # 11: единый шаг с раздачей ord, NOT NULL и индексом до разбиения на 11, 14-16
+        11: {"2bff569f31e11177ce34d7e75ed3f860ea1a7567a6d7eb1106e745d4ded30d6e"},
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool, migrations: list = MIGRATIONS,
+                 accept_changed: set[int] = MIGRATIONS_ACCEPT_CHANGED):
         self.pool = pool
+        self.migrations = sorted(migrations, key=lambda m: m[0])
+        self.accept_changed = accept_changed
+
+    @staticmethod
+    def _step_functions(step) -> list:
+        """Функция шага и все функции этого модуля, которые она вызывает (рекурсивно)"""
+        functions, queue = [step], [step]
+        while queue:
+            codes = [queue.pop().__code__]
+            names = []
+            while codes:
+                code = codes.pop()
+                names.extend(code.co_names)
+                codes.extend(c for c in code.co_consts if inspect.iscode(c))
+            for name in names:
+                helper = step.__globals__.get(name)
+                if inspect.isfunction(helper) and helper.__module__ == step.__module__ and helper not in functions:
+                    functions.append(helper)
+                    queue.append(helper)
+        return functions
+
+    @classmethod
+    def checksum(cls, step) -> str:
+        """SQL шага или исходники функции шага вместе с вызываемыми ею функциями модуля"""
+        if callable(step):
+            source = "\n".join(inspect.getsource(f).strip() for f in cls._step_functions(step))
+        else:
+            source = step
+        return hashlib.sha256(source.strip().encode("utf-8")).hexdigest()
 
-    async def create_users_table(self):
-        """Создание таблицы пользователей и миграция для referrer_id"""
-        query = """
-        CREATE TABLE IF NOT EXISTS tg_users (
-            telegram_id BIGINT PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            language_code TEXT,
-            timezone TEXT,
-            is_premium BOOLEAN DEFAULT FALSE,
-            referrer_id BIGINT,
-            referrals BIGINT[] DEFAULT '{}',
-            is_alive BOOLEAN DEFAULT TRUE,
-            logs JSONB DEFAULT '[]',
-            balance NUMERIC(18,2) DEFAULT 0,
-            quests_done BIGINT[] DEFAULT '{}',
-            cash_out_used BIGINT[] DEFAULT '{}',
-            created_at TIMESTAMPTZ DEFAULT now()
-        );
+    @staticmethod
+    def legacy_checksum(step) -> str:
+        """Прежняя сумма — только исходник самой функции шага"""
+        source = inspect.getsource(step) if callable(step) else step
+        return hashlib.sha256(source.strip().encode("utf-8")).hexdigest()
+
+    async def _applied(self, conn) -> dict[int, str]:
+        try:
+            rows = await conn.fetch("SELECT version, checksum FROM schema_migrations;")
+        except asyncpg.exceptions.UndefinedTableError:
+            return {}
+        return {row['version']: row['checksum'] for row in rows}
+
+    def _pending(self, applied: dict[int, str]) -> tuple[list, list[tuple[int, str]]]:
+        """
+        (шаги к применению, [(версия, новая сумма)] для перезаписи в schema_migrations).
+        Примененный шаг с чужой суммой — RuntimeError, если версия не подтверждена.
         """
+        pending, rechecksum = [], []
+        for version, name, step in self.migrations:
+            if version not in applied:
+                pending.append((version, name, step))
+                continue
+            checksum = self.checksum(step)
+            if applied[version] == checksum:
+                continue
+            if applied[version] == self.legacy_checksum(step):
+                # Записано старым способом подсчета, сам шаг не менялся
+                rechecksum.append((version, checksum))
+            elif applied[version] in self.REWRITTEN.get(version, ()):
+                logger.info(f"Миграция {version} ({name}) переписана равнозначно, обновляем сумму")
+                rechecksum.append((version, checksum))
+            elif version in self.accept_changed:
+                logger.warning(f"Миграция {version} ({name}) изменена после применения, изменение подтверждено")
+                rechecksum.append((version, checksum))
+            else:
+                raise RuntimeError(
+                    f"Миграция {version} ({name}) изменена после применения: БД могла получить другую схему. "
+                    f"Верните прежний текст шага и добавьте новую миграцию или подтвердите изменение "
+                    f"MIGRATIONS_ACCEPT_CHANGED={version}"
+                )
+        return pending, rechecksum
+
+    async def _apply(self, conn, version: int, name: str, step):
+        if callable(step):
+            await step(conn)
+        else:
+            await conn.execute(step)
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name, checksum) VALUES ($1, $2, $3);",
+            version, name, self.checksum(step)
+        )
+
+    async def run(self) -> list[int]:
+        """Возвращает список примененных версий (пустой на теплом старте)"""
         async with self.pool.acquire() as conn:
-            await conn.execute(query)
-            # Принудительное добавление колонки, если таблица уже была создана ранее без нее
-            await conn.execute("ALTER TABLE tg_users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;")
+            if not any(self._pending(await self._applied(conn))):
+                return []
+            await conn.execute("SELECT pg_advisory_lock($1);", self.LOCK_KEY)
+            try:
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    checksum TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ DEFAULT now()
+                );
+                """)
+                # Пока ждали блокировку, миграции мог применить другой процесс
+                pending, rechecksum = self._pending(await self._applied(conn))
+                for version, checksum in rechecksum:
+                    await conn.execute("UPDATE schema_migrations SET checksum = $2 WHERE version = $1;",
+                                       version, checksum)
+                applied_now = []
+                for version, name, step in pending:
+                    started = time.perf_counter()
+                    if getattr(step, "transactional", True):
+                        async with conn.transaction():
+                            await self._apply(conn, version, name, step)
+                    else:
+                        # Шаг сам коммитит по частям, отметка — после успешного завершения всего шага
+                        await self._apply(conn, version, name, step)
+                    applied_now.append(version)
+                    logger.info(f"Миграция {version} ({name}) применена за {time.perf_counter() - started:.2f} с")
+                return applied_now
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1);", self.LOCK_KEY)
 
-    async def add_user(self, telegram_id, username=None, first_name=None, last_name=None, 
-                       language_code=None, timezone=None, is_premium=False, referrer_id=None):
-        """Добавление нового пользователя или обновление существующего"""
-        query = """
+# ------------------ USERS ------------------
+class UsersDBManager:
+    QUERIES = {
+        "users.add": """
         INSERT INTO tg_users (
-            telegram_id, username, first_name, last_name, 
+            telegram_id, username, first_name, last_name,
             language_code, timezone, is_premium, referrer_id
         )
         VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
@@ -58,98 +763,288 @@ class UsersDBManager:
             username = EXCLUDED.username,
             first_name = EXCLUDED.first_name,
             last_name = EXCLUDED.last_name,
-            is_alive = TRUE;
-        """
+            is_alive = TRUE,
+            alive_changed_at = now();
+        """,
+        "users.get_by_id": "SELECT * FROM tg_users WHERE telegram_id = $1;",
+        # Keyset-пагинация по partial-индексу tg_users_alive_idx
+        "users.alive_ids_after": """
+        SELECT telegram_id FROM tg_users
+        WHERE is_alive = TRUE AND telegram_id > $1
+        ORDER BY telegram_id
+        LIMIT $2;
+        """,
+        "users.alive_count_after": "SELECT count(*) FROM tg_users WHERE is_alive = TRUE AND telegram_id > $1;",
+        # Та же выборка, ограниченная часовыми поясами ('' — пользователи без пояса)
+        "users.alive_ids_after_tz": """
+        SELECT telegram_id FROM tg_users
+        WHERE is_alive = TRUE AND telegram_id > $1 AND COALESCE(timezone, '') = ANY($3::text[])
+        ORDER BY telegram_id
+        LIMIT $2;
+        """,
+        "users.alive_count_after_tz": """
+        SELECT count(*) FROM tg_users
+        WHERE is_alive = TRUE AND telegram_id > $1 AND COALESCE(timezone, '') = ANY($2::text[]);
+        """,
+        "users.timezone_buckets": """
+        SELECT COALESCE(timezone, '') AS timezone, count(*) AS users
+        FROM tg_users WHERE is_alive = TRUE
+        GROUP BY 1;
+        """,
+        "users.update_balance": "UPDATE tg_users SET balance = balance + $1 WHERE telegram_id = $2;",
+        # Пары с неизвестными юзерами пропускаем, как раньше UPDATE без совпадений
+        "users.add_referrals": """
+        INSERT INTO user_referrals (referrer_id, referral_id)
+        SELECT r.referrer_id, r.referral_id
+        FROM unnest($1::bigint[], $2::bigint[]) AS r(referrer_id, referral_id)
+        JOIN tg_users a ON a.telegram_id = r.referrer_id
+        JOIN tg_users b ON b.telegram_id = r.referral_id
+        ON CONFLICT DO NOTHING;
+        """,
+        # Баланс, статусы квестов и счетчики одним запросом для /api/quest/statuses
+        "users.snapshot": """
+        SELECT u.balance,
+            COALESCE((SELECT json_agg(json_build_object('quest_id', q.quest_id, 'status', q.status))
+                      FROM user_quest_statuses q WHERE q.telegram_id = u.telegram_id), '[]'::json) AS quests,
+            COALESCE((SELECT json_object_agg(c.counter_key, c.value)
+                      FROM user_counters c WHERE c.telegram_id = u.telegram_id), '{}'::json) AS counters
+        FROM tg_users u
+        WHERE u.telegram_id = $1;
+        """,
+        "users.referral_count": "SELECT count(*) FROM user_referrals WHERE referrer_id = $1;",
+        "users.referrals_total": "SELECT count(*) FROM user_referrals;",
+        "users.referral_leaderboard": """
+        SELECT referrer_id, count(*) AS referrals
+        FROM user_referrals
+        GROUP BY referrer_id
+        ORDER BY referrals DESC
+        LIMIT $1;
+        """,
+        "users.update_status": "UPDATE tg_users SET is_alive = $1, alive_changed_at = now() WHERE telegram_id = $2;",
+        "users.add_quests_done": """
+        INSERT INTO user_quests_done (telegram_id, quest_id)
+        SELECT q.telegram_id, q.quest_id
+        FROM unnest($1::bigint[], $2::text[]) AS q(telegram_id, quest_id)
+        JOIN tg_users u ON u.telegram_id = q.telegram_id
+        ON CONFLICT DO NOTHING;
+        """,
+        "users.log_event": "INSERT INTO user_events (telegram_id, event) VALUES ($1, $2::jsonb);",
+        "users.events_page": """
+        SELECT id, event, created_at FROM user_events
+        WHERE telegram_id = $1 AND id < $2
+        ORDER BY id DESC
+        LIMIT $3;
+        """,
+    }
+
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None,
+                 events_buffer: "UserEventsBuffer | None" = None,
+                 snapshot_cache: SnapshotCache | None = None,
+                 counter_buffer: "CounterBuffer | None" = None,
+                 status_buffer: "UserStatusBuffer | None" = None):
+        self.db_url = db_url
+        self.pool = pool
+        self.events_buffer = events_buffer
+        self.snapshot_cache = snapshot_cache
+        self.counter_buffer = counter_buffer
+        self.status_buffer = status_buffer
+
+    async def add_user(self, telegram_id, username=None, first_name=None, last_name=None,
+                       language_code=None, timezone=None, is_premium=False, referrer_id=None):
+        """Добавление нового пользователя или обновление существующего"""
+        if self.status_buffer:
+            # users.add сам возвращает is_alive = TRUE, отложенная «смерть» устарела
+            self.status_buffer.discard(telegram_id)
         async with self.pool.acquire() as conn:
-            await conn.execute(query, telegram_id, username, first_name, last_name, 
-                               language_code, timezone, is_premium, referrer_id)
+            await queries.execute(conn, "users.add", telegram_id, username, first_name, last_name,
+                                  language_code, timezone, is_premium, referrer_id)
 
     async def get_user_by_telegram_id(self, telegram_id: int):
         """Получение всех данных пользователя по ID"""
-        query = "SELECT * FROM tg_users WHERE telegram_id = $1;"
         async with self.pool.acquire() as conn:
-            return await conn.fetchrow(query, telegram_id)
+            return await queries.fetchrow(conn, "users.get_by_id", telegram_id)
 
-    async def get_all_user_ids(self):
-        """Получение списка ID всех активных пользователей для рассылки"""
-        query = "SELECT telegram_id FROM tg_users WHERE is_alive = TRUE;"
+    async def iter_alive_user_id_chunks(self, chunk_size: int = 1000, after_id: int | None = None,
+                                        timezones: list[str] | None = None):
+        """
+        Async-генератор ID живых пользователей чанками по chunk_size, по возрастанию telegram_id.
+        Соединение берется только на время одного запроса, следующий чанк
+        подгружается, пока потребитель обрабатывает текущий.
+        after_id — продолжить строго после этого ID.
+        timezones — только пользователи из этих поясов ('' — без пояса).
+        """
+        async def fetch_after(last_id: int) -> list[int]:
+            async with self.pool.acquire() as conn:
+                if timezones is not None:
+                    rows = await queries.fetch(conn, "users.alive_ids_after_tz", last_id, chunk_size, timezones)
+                else:
+                    rows = await queries.fetch(conn, "users.alive_ids_after", last_id, chunk_size)
+                return [row['telegram_id'] for row in rows]
+
+        chunk = await fetch_after(after_id if after_id is not None else -2**63)
+        while chunk:
+            next_chunk = None
+            if len(chunk) == chunk_size:
+                next_chunk = asyncio.create_task(fetch_after(chunk[-1]))
+            try:
+                yield chunk
+            except BaseException:
+                if next_chunk:
+                    next_chunk.cancel()
+                raise
+            chunk = await next_chunk if next_chunk else []
+
+    async def iter_alive_user_ids(self, chunk_size: int = 1000, after_id: int | None = None):
+        """Поштучный поток ID живых пользователей поверх iter_alive_user_id_chunks"""
+        async for chunk in self.iter_alive_user_id_chunks(chunk_size, after_id):
+            for telegram_id in chunk:
+                yield telegram_id
+
+    async def count_alive_user_ids(self, after_id: int | None = None, timezones: list[str] | None = None) -> int:
+        """Сколько живых пользователей осталось после after_id (оценка аудитории рассылки)"""
+        after_id = after_id if after_id is not None else -2**63
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(query)
-            return [row['telegram_id'] for row in rows]
-        
+            if timezones is not None:
+                return await queries.fetchval(conn, "users.alive_count_after_tz", after_id, timezones)
+            return await queries.fetchval(conn, "users.alive_count_after", after_id)
+
+    async def get_timezone_buckets(self) -> dict[str, int]:
+        """Живые пользователи по сохраненному часовому поясу: {timezone или '': количество}"""
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "users.timezone_buckets")
+            return {r['timezone']: r['users'] for r in rows}
+
+    async def get_all_user_ids(self):
+        """Получение списка ID всех активных пользователей (для рассылок используйте iter_alive_user_ids)"""
+        return await self.get_all_alive_user_ids()
+
     async def get_all_alive_user_ids(self):
-        query = "SELECT telegram_id FROM tg_users WHERE is_alive = TRUE;"
+        return [telegram_id async for telegram_id in self.iter_alive_user_ids(chunk_size=10000)]
+
+    async def get_snapshot(self, telegram_id: int) -> dict | None:
+        """
+        Компактный снимок пользователя: {'balance', 'quests', 'counters'}.
+        Берется из короткоживущего кеша, иначе одним запросом из БД.
+        """
+        if self.snapshot_cache:
+            cached = self.snapshot_cache.get(telegram_id)
+            if cached is not None:
+                return cached
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(query)
-            return [row['telegram_id'] for row in rows]
+            row = await queries.fetchrow(conn, "users.snapshot", telegram_id)
+        if not row:
+            return None
+        counters = json.loads(row['counters'])
+        if self.counter_buffer:
+            counters = self.counter_buffer.merge_counters(telegram_id, counters)
+        snapshot = {
+            "balance": float(row['balance']),
+            "quests": json.loads(row['quests']),
+            "counters": counters,
+        }
+        if self.snapshot_cache:
+            self.snapshot_cache.set(telegram_id, snapshot)
+        return snapshot
 
     async def update_balance(self, telegram_id: int, amount: float):
         """Изменение баланса пользователя"""
-        query = "UPDATE tg_users SET balance = balance + $1 WHERE telegram_id = $2;"
         async with self.pool.acquire() as conn:
-            await conn.execute(query, amount, telegram_id)
+            await queries.execute(conn, "users.update_balance", amount, telegram_id)
+        if self.snapshot_cache:
+            self.snapshot_cache.invalidate(telegram_id)
 
     async def add_referral(self, referrer_id: int, referral_id: int):
         """Добавление ID приглашенного пользователя в список рефералов"""
-        query = """
-        UPDATE tg_users
-        SET referrals = array_append(referrals, $1)
-        WHERE telegram_id = $2 AND NOT ($1 = ANY(referrals));
-        """
+        await self.add_referrals_bulk([(referrer_id, referral_id)])
+
+    async def add_referrals_bulk(self, pairs: list[tuple[int, int]]):
+        """Пакетное добавление пар (referrer_id, referral_id) одним запросом"""
+        if not pairs:
+            return
         async with self.pool.acquire() as conn:
-            await conn.execute(query, referral_id, referrer_id)
+            await queries.execute(conn, "users.add_referrals", [p[0] for p in pairs], [p[1] for p in pairs])
 
-    async def update_user_status(self, telegram_id: int, is_alive: bool):
-        """Обновление статуса (заблокировал бота или нет)"""
-        query = "UPDATE tg_users SET is_alive = $1 WHERE telegram_id = $2;"
+    async def get_referral_count(self, referrer_id: int) -> int:
         async with self.pool.acquire() as conn:
-            await conn.execute(query, is_alive, telegram_id)
+            return await queries.fetchval(conn, "users.referral_count", referrer_id)
 
-    async def add_quest_done(self, telegram_id: int, quest_id: int):
-        """Пометка квеста как выполненного в основной таблице пользователя"""
-        query = """
-        UPDATE tg_users 
-        SET quests_done = array_append(quests_done, $1) 
-        WHERE telegram_id = $2 AND NOT ($1 = ANY(quests_done));
+    async def get_referrals_total(self) -> int:
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "users.referrals_total")
+
+    async def get_referral_leaderboard(self, limit: int = 10):
+        """Топ пригласивших: [{'referrer_id': ..., 'referrals': ...}, ...]"""
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "users.referral_leaderboard", limit)
+            return [dict(r) for r in rows]
+
+    async def update_user_status(self, telegram_id: int, is_alive: bool):
         """
+        Обновление статуса (заблокировал бота или нет). «Умер» копится в буфере,
+        если он подключен; «ожил» пишется сразу и отменяет несброшенную отметку.
+        """
+        if self.status_buffer:
+            if not is_alive:
+                self.status_buffer.add(telegram_id)
+                return
+            self.status_buffer.discard(telegram_id)
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "users.update_status", is_alive, telegram_id)
+
+    async def flush_statuses(self):
+        """Дописывает накопленные статусы is_alive (в конце рассылки)"""
+        if self.status_buffer:
+            await self.status_buffer.flush()
+
+    async def add_quest_done(self, telegram_id: int, quest_id: str):
+        """Пометка квеста как выполненного"""
+        await self.add_quests_done_bulk([(telegram_id, quest_id)])
+
+    async def add_quests_done_bulk(self, pairs: list[tuple[int, str]]):
+        """Пакетная пометка пар (telegram_id, quest_id) одним запросом"""
+        if not pairs:
+            return
         async with self.pool.acquire() as conn:
-            await conn.execute(query, quest_id, telegram_id)
+            await queries.execute(conn, "users.add_quests_done", [p[0] for p in pairs], [str(p[1]) for p in pairs])
 
     async def log_event(self, telegram_id: int, event_data: dict):
-        """Запись действия в логи пользователя"""
-        query = """
-        UPDATE tg_users 
-        SET logs = logs || $1::jsonb 
-        WHERE telegram_id = $2;
+        """Запись действия в журнал user_events (пачками через буфер, если он подключен)"""
+        if self.events_buffer:
+            self.events_buffer.add(telegram_id, event_data)
+            return
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "users.log_event", telegram_id, json.dumps(event_data))
+
+    async def get_user_events(self, telegram_id: int, before_id: int | None = None, limit: int = 50):
         """
+        Страница событий пользователя, от новых к старым.
+        Для следующей страницы передайте before_id = id последнего события.
+        """
+        if self.events_buffer:
+            await self.events_buffer.flush()
         async with self.pool.acquire() as conn:
-            await conn.execute(query, json.dumps([event_data]), telegram_id)
+            rows = await queries.fetch(conn, "users.events_page", telegram_id, before_id or 2**63 - 1, limit)
+            return [{"id": r['id'], "event": json.loads(r['event']), "created_at": r['created_at']} for r in rows]
 
 # ------------------ VIDEOS ------------------
 class VideosDBManager:
-    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None, videos_path: str = "vids"):
+    QUERIES = {
+        "videos.add_if_not_exists": "INSERT INTO videos (title, video_url) VALUES ($1, $2) ON CONFLICT (video_url) DO NOTHING;",
+        "videos.active": "SELECT * FROM videos WHERE is_active = TRUE;",
+        "videos.increment_watched": "UPDATE videos SET watched = watched + 1 WHERE id = $1;",
+    }
+
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None, videos_path: str = "vids",
+                 counter_buffer: "CounterBuffer | None" = None, catalog: "VideoCatalog | None" = None):
         self.db_url = db_url
         self.pool = pool
         self.videos_path = videos_path
-
-    async def create_videos_table(self):
-        query = """
-        CREATE TABLE IF NOT EXISTS videos (
-            id BIGSERIAL PRIMARY KEY,
-            title TEXT,
-            video_url TEXT UNIQUE NOT NULL,
-            is_active BOOLEAN DEFAULT TRUE,
-            watched INTEGER DEFAULT 0,
-            clicked INTEGER DEFAULT 0
-        );
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(query)
+        self.counter_buffer = counter_buffer
+        self.catalog = catalog
 
     async def add_video_if_not_exists(self, title: str, video_url: str):
-        query = "INSERT INTO videos (title, video_url) VALUES ($1, $2) ON CONFLICT (video_url) DO NOTHING;"
         async with self.pool.acquire() as conn:
-            await conn.execute(query, title, video_url)
+            await queries.execute(conn, "videos.add_if_not_exists", title, video_url)
 
     async def sync_videos_from_folder(self):
         if not os.path.exists(self.videos_path):
@@ -158,151 +1053,852 @@ class VideosDBManager:
         for filename in os.listdir(self.videos_path):
             if filename.lower().endswith((".mp4", ".mov", ".webm")):
                 video_path = os.path.join(self.videos_path, filename)
+                if self.catalog and self.catalog.has_url(video_path):
+                    continue
                 title = os.path.splitext(filename)[0]
                 await self.add_video_if_not_exists(title=title, video_url=video_path)
 
     async def get_random_video(self):
-        query = "SELECT * FROM videos WHERE is_active = TRUE;"
+        if self.catalog and self.catalog.loaded:
+            return self.catalog.random_video()
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(query)
+            rows = await queries.fetch(conn, "videos.active")
             return random.choice(rows) if rows else None
 
     async def increment_watched(self, video_id: int):
-        query = "UPDATE videos SET watched = watched + 1 WHERE id = $1;"
+        if self.counter_buffer:
+            # Горячий путь: копим дельту в памяти, в БД уйдет пачкой
+            self.counter_buffer.add_video_view(int(video_id))
+            return
         async with self.pool.acquire() as conn:
-            await conn.execute(query, int(video_id))
+            await queries.execute(conn, "videos.increment_watched", int(video_id))
+
+# ------------------ VIDEO CATALOG ------------------
+class VideoCatalog:
+    """
+    Резидентный каталог активных видео. Загружается один раз при старте и
+    перечитывается по NOTIFY videos_changed (триггер на videos), поэтому выбор
+    случайного видео — это random.choice по списку в памяти без запросов в БД.
+    """
+    CHANNEL = "videos_changed"
+    QUERIES = {
+        "catalog.load": "SELECT id, title, video_url FROM videos WHERE is_active = TRUE ORDER BY id;",
+    }
+
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool, check_interval: float = 60.0,
+                 reconnect_delay: float = 5.0):
+        self.db_url = db_url
+        self.pool = pool
+        self.check_interval = check_interval
+        self.reconnect_delay = reconnect_delay
+        self.loaded = False
+        self.version = 0
+        self._videos: list[asyncpg.Record] = []
+        self._urls: set[str] = set()
+        self._dirty = False
+        self._reload_task: asyncio.Task | None = None
+        self._listener_task: asyncio.Task | None = None
+
+    async def reload(self):
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "catalog.load")
+        # Подменяем ссылки целиком, читатели никогда не видят полусобранный каталог
+        self._videos = rows
+        self._urls = {row['video_url'] for row in rows}
+        self.version += 1
+        self.loaded = True
+        logger.info(f"Каталог видео загружен: {len(rows)} шт. (версия {self.version})")
+
+    def random_video(self):
+        return random.choice(self._videos) if self._videos else None
+
+    def has_url(self, video_url: str) -> bool:
+        return video_url in self._urls
+
+    def __len__(self):
+        return len(self._videos)
+
+    def start(self):
+        if not self._listener_task:
+            self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        for task in (self._listener_task, self._reload_task):
+            if task and not task.done():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self._listener_task = None
+
+    def _on_notify(self, conn, pid, channel, payload):
+        # Пачку уведомлений (например, синк папки) схлопываем в одну перезагрузку
+        self._dirty = True
+        if not self._reload_task or self._reload_task.done():
+            self._reload_task = asyncio.create_task(self._reload_while_dirty())
+
+    async def _reload_while_dirty(self):
+        while self._dirty:
+            self._dirty = False
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Не удалось перечитать каталог видео")
+
+    async def _listen(self):
+        """Держит отдельное соединение под LISTEN (не из пула) и переподключается при обрыве"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.db_url)
+                await conn.add_listener(self.CHANNEL, self._on_notify)
+                # Пока соединения не было, уведомления могли потеряться
+                self._on_notify(conn, None, self.CHANNEL, "")
+                while True:
+                    await asyncio.sleep(self.check_interval)
+                    await conn.execute("SELECT 1;")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"LISTEN {self.CHANNEL} прерван: {e}")
+            finally:
+                if conn and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+# ------------------ SEGMENTS ------------------
+def _bitmap_from_ords(ords: list[int]) -> int:
+    """Битмап (int) из списка порядковых номеров; собираем через bytearray, а не сдвигами по одному"""
+    if not ords:
+        return 0
+    buf = bytearray((max(ords) >> 3) + 1)
+    for o in ords:
+        buf[o >> 3] |= 1 << (o & 7)
+    return int.from_bytes(buf, "little")
+
+
+def _ords_from_bitmap(bitmap: int) -> list[int]:
+    """Порядковые номера установленных битов по возрастанию"""
+    ords = []
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            for bit in range(8):
+                if byte >> bit & 1:
+                    ords.append(base + bit)
+    return ords
+
+
+class SegmentIndex:
+    """
+    Сегменты аудитории в памяти. Каждый пользователь имеет плотный порядковый
+    номер tg_users.ord, признак хранится битмапом (Python int, бит ord), поэтому
+    пересечение и подсчет сегмента — это & и bit_count() за миллисекунды.
+
+    Предрасчитанные битмапы: живые, premium, по языку, по квестам, «пришел по рефералке».
+    Дата регистрации — диапазон ord (ord выдается по порядку регистрации).
+    Редкие фильтры (конкретный реферер, минимум просмотров) читаются из БД по
+    запросу и кешируются до следующего обновления.
+
+    Новые пользователи догружаются инкрементально по ord > последнего,
+    изменения существующих (блокировки, premium, квесты) — полной пересборкой.
+
+    Спецификация сегмента — dict:
+        language: ["ru", "en"], premium: bool, signup_from / signup_to: "YYYY-MM-DD",
+        has_referrer: bool, referrer: telegram_id, min_videos: int, quest / no_quest: quest_id
+    """
+    QUERIES = {
+        "segments.users_after": """
+        SELECT ord, telegram_id, language_code, is_premium, is_alive, created_at
+        FROM tg_users WHERE ord > $1
+        ORDER BY ord
+        LIMIT $2;
+        """,
+        "segments.quests_done": """
+        SELECT u.ord, q.quest_id FROM user_quests_done q
+        JOIN tg_users u ON u.telegram_id = q.telegram_id
+        WHERE u.ord > $1;
+        """,
+        "segments.referred": """
+        SELECT DISTINCT u.ord FROM user_referrals r
+        JOIN tg_users u ON u.telegram_id = r.referral_id
+        WHERE u.ord > $1;
+        """,
+        "segments.referrals_of": """
+        SELECT u.ord FROM user_referrals r
+        JOIN tg_users u ON u.telegram_id = r.referral_id
+        WHERE r.referrer_id = $1;
+        """,
+        "segments.counter_at_least": """
+        SELECT u.ord FROM user_counters c
+        JOIN tg_users u ON u.telegram_id = c.telegram_id
+        WHERE c.counter_key = $1 AND c.value >= $2;
+        """,
+        # Финальная проверка чанка аудитории: блокировки и пояса — по актуальным данным
+        "segments.alive_among": """
+        SELECT telegram_id FROM tg_users
+        WHERE telegram_id = ANY($1::bigint[]) AND is_alive = TRUE
+          AND ($2::text[] IS NULL OR COALESCE(timezone, '') = ANY($2::text[]))
+        ORDER BY telegram_id;
+        """,
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool, refresh_interval: float = SEGMENTS_REFRESH_INTERVAL,
+                 rebuild_interval: float = SEGMENTS_REBUILD_INTERVAL, chunk_size: int = 50000):
+        self.pool = pool
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.chunk_size = chunk_size
+        self.version = 0
+        self._reset()
+        self._ready = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def _reset(self):
+        self._ids = array("q")        # ord -> telegram_id (0 — дырка)
+        self._created = array("d")    # ord -> created_at (epoch), для диапазона регистрации
+        self._last_ord = 0
+        self.alive = 0
+        self.premium = 0
+        self.referred = 0
+        self.languages: dict[str, int] = {}
+        self.quests: dict[str, int] = {}
+        self._cache: dict[tuple, int] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self._ready.is_set()
+
+    async def ready(self):
+        """Ждет первой сборки; индекс строится лениво — при первом обращении к сегментам"""
+        self.start()
+        await self._ready.wait()
+
+    # --- загрузка ---
+
+    async def _scan(self, after_ord: int) -> dict:
+        part = {"users": [], "alive": [], "premium": [], "languages": {}, "quests": {},
+                "referred": [], "last_ord": after_ord}
+        last = after_ord
+        while True:
+            async with self.pool.acquire() as conn:
+                rows = await queries.fetch(conn, "segments.users_after", last, self.chunk_size)
+            if not rows:
+                break
+            for r in rows:
+                o = r['ord']
+                part["users"].append((o, r['telegram_id'], r['created_at'].timestamp() if r['created_at'] else 0.0))
+                if r['is_alive']:
+                    part["alive"].append(o)
+                if r['is_premium']:
+                    part["premium"].append(o)
+                # Язык по основному подтегу: 'pt-br' попадает в 'pt'
+                lang = (r['language_code'] or "").lower().split("-")[0]
+                part["languages"].setdefault(lang, []).append(o)
+            last = rows[-1]['ord']
+        part["last_ord"] = last
+        async with self.pool.acquire() as conn:
+            for r in await queries.fetch(conn, "segments.quests_done", after_ord):
+                part["quests"].setdefault(r['quest_id'], []).append(r['ord'])
+            part["referred"] = [r['ord'] for r in await queries.fetch(conn, "segments.referred", after_ord)]
+        return part
+
+    def _merge(self, part: dict):
+        # Без await: читатели видят либо старое, либо уже слитое состояние
+        for o, telegram_id, created in part["users"]:
+            if o >= len(self._ids):
+                fill = o + 1 - len(self._ids)
+                self._ids.extend([0] * fill)
+                self._created.extend([self._created[-1] if self._created else created] * fill)
+            self._ids[o] = telegram_id
+            self._created[o] = created
+        self.alive |= _bitmap_from_ords(part["alive"])
+        self.premium |= _bitmap_from_ords(part["premium"])
+        self.referred |= _bitmap_from_ords(part["referred"])
+        for lang, ords in part["languages"].items():
+            self.languages[lang] = self.languages.get(lang, 0) | _bitmap_from_ords(ords)
+        for quest_id, ords in part["quests"].items():
+            self.quests[quest_id] = self.quests.get(quest_id, 0) | _bitmap_from_ords(ords)
+        self._last_ord = max(self._last_ord, part["last_ord"])
+        self._cache.clear()
+        self.version += 1
+
+    async def rebuild(self):
+        """Полная пересборка (подхватывает изменения существующих пользователей)"""
+        async with self._lock:
+            started = time.monotonic()
+            part = await self._scan(0)
+            self._reset()
+            self._merge(part)
+            self._ready.set()
+            logger.info(
+                f"Сегменты пересобраны: {self.alive.bit_count()} живых из {len(part['users'])}, "
+                f"{(time.monotonic() - started) * 1000:.0f} мс"
+            )
+
+    async def refresh(self):
+        """Инкрементально догружает пользователей, зарегистрированных после последней загрузки"""
+        if not self.loaded:
+            return await self.rebuild()
+        async with self._lock:
+            part = await self._scan(self._last_ord)
+            if part["users"]:
+                self._merge(part)
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _loop(self):
+        last_rebuild = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_rebuild >= self.rebuild_interval:
+                    await self.rebuild()
+                    last_rebuild = time.monotonic()
+                else:
+                    await self.refresh()
+            except Exception:
+                logger.exception("Ошибка обновления сегментов")
+            await asyncio.sleep(self.refresh_interval)
+
+    # --- вычисление ---
+
+    async def _query_bitmap(self, key: tuple, name: str, *args) -> int:
+        bitmap = self._cache.get(key)
+        if bitmap is None:
+            async with self.pool.acquire() as conn:
+                rows = await queries.fetch(conn, name, *args)
+            bitmap = self._cache[key] = _bitmap_from_ords([r['ord'] for r in rows])
+        return bitmap
+
+    def _signup_mask(self, date_from: str | None, date_to: str | None) -> int:
+        lo, hi = 0, len(self._created)
+        if date_from:
+            ts = datetime.fromisoformat(date_from).replace(tzinfo=timezone.utc).timestamp()
+            lo = bisect.bisect_left(self._created, ts)
+        if date_to:
+            # Дата «по» включительно: до начала следующего дня
+            ts = datetime.fromisoformat(date_to).replace(tzinfo=timezone.utc).timestamp() + 86400
+            hi = bisect.bisect_left(self._created, ts)
+        if hi <= lo:
+            return 0
+        return ((1 << hi) - 1) ^ ((1 << lo) - 1)
+
+    async def evaluate(self, spec: dict) -> int:
+        """Битмап сегмента (всегда подмножество живых)"""
+        await self.ready()
+        bitmap = self.alive
+        if spec.get("language"):
+            langs = 0
+            for lang in spec["language"]:
+                langs |= self.languages.get(lang.lower().split("-")[0], 0)
+            bitmap &= langs
+        if "premium" in spec:
+            bitmap = bitmap & self.premium if spec["premium"] else bitmap & ~self.premium
+        if spec.get("signup_from") or spec.get("signup_to"):
+            bitmap &= self._signup_mask(spec.get("signup_from"), spec.get("signup_to"))
+        if "has_referrer" in spec:
+            bitmap = bitmap & self.referred if spec["has_referrer"] else bitmap & ~self.referred
+        if spec.get("referrer"):
+            bitmap &= await self._query_bitmap(("referrer", spec["referrer"]), "segments.referrals_of", int(spec["referrer"]))
+        if spec.get("min_videos"):
+            bitmap &= await self._query_bitmap(
+                ("videos", spec["min_videos"]), "segments.counter_at_least", "videos_watched", int(spec["min_videos"])
+            )
+        if spec.get("quest"):
+            bitmap &= self.quests.get(spec["quest"], 0)
+        if spec.get("no_quest"):
+            bitmap &= ~self.quests.get(spec["no_quest"], 0)
+        return bitmap
+
+    async def count(self, spec: dict) -> int:
+        return (await self.evaluate(spec)).bit_count()
+
+    async def members(self, spec: dict) -> array:
+        """telegram_id участников сегмента по возрастанию (для keyset-курсора рассылки)"""
+        bitmap = await self.evaluate(spec)
+        ids = self._ids
+        return array("q", sorted(ids[o] for o in _ords_from_bitmap(bitmap)))
+
+    async def iter_member_chunks(self, spec: dict, chunk_size: int = 1000, after_id: int | None = None,
+                                 timezones: list[str] | None = None):
+        """
+        Как UsersDBManager.iter_alive_user_id_chunks, но по сегменту: состав берется
+        из битмапа один раз, каждый чанк перепроверяется в БД (is_alive, пояса).
+        """
+        members = await self.members(spec)
+        start = bisect.bisect_right(members, after_id) if after_id is not None else 0
+        for i in range(start, len(members), chunk_size):
+            chunk = list(members[i:i + chunk_size])
+            async with self.pool.acquire() as conn:
+                rows = await queries.fetch(conn, "segments.alive_among", chunk, timezones)
+            if rows:
+                yield [r['telegram_id'] for r in rows]
+
+    async def count_members(self, spec: dict, after_id: int | None = None) -> int:
+        members = await self.members(spec)
+        return len(members) - (bisect.bisect_right(members, after_id) if after_id is not None else 0)
+
 
 # ------------------ MAILING ------------------
 class MailingDBManager:
-    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None):
+    QUERIES = {
+        "mailing.start_run": """
+        INSERT INTO mailing_runs (mailing_id, admin_id, mode, tz_filter, rate, segment)
+        VALUES ($1, $2, $3, $4, $5, $6) RETURNING id;
+        """,
+        "mailing.get_run": "SELECT * FROM mailing_runs WHERE id = $1;",
+        "mailing.set_source": """
+        UPDATE mailing_runs SET source_chat_id = $2, source_message_id = $3, updated_at = now()
+        WHERE id = $1;
+        """,
+        # Курсор и текущее состояние одним запросом: так прогон узнает о паузе на каждом чекпоинте
+        "mailing.checkpoint": """
+        UPDATE mailing_runs SET cursor = $2, updated_at = now()
+        WHERE id = $1
+        RETURNING state;
+        """,
+        "mailing.set_state": """
+        UPDATE mailing_runs
+        SET state = $2, updated_at = now(),
+            finished_at = CASE WHEN $2 = 'done' THEN now() ELSE finished_at END
+        WHERE id = $1;
+        """,
+        # Пауза и продолжение — только из ожидаемого состояния: старые кнопки не трогают завершенные прогоны
+        "mailing.pause_run": "UPDATE mailing_runs SET state = 'paused', updated_at = now() WHERE id = $1 AND state = 'running' RETURNING id;",
+        "mailing.resume_run": "UPDATE mailing_runs SET state = 'running', updated_at = now() WHERE id = $1 AND state = 'paused' RETURNING id;",
+        # Прогоны из run_ids, чью аренду (см. run_lease) сейчас держит какой-то процесс
+        "mailing.leased_runs": """
+        SELECT objid::bigint AS run_id FROM pg_locks
+        WHERE locktype = 'advisory' AND granted AND objsubid = 2
+          AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+          AND classid::bigint = $1 AND objid::bigint = ANY($2::bigint[]);
+        """,
+        "mailing.runs_by_state": """
+        SELECT mr.id, mr.state, mr.cursor, mr.admin_id, mr.mode, mr.planned, m.name
+        FROM mailing_runs mr JOIN mailings m ON m.id = mr.mailing_id
+        WHERE mr.state = ANY($1::text[])
+        ORDER BY mr.id;
+        """,
+        "mailing.log_stat": "INSERT INTO mailing_stats (run_id, telegram_id, status) VALUES ($1, $2, $3);",
+        "mailing.add": """INSERT INTO mailings (name, title, text, media_url, media_type, button_text, button_link)
+                   VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id""",
+        "mailing.names": "SELECT DISTINCT ON (name) id, name FROM mailings ORDER BY name, created_at DESC;",
+        "mailing.by_run_id": "SELECT m.* FROM mailings m JOIN mailing_runs mr ON m.id = mr.mailing_id WHERE mr.id = $1;",
+        "mailing.summary_add": """
+        INSERT INTO mailing_run_summary (run_id, status, cnt)
+        SELECT * FROM unnest($1::bigint[], $2::text[], $3::bigint[])
+        ON CONFLICT (run_id, status) DO UPDATE SET cnt = mailing_run_summary.cnt + EXCLUDED.cnt;
+        """,
+        "mailing.stats": "SELECT status, cnt FROM mailing_run_summary WHERE run_id = $1;",
+    }
+
+    # Первый ключ pg_try_advisory_lock(int, int) для аренды прогонов, второй — run_id
+    RUN_LEASE_NAMESPACE = 723_190
+
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None,
+                 stats_sink: "MailingStatsSink | None" = None):
+        self.db_url = db_url
         self.pool = pool
+        self.stats_sink = stats_sink
+
+    async def maintain_partitions(self):
+        """Готовит партиции mailing_stats на будущие месяцы и удаляет вышедшие за срок хранения"""
+        async with self.pool.acquire() as conn:
+            await ensure_monthly_partitions(conn, "mailing_stats", "timestamp", date.today())
+            await drop_expired_partitions(conn, "mailing_stats", MAILING_STATS_RETENTION_MONTHS)
+
+    async def start_new_run(self, mailing_id: int, admin_id: int | None = None, mode: str = "inline",
+                            timezones: list[str] | None = None, rate: float | None = None,
+                            segment: dict | None = None) -> int:
+        """
+        mode: inline — рассылает сам процесс бота, queue — через задания для broadcast_worker.py.
+        timezones — ограничить аудиторию поясами, rate — своя скорость прогона (msg/s),
+        segment — спецификация сегмента (см. SegmentIndex).
+        """
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(
+                conn, "mailing.start_run", mailing_id, admin_id, mode, timezones, rate,
+                json.dumps(segment) if segment else None
+            )
+
+    async def get_run(self, run_id: int):
+        async with self.pool.acquire() as conn:
+            return await queries.fetchrow(conn, "mailing.get_run", run_id)
+
+    async def set_source_message(self, run_id: int, chat_id: int, message_id: int):
+        """Запоминает отрендеренное исходное сообщение прогона для copy_message"""
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "mailing.set_source", run_id, chat_id, message_id)
+
+    async def save_checkpoint(self, run_id: int, cursor: int) -> str | None:
+        """Сохраняет курсор (последний обработанный telegram_id) и возвращает состояние прогона"""
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "mailing.checkpoint", run_id, cursor)
+
+    async def set_run_state(self, run_id: int, state: str):
+        """state: running | paused | done"""
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "mailing.set_state", run_id, state)
+
+    async def pause_run(self, run_id: int) -> bool:
+        """running -> paused; False, если прогон уже на паузе или завершен"""
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "mailing.pause_run", run_id) is not None
 
-    async def create_mailing_table(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS mailings (
-                id BIGSERIAL PRIMARY KEY,
-                name TEXT NOT NULL,
-                title TEXT NOT NULL,
-                text TEXT NOT NULL,
-                media_url TEXT,
-                media_type TEXT,    
-                button_text TEXT,
-                button_link TEXT,                          
-                created_at TIMESTAMPTZ DEFAULT now()
-            );
-            CREATE TABLE IF NOT EXISTS mailing_runs (
-                id BIGSERIAL PRIMARY KEY,
-                mailing_id BIGINT REFERENCES mailings(id) ON DELETE CASCADE,
-                users_count INTEGER DEFAULT 0,
-                start_time TIMESTAMPTZ DEFAULT now()
-            );
-            CREATE TABLE IF NOT EXISTS mailing_stats (
-                id BIGSERIAL PRIMARY KEY,
-                run_id BIGINT REFERENCES mailing_runs(id) ON DELETE CASCADE,
-                telegram_id BIGINT NOT NULL,
-                status TEXT NOT NULL,
-                timestamp TIMESTAMPTZ DEFAULT now()
-            );
-            """)
-
-    async def start_new_run(self, mailing_id: int) -> int:
-        async with self.pool.acquire() as conn:
-            return await conn.fetchval("INSERT INTO mailing_runs (mailing_id) VALUES ($1) RETURNING id;", mailing_id)
+    async def resume_run(self, run_id: int) -> bool:
+        """paused -> running; False, если прогон не на паузе"""
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "mailing.resume_run", run_id) is not None
+
+    @contextlib.asynccontextmanager
+    async def run_lease(self, run_id: int):
+        """
+        Межпроцессная аренда прогона: отдает True, если ее удалось взять (прогон
+        больше никто не отправляет), иначе False. Это session-level advisory lock
+        на отдельном соединении (не из пула: держится весь прогон) — если процесс
+        упал, соединение закрывается и аренда освобождается сама.
+        """
+        conn = await asyncpg.connect(self.db_url)
+        try:
+            yield await conn.fetchval("SELECT pg_try_advisory_lock($1, $2);", self.RUN_LEASE_NAMESPACE, run_id)
+        finally:
+            # Закрытие соединения снимает и lock
+            await conn.close()
+
+    async def get_leased_runs(self, run_ids: list[int]) -> set[int]:
+        """Какие из run_ids сейчас выполняются в каком-то процессе (взята аренда)"""
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "mailing.leased_runs", self.RUN_LEASE_NAMESPACE, run_ids)
+            return {r['run_id'] for r in rows}
+
+    async def get_runs_by_state(self, *states: str):
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "mailing.runs_by_state", list(states))
+            return [dict(r) for r in rows]
 
     async def log_stat(self, run_id: int, telegram_id: int, status: str):
+        if self.stats_sink:
+            # Строка уйдет в БД пачкой через COPY; при переполненном буфере здесь будет ожидание
+            await self.stats_sink.add(run_id, telegram_id, status)
+            return
         async with self.pool.acquire() as conn:
-            await conn.execute("INSERT INTO mailing_stats (run_id, telegram_id, status) VALUES ($1, $2, $3);", run_id, telegram_id, status)
+            async with conn.transaction():
+                await queries.execute(conn, "mailing.log_stat", run_id, telegram_id, status)
+                await queries.execute(conn, "mailing.summary_add", [run_id], [status], [1])
+
+    async def flush_stats(self):
+        """Дописывает накопленную статистику (перед отчетом или в конце рассылки)"""
+        if self.stats_sink:
+            await self.stats_sink.flush()
 
     async def add_broadcast(self, name, title, text, **kwargs):
-        query = """INSERT INTO mailings (name, title, text, media_url, media_type, button_text, button_link) 
-                   VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id"""
         async with self.pool.acquire() as conn:
-            return await conn.fetchval(query, name, title, text, kwargs.get('media_url'), kwargs.get('media_type'), kwargs.get('button_text'), kwargs.get('button_link'))
+            return await queries.fetchval(conn, "mailing.add", name, title, text, kwargs.get('media_url'), kwargs.get('media_type'), kwargs.get('button_text'), kwargs.get('button_link'))
 
     async def get_all_broadcast_names(self):
-        query = "SELECT DISTINCT ON (name) id, name FROM mailings ORDER BY name, created_at DESC;"
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(query)
+            rows = await queries.fetch(conn, "mailing.names")
             return [dict(r) for r in rows]
 
     async def get_mailing_by_run_id(self, run_id: int):
-        query = "SELECT m.* FROM mailings m JOIN mailing_runs mr ON m.id = mr.mailing_id WHERE mr.id = $1;"
         async with self.pool.acquire() as conn:
-            return await conn.fetchrow(query, run_id)
+            return await queries.fetchrow(conn, "mailing.by_run_id", run_id)
 
     async def get_stats(self, run_id: int):
-        query = "SELECT status, COUNT(*) FROM mailing_stats WHERE run_id = $1 GROUP BY status;"
+        """Итоги рассылки из свертки mailing_run_summary (без GROUP BY по сырым строкам)"""
+        await self.flush_stats()
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(query, run_id)
-            return {r['status']: r['count'] for r in rows}
+            rows = await queries.fetch(conn, "mailing.stats", run_id)
+            return {r['status']: r['cnt'] for r in rows}
 
-# ------------------ QUESTS & COUNTERS ------------------
-class QuestStatusDBManager:
-    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None):
+# ------------------ SCHEDULES ------------------
+class ScheduleDBManager:
+    """Отложенные рассылки: расписания и их слоты (см. utils/scheduler.py)"""
+    QUERIES = {
+        "schedules.add": """
+        INSERT INTO mailing_schedules (mailing_id, admin_id, kind, local_time, spread_minutes)
+        VALUES ($1, $2, $3, $4, $5) RETURNING id;
+        """,
+        "schedules.add_slot": """
+        INSERT INTO mailing_schedule_slots (schedule_id, fire_at, tz_filter, audience)
+        VALUES ($1, $2, $3, $4);
+        """,
+        # SKIP LOCKED: при нескольких процессах каждый слот запускает ровно один
+        "schedules.due_slots": """
+        SELECT sl.id, sl.fire_at, sl.tz_filter, sl.audience, s.mailing_id, s.admin_id, s.spread_minutes,
+               s.kind, s.local_time, s.created_at,
+               (SELECT array_agg(fire_at ORDER BY fire_at) FROM mailing_schedule_slots
+                WHERE schedule_id = s.id) AS slot_times
+        FROM mailing_schedule_slots sl
+        JOIN mailing_schedules s ON s.id = sl.schedule_id
+        WHERE sl.run_id IS NULL AND sl.fire_at <= now() AND NOT s.cancelled
+        ORDER BY sl.fire_at
+        FOR UPDATE OF sl SKIP LOCKED;
+        """,
+        "schedules.bind_run": "UPDATE mailing_schedule_slots SET run_id = $2 WHERE id = $1;",
+        "schedules.pending": """
+        SELECT s.id, s.kind, s.spread_minutes, m.name,
+               min(sl.fire_at) AS next_fire_at, count(*) AS slots
+        FROM mailing_schedules s
+        JOIN mailings m ON m.id = s.mailing_id
+        JOIN mailing_schedule_slots sl ON sl.schedule_id = s.id AND sl.run_id IS NULL
+        WHERE NOT s.cancelled
+        GROUP BY s.id, m.name
+        ORDER BY next_fire_at;
+        """,
+        "schedules.cancel": "UPDATE mailing_schedules SET cancelled = TRUE WHERE id = $1;",
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool):
         self.pool = pool
 
-    async def create_quest_statuses_table(self):
-        query = """
-        CREATE TABLE IF NOT EXISTS user_quest_statuses (
-            id BIGSERIAL PRIMARY KEY,
-            telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
-            quest_id TEXT NOT NULL,
-            status TEXT NOT NULL,
-            updated_at TIMESTAMPTZ DEFAULT now(),
-            UNIQUE (telegram_id, quest_id)
-        );
+    async def add_schedule(self, mailing_id: int, admin_id: int | None, kind: str,
+                           slots: list[tuple[datetime, list[str] | None, int]],
+                           local_time: datetime | None = None, spread_minutes: int = 0) -> int:
+        """slots — [(fire_at, tz_filter или None для всей аудитории, размер аудитории)]"""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                schedule_id = await queries.fetchval(
+                    conn, "schedules.add", mailing_id, admin_id, kind, local_time, spread_minutes
+                )
+                # Слотов единицы-десятки (по одному на смещение UTC), пишем по одному
+                for fire_at, tz_filter, audience in slots:
+                    await queries.execute(conn, "schedules.add_slot", schedule_id, fire_at, tz_filter, audience)
+                return schedule_id
+
+    async def start_due_runs(self, mode: str, base_rate: float,
+                             resolve_local=None) -> list[tuple[int, int | None]]:
         """
+        Создает прогоны для наступивших слотов и привязывает их в одной транзакции.
+        Скорость прогона — аудитория / окно, но не выше base_rate.
+        resolve_local(slot, buckets) -> (tz_filter, audience) — пояса local-слота по текущей
+        аудитории (см. utils/scheduler.slot_zones); без него берутся сохраненные при создании.
+        Аудитория по поясам считается на том же соединении: второе соединение из пула
+        при открытой транзакции на маленьком пуле может не дождаться.
+        Возвращает [(run_id, admin_id)] для запуска.
+        """
+        started = []
+        buckets = None
         async with self.pool.acquire() as conn:
-            await conn.execute(query)
+            async with conn.transaction():
+                for slot in await queries.fetch(conn, "schedules.due_slots"):
+                    tz_filter, audience = slot['tz_filter'], slot['audience']
+                    if slot['kind'] == 'local' and resolve_local:
+                        # Один GROUP BY на вызов и только если наступил local-слот
+                        if buckets is None:
+                            rows = await queries.fetch(conn, "users.timezone_buckets")
+                            buckets = {r['timezone']: r['users'] for r in rows}
+                        tz_filter, audience = resolve_local(slot, buckets)
+                    rate = None
+                    if slot['spread_minutes'] and audience:
+                        rate = min(base_rate, max(1.0, audience / (slot['spread_minutes'] * 60)))
+                    run_id = await queries.fetchval(
+                        conn, "mailing.start_run", slot['mailing_id'], slot['admin_id'], mode,
+                        tz_filter, rate, None
+                    )
+                    await queries.execute(conn, "schedules.bind_run", slot['id'], run_id)
+                    started.append((run_id, slot['admin_id']))
+        return started
 
-    async def set_quest_status(self, telegram_id: int, quest_id: str, status: str):
+    async def get_pending(self):
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "schedules.pending")
+            return [dict(r) for r in rows]
+
+    async def cancel(self, schedule_id: int):
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "schedules.cancel", schedule_id)
+
+
+# ------------------ BROADCAST JOBS ------------------
+class BroadcastJobsDBManager:
+    """
+    Очередь заданий рассылки в Postgres. Задание — отсортированный чанк
+    получателей одного прогона. Воркеры забирают задания через
+    FOR UPDATE SKIP LOCKED, поэтому их можно запускать сколько угодно.
+    """
+    QUERIES = {
+        "jobs.add": "INSERT INTO broadcast_jobs (run_id, recipient_ids) VALUES ($1, $2);",
+        "jobs.plan_cursor": "UPDATE mailing_runs SET cursor = $2, updated_at = now() WHERE id = $1;",
+        "jobs.mark_planned": "UPDATE mailing_runs SET planned = TRUE, updated_at = now() WHERE id = $1;",
+        # Берем только задания прогонов в состоянии running: пауза просто перестает их выдавать
+        "jobs.claim": """
+        UPDATE broadcast_jobs j
+        SET state = 'claimed', claimed_by = $1, claimed_at = now(), attempts = j.attempts + 1
+        WHERE j.id = (
+            SELECT bj.id FROM broadcast_jobs bj
+            JOIN mailing_runs mr ON mr.id = bj.run_id
+            WHERE bj.state = 'pending' AND mr.state = 'running'
+            ORDER BY bj.id
+            LIMIT 1
+            FOR UPDATE OF bj SKIP LOCKED
+        )
+        RETURNING j.id, j.run_id, j.recipient_ids, j.cursor, j.attempts;
+        """,
+        # Курсор задания заодно служит heartbeat'ом; возвращаем состояние прогона для паузы
+        "jobs.checkpoint": """
+        UPDATE broadcast_jobs SET cursor = $2, claimed_at = now()
+        WHERE id = $1
+        RETURNING (SELECT state FROM mailing_runs WHERE id = broadcast_jobs.run_id);
+        """,
+        "jobs.complete": "UPDATE broadcast_jobs SET state = 'done' WHERE id = $1;",
+        "jobs.release": """
+        UPDATE broadcast_jobs
+        SET state = CASE WHEN attempts >= $2 THEN 'failed' ELSE 'pending' END, claimed_by = NULL
+        WHERE id = $1;
+        """,
+        # Пауза или штатная остановка воркера — не сбой: возвращаем попытку, взятую в jobs.claim
+        "jobs.yield": """
+        UPDATE broadcast_jobs
+        SET state = 'pending', claimed_by = NULL, attempts = GREATEST(attempts - 1, 0)
+        WHERE id = $1;
+        """,
+        "jobs.reclaim_stale": """
+        UPDATE broadcast_jobs
+        SET state = CASE WHEN attempts >= $2 THEN 'failed' ELSE 'pending' END, claimed_by = NULL
+        WHERE state = 'claimed' AND claimed_at < now() - make_interval(secs => $1)
+        RETURNING id;
+        """,
+        "jobs.run_workers": "SELECT count(DISTINCT claimed_by) FROM broadcast_jobs WHERE run_id = $1 AND state = 'claimed';",
+        # Ровно один воркер закрывает прогон: тот, чей UPDATE увидел последнее задание готовым
+        "jobs.finish_run": """
+        UPDATE mailing_runs
+        SET state = 'done', finished_at = now(), updated_at = now()
+        WHERE id = $1 AND state = 'running' AND planned
+          AND NOT EXISTS (
+              SELECT 1 FROM broadcast_jobs
+              WHERE run_id = $1 AND state IN ('pending', 'claimed')
+          )
+        RETURNING admin_id;
+        """,
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool, max_attempts: int = 3):
+        self.pool = pool
+        self.max_attempts = max_attempts
+
+    async def plan_run(self, run_id: int, user_id_chunks):
         """
-        Устанавливает статус квеста в правильную таблицу: user_quest_statuses
+        Раскладывает аудиторию по заданиям. Каждое задание пишется в одной
+        транзакции с курсором раскладки, поэтому после рестарта планирование
+        продолжается без дублей.
         """
-        query = """
+        async for chunk in user_id_chunks:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await queries.execute(conn, "jobs.add", run_id, chunk)
+                    await queries.execute(conn, "jobs.plan_cursor", run_id, chunk[-1])
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "jobs.mark_planned", run_id)
+
+    async def claim(self, worker_id: str):
+        async with self.pool.acquire() as conn:
+            row = await queries.fetchrow(conn, "jobs.claim", worker_id)
+            return dict(row) if row else None
+
+    async def checkpoint(self, job_id: int, cursor: int) -> str | None:
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "jobs.checkpoint", job_id, cursor)
+
+    async def complete(self, job_id: int):
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "jobs.complete", job_id)
+
+    async def release(self, job_id: int):
+        """Возвращает задание в очередь после сбоя; после max_attempts — failed"""
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "jobs.release", job_id, self.max_attempts)
+
+    async def yield_job(self, job_id: int):
+        """Возвращает задание в очередь на паузе или остановке воркера, попытка не засчитывается"""
+        async with self.pool.acquire() as conn:
+            await queries.execute(conn, "jobs.yield", job_id)
+
+    async def reclaim_stale(self, stale_after: float) -> int:
+        """Возвращает в очередь задания воркеров, которые пропали без чекпоинта дольше stale_after секунд"""
+        async with self.pool.acquire() as conn:
+            rows = await queries.fetch(conn, "jobs.reclaim_stale", float(stale_after), self.max_attempts)
+            return len(rows)
+
+    async def count_run_workers(self, run_id: int) -> int:
+        """Сколько воркеров сейчас держат задания прогона (делят между собой его скорость)"""
+        async with self.pool.acquire() as conn:
+            return await queries.fetchval(conn, "jobs.run_workers", run_id)
+
+    async def finish_run(self, run_id: int) -> tuple[bool, int | None]:
+        """Закрывает прогон, если заданий не осталось. Возвращает (закрыт, admin_id)"""
+        async with self.pool.acquire() as conn:
+            row = await queries.fetchrow(conn, "jobs.finish_run", run_id)
+            return (row is not None, row['admin_id'] if row else None)
+
+
+# ------------------ QUESTS & COUNTERS ------------------
+class QuestStatusDBManager:
+    QUERIES = {
+        "quests.set_status": """
         INSERT INTO user_quest_statuses (telegram_id, quest_id, status)
         VALUES ($1, $2, $3)
-        ON CONFLICT (telegram_id, quest_id) 
+        ON CONFLICT (telegram_id, quest_id)
         DO UPDATE SET status = EXCLUDED.status, updated_at = now();
+        """,
+        "quests.user_statuses": "SELECT quest_id, status FROM user_quest_statuses WHERE telegram_id = $1",
+    }
+
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None,
+                 snapshot_cache: SnapshotCache | None = None):
+        self.pool = pool
+        self.snapshot_cache = snapshot_cache
+
+    async def set_quest_status(self, telegram_id: int, quest_id: str, status: str):
+        """
+        Устанавливает статус квеста в правильную таблицу: user_quest_statuses
         """
         async with self.pool.acquire() as conn:
-            await conn.execute(query, telegram_id, quest_id, status)
+            await queries.execute(conn, "quests.set_status", telegram_id, quest_id, status)
+        if self.snapshot_cache:
+            self.snapshot_cache.invalidate(telegram_id)
 
     async def get_user_quest_statuses(self, telegram_id: int):
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT quest_id, status FROM user_quest_statuses WHERE telegram_id = $1", telegram_id)
+            rows = await queries.fetch(conn, "quests.user_statuses", telegram_id)
             return [dict(r) for r in rows]
 
 class CountersDBManager:
-    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None):
-        self.pool = pool
+    QUERIES = {
+        "counters.increment": """
+        INSERT INTO user_counters (telegram_id, counter_key, value) VALUES ($1, $2, $3)
+        ON CONFLICT (telegram_id, counter_key) DO UPDATE SET value = user_counters.value + $3 RETURNING value;
+        """,
+        "counters.get": "SELECT value FROM user_counters WHERE telegram_id = $1 AND counter_key = $2",
+    }
 
-    async def create_user_counters_table(self):
-        query = """
-        CREATE TABLE IF NOT EXISTS user_counters (
-            id BIGSERIAL PRIMARY KEY,
-            telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
-            counter_key TEXT NOT NULL,
-            value INTEGER DEFAULT 0,
-            updated_at TIMESTAMPTZ DEFAULT now(),
-            UNIQUE (telegram_id, counter_key)
-        );
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(query)
+    def __init__(self, db_url: str, pool: asyncpg.pool.Pool | None = None,
+                 counter_buffer: "CounterBuffer | None" = None):
+        self.pool = pool
+        self.counter_buffer = counter_buffer
 
     async def increment_counter(self, telegram_id: int, counter_key: str, increment: int = 1):
-        query = """
-        INSERT INTO user_counters (telegram_id, counter_key, value) VALUES ($1, $2, $3)
-        ON CONFLICT (telegram_id, counter_key) DO UPDATE SET value = user_counters.value + $3 RETURNING value;
-        """
+        if self.counter_buffer:
+            return await self.counter_buffer.increment_counter(telegram_id, counter_key, increment)
         async with self.pool.acquire() as conn:
-            return await conn.fetchval(query, telegram_id, counter_key, increment)
+            return await queries.fetchval(conn, "counters.increment", telegram_id, counter_key, increment)
 
     async def get_counter(self, telegram_id: int, counter_key: str):
+        if self.counter_buffer:
+            # Значение с учетом еще не сброшенных дельт
+            return await self.counter_buffer.get_counter(telegram_id, counter_key)
         async with self.pool.acquire() as conn:
-            return await conn.fetchval("SELECT value FROM user_counters WHERE telegram_id = $1 AND counter_key = $2", telegram_id, counter_key) or 0
+            return await queries.fetchval(conn, "counters.get", telegram_id, counter_key) or 0
 
 # ------------------ DAILY STATISTICS ------------------
 class DailyStatsManager:
@@ -313,6 +1909,8 @@ class DailyStatsManager:
 
     async def collect_and_save(self):
         today = date.today()
+        # Сначала дописываем отложенные просмотры, иначе SUM(watched) отстанет
+        await self.db.counter_buffer.flush()
         async with self.db.pool.acquire() as conn:
             new_users = await conn.fetchval("SELECT COUNT(*) FROM tg_users WHERE created_at::date = $1", today)
             watched = await conn.fetchval("SELECT SUM(watched) FROM videos") or 0
@@ -333,53 +1931,353 @@ class DailyStatsManager:
 
 # ------------------ CPA & POSTBACKS ------------------
 class CpaDBManager:
+    QUERIES = {
+        "cpa.register_click": """
+        INSERT INTO cpa_clicks (click_id, telegram_id, offer_name)
+        VALUES ($1, $2, $3);
+        """,
+        "cpa.update_click_status": """
+        UPDATE cpa_clicks
+        SET status = $1, amount = amount + $2, updated_at = now()
+        WHERE click_id = $3
+        RETURNING telegram_id;
+        """,
+    }
+
     def __init__(self, pool: asyncpg.pool.Pool):
         self.pool = pool
 
-    async def create_cpa_table(self):
-        """Создает таблицу для фиксации кликов и постбеков"""
-        query = """
-        CREATE TABLE IF NOT EXISTS cpa_clicks (
-            id BIGSERIAL PRIMARY KEY,
-            click_id TEXT UNIQUE NOT NULL,
-            telegram_id BIGINT REFERENCES tg_users(telegram_id) ON DELETE CASCADE,
-            offer_name TEXT NOT NULL,
-            status TEXT DEFAULT 'click', -- click, registration, deposit
-            amount NUMERIC(18,2) DEFAULT 0,
-            created_at TIMESTAMPTZ DEFAULT now(),
-            updated_at TIMESTAMPTZ DEFAULT now()
-        );
-        """
-        async with self.pool.acquire() as conn:
-            await conn.execute(query)
-
     async def register_click(self, click_id: str, telegram_id: int, offer_name: str):
         """Регистрирует новый переход по ссылке"""
-        query = """
-        INSERT INTO cpa_clicks (click_id, telegram_id, offer_name)
-        VALUES ($1, $2, $3);
-        """
         async with self.pool.acquire() as conn:
-            await conn.execute(query, click_id, telegram_id, offer_name)
+            await queries.execute(conn, "cpa.register_click", click_id, telegram_id, offer_name)
 
     async def update_click_status(self, click_id: str, status: str, amount: float = 0):
         """
         Обновляет статус клика при получении постбека.
         Возвращает telegram_id пользователя, чтобы начислить ему баланс.
         """
-        query = """
-        UPDATE cpa_clicks 
-        SET status = $1, amount = amount + $2, updated_at = now()
-        WHERE click_id = $3
-        RETURNING telegram_id;
-        """
         async with self.pool.acquire() as conn:
-            return await conn.fetchval(query, status, amount, click_id)
+            return await queries.fetchval(conn, "cpa.update_click_status", status, amount, click_id)
+
+# ------------------ WRITE-BEHIND BUFFERS ------------------
+# Базовый класс — utils/write_behind.WriteBehindBuffer (без зависимостей от db.py)
+class CounterBuffer(WriteBehindBuffer):
+    """
+    Агрегатор счетчиков для горячего пути /api/video/watched.
+    Дельты videos.watched и user_counters копятся в памяти и уходят в БД
+    пачкой (одно UPDATE ... FROM unnest и один INSERT ... ON CONFLICT на сброс).
+    Для счетчиков пользователей храним последнее известное значение из БД,
+    поэтому чтения возвращают base + несброшенные дельты без запроса в БД.
+    """
+    QUERIES = {
+        "counters.flush_videos": """
+        UPDATE videos v SET watched = v.watched + d.delta
+        FROM unnest($1::bigint[], $2::int[]) AS d(id, delta)
+        WHERE v.id = d.id;
+        """,
+        # JOIN с tg_users отбрасывает неизвестных юзеров, чтобы одна битая дельта не блокировала всю пачку
+        "counters.flush_counters": """
+        INSERT INTO user_counters (telegram_id, counter_key, value)
+        SELECT d.telegram_id, d.counter_key, d.delta
+        FROM unnest($1::bigint[], $2::text[], $3::int[]) AS d(telegram_id, counter_key, delta)
+        JOIN tg_users u ON u.telegram_id = d.telegram_id
+        ON CONFLICT (telegram_id, counter_key) DO UPDATE
+        SET value = user_counters.value + EXCLUDED.value, updated_at = now();
+        """,
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool, flush_interval: float = 1.0,
+                 max_pending: int = 1000, cache_size: int = 50000,
+                 snapshot_cache: SnapshotCache | None = None):
+        super().__init__(pool, flush_interval, max_pending)
+        self.cache_size = cache_size
+        self.snapshot_cache = snapshot_cache
+        self._videos: dict[int, int] = {}
+        self._counters: dict[tuple[int, str], int] = {}
+        self._inflight_videos: dict[int, int] = {}
+        self._inflight_counters: dict[tuple[int, str], int] = {}
+        # Последние известные значения счетчиков в БД (LRU)
+        self._base: OrderedDict[tuple[int, str], int] = OrderedDict()
+
+    def add_video_view(self, video_id: int, increment: int = 1):
+        self._videos[video_id] = self._videos.get(video_id, 0) + increment
+        self._maybe_flush()
+
+    def pending_watched(self, video_id: int | None = None) -> int:
+        """Несброшенные просмотры одного видео или всех сразу"""
+        if video_id is None:
+            return sum(self._videos.values()) + sum(self._inflight_videos.values())
+        return self._videos.get(video_id, 0) + self._inflight_videos.get(video_id, 0)
+
+    def _pending_delta(self, key: tuple[int, str]) -> int:
+        return self._counters.get(key, 0) + self._inflight_counters.get(key, 0)
+
+    async def _get_base(self, key: tuple[int, str]) -> int:
+        if key in self._base:
+            self._base.move_to_end(key)
+            return self._base[key]
+        async with self.pool.acquire() as conn:
+            value = await queries.fetchval(conn, "counters.get", *key) or 0
+        # Пока ждали БД, значение мог закешировать параллельный запрос — оно свежее
+        if key not in self._base:
+            self._base[key] = value
+            self._evict()
+        return self._base[key]
+
+    def _evict(self):
+        while len(self._base) > self.cache_size:
+            key = next(iter(self._base))
+            if self._pending_delta(key):
+                # Ключи с несброшенными дельтами не выбрасываем, дождемся сброса
+                self._base.move_to_end(key)
+                break
+            del self._base[key]
+
+    async def increment_counter(self, telegram_id: int, counter_key: str, increment: int = 1) -> int:
+        key = (telegram_id, counter_key)
+        base = await self._get_base(key)
+        self._counters[key] = self._counters.get(key, 0) + increment
+        if self.snapshot_cache:
+            self.snapshot_cache.invalidate(telegram_id)
+        self._maybe_flush()
+        return base + self._pending_delta(key)
+
+    def merge_counters(self, telegram_id: int, counters: dict[str, int]) -> dict[str, int]:
+        """Дополняет значения счетчиков из БД несброшенными дельтами"""
+        merged = dict(counters)
+        for key in set(self._counters) | set(self._inflight_counters):
+            if key[0] != telegram_id:
+                continue
+            if key in self._base:
+                merged[key[1]] = self._base[key] + self._pending_delta(key)
+            else:
+                merged[key[1]] = merged.get(key[1], 0) + self._pending_delta(key)
+        return merged
+
+    async def get_counter(self, telegram_id: int, counter_key: str) -> int:
+        key = (telegram_id, counter_key)
+        base = await self._get_base(key)
+        return base + self._pending_delta(key)
+
+    def _pending_count(self) -> int:
+        return len(self._videos) + len(self._counters)
+
+    def _take_pending(self):
+        self._inflight_videos, self._videos = self._videos, {}
+        self._inflight_counters, self._counters = self._counters, {}
+        return self._inflight_videos, self._inflight_counters
+
+    async def _write(self, conn, batch):
+        videos, counters = batch
+        if videos:
+            await queries.execute(conn, "counters.flush_videos", list(videos.keys()), list(videos.values()))
+        if counters:
+            await queries.execute(
+                conn, "counters.flush_counters",
+                [k[0] for k in counters], [k[1] for k in counters], list(counters.values())
+            )
+
+    def _on_flushed(self, batch):
+        _, counters = batch
+        for key, delta in counters.items():
+            if key in self._base:
+                self._base[key] += delta
+        self._inflight_videos, self._inflight_counters = {}, {}
+
+    def _restore(self, batch):
+        videos, counters = batch
+        for video_id, delta in videos.items():
+            self._videos[video_id] = self._videos.get(video_id, 0) + delta
+        for key, delta in counters.items():
+            self._counters[key] = self._counters.get(key, 0) + delta
+        self._inflight_videos, self._inflight_counters = {}, {}
+
+class MailingStatsSink(WriteBehindBuffer):
+    """
+    Буфер статистики рассылок. Копит кортежи (run_id, telegram_id, status) и
+    пишет их через COPY (copy_records_to_table) пачками по batch_size строк.
+    Фоновый сброс стартует при batch_size строк; если в памяти набралось
+    max_buffer строк, add() ждет завершения фонового сброса — так рассылка не
+    обгоняет БД, а ошибки БД не долетают до отправителя.
+    Если пачку отвергли сами данные (например, FK после удаления прогона), она
+    пишется по прогонам, битая часть делится пополам до строк, которые уходят
+    в лог (dead letter) — одна плохая строка не держит весь буфер.
+    """
+    COLUMNS = ("run_id", "telegram_id", "status")
+    # Ошибки самих строк: повтор той же пачки их не исправит
+    BAD_ROWS_ERRORS = (asyncpg.exceptions.IntegrityConstraintViolationError, asyncpg.exceptions.DataError)
+
+    def __init__(self, pool: asyncpg.pool.Pool, flush_interval: float = 2.0,
+                 batch_size: int = 5000, max_buffer: int = 50000):
+        super().__init__(pool, flush_interval, max_pending=batch_size)
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self._rows: list[tuple[int, int, str]] = []
+
+    async def add(self, run_id: int, telegram_id: int, status: str):
+        self._rows.append((run_id, telegram_id, status))
+        self._maybe_flush()
+        if len(self._rows) >= self.max_buffer:
+            # shield: пауза рассылки отменяет отправителя, но не начатый сброс
+            if not await asyncio.shield(self._flush_task):
+                # Сброс не удался (БД недоступна) — притормаживаем отправку до следующей попытки
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._rows:
+                return
+            batch = self._take_pending()
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self._write(conn, batch)
+            except self.BAD_ROWS_ERRORS as e:
+                logger.warning(f"MailingStatsSink: пачка из {len(batch)} строк отвергнута ({e}), пишем по частям")
+                await self._write_isolated(batch)
+            except BaseException:
+                self._restore(batch)
+                raise
+
+    async def _write_isolated(self, batch: list[tuple[int, int, str]]):
+        """Пишет пачку по прогонам; отвергнутые части делит пополам, одиночные строки — в лог"""
+        by_run: dict[int, list] = {}
+        for row in batch:
+            by_run.setdefault(row[0], []).append(row)
+        # (строки, целый прогон?)
+        parts = [(rows, True) for rows in by_run.values()]
+        while parts:
+            rows, whole_run = parts.pop()
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self._write(conn, rows)
+            except self.BAD_ROWS_ERRORS as e:
+                if len(rows) == 1 or (whole_run and not await self._run_exists(rows[0][0])):
+                    logger.error(f"MailingStatsSink: отброшено {len(rows)} строк прогона #{rows[0][0]}: {e}; "
+                                 f"первая: {rows[0]}")
+                    continue
+                mid = len(rows) // 2
+                parts += [(rows[:mid], False), (rows[mid:], False)]
+            except BaseException:
+                # БД недоступна — все, что не записано, возвращаем в буфер
+                self._restore(rows + [row for part, _ in parts for row in part])
+                raise
+
+    async def _run_exists(self, run_id: int | None) -> bool:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT EXISTS (SELECT 1 FROM mailing_runs WHERE id = $1);", run_id)
+
+    def _pending_count(self) -> int:
+        return len(self._rows)
+
+    def _take_pending(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    async def _write(self, conn, batch):
+        for start in range(0, len(batch), self.batch_size):
+            await conn.copy_records_to_table(
+                "mailing_stats", records=batch[start:start + self.batch_size], columns=self.COLUMNS
+            )
+        # Свертку обновляем в той же транзакции, что и сырые строки
+        summary: dict[tuple[int, str], int] = {}
+        for run_id, _, status in batch:
+            summary[(run_id, status)] = summary.get((run_id, status), 0) + 1
+        await queries.execute(
+            conn, "mailing.summary_add",
+            [k[0] for k in summary], [k[1] for k in summary], list(summary.values())
+        )
+
+    def _restore(self, batch):
+        self._rows[:0] = batch
+
+class UserEventsBuffer(WriteBehindBuffer):
+    """Буфер событий пользователей: копит (telegram_id, event) и пишет их в user_events через COPY"""
+    COLUMNS = ("telegram_id", "event")
+
+    def __init__(self, pool: asyncpg.pool.Pool, flush_interval: float = 2.0, max_pending: int = 5000):
+        super().__init__(pool, flush_interval, max_pending)
+        self._rows: list[tuple[int, str]] = []
+
+    def add(self, telegram_id: int, event_data: dict):
+        self._rows.append((telegram_id, json.dumps(event_data)))
+        self._maybe_flush()
+
+    def _pending_count(self) -> int:
+        return len(self._rows)
+
+    def _take_pending(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    async def _write(self, conn, batch):
+        await conn.copy_records_to_table("user_events", records=batch, columns=self.COLUMNS)
+
+    def _restore(self, batch):
+        self._rows[:0] = batch
+
+class UserStatusBuffer(WriteBehindBuffer):
+    """
+    Буфер отметок is_alive = FALSE с моментом события: сброс — один UPDATE на пачку.
+    Первая рассылка после долгого перерыва ловит десятки тысяч 403 подряд.
+    «Ожил» (/start, разблокировка) пишется сразу мимо буфера, в том числе из других
+    процессов, поэтому отметка применяется, только если она новее alive_changed_at.
+    Момент отметки — по часам БД, как и now() у «ожил»: в буфере хранится
+    time.monotonic(), при сбросе он превращается в clock_timestamp() минус возраст.
+    """
+    QUERIES = {
+        # Уже помеченных не трогаем, чтобы не плодить новые версии строк
+        "users.mark_dead_bulk": """
+        UPDATE tg_users u SET is_alive = FALSE, alive_changed_at = t.at
+        FROM (
+            SELECT telegram_id, clock_timestamp() - make_interval(secs => age) AS at
+            FROM unnest($1::bigint[], $2::float8[]) AS a(telegram_id, age)
+        ) t
+        WHERE u.telegram_id = t.telegram_id AND u.is_alive IS DISTINCT FROM FALSE
+          AND (u.alive_changed_at IS NULL OR u.alive_changed_at < t.at);
+        """,
+    }
+
+    def __init__(self, pool: asyncpg.pool.Pool, flush_interval: float = 2.0, max_pending: int = 5000):
+        super().__init__(pool, flush_interval, max_pending)
+        self._statuses: dict[int, float] = {}  # telegram_id -> time.monotonic() отметки
+
+    def add(self, telegram_id: int):
+        self._statuses[telegram_id] = time.monotonic()
+        self._maybe_flush()
+
+    def discard(self, telegram_id: int):
+        """Отменяет несброшенный статус (юзер вернулся раньше, чем буфер ушел в БД)"""
+        self._statuses.pop(telegram_id, None)
+
+    def _pending_count(self) -> int:
+        return len(self._statuses)
+
+    def _take_pending(self):
+        statuses, self._statuses = self._statuses, {}
+        return statuses
+
+    async def _write(self, conn, batch):
+        now = time.monotonic()
+        await queries.execute(conn, "users.mark_dead_bulk", list(batch), [now - at for at in batch.values()])
+
+    def _restore(self, batch):
+        # Отметки, поставленные во время неудачного сброса, новее — их не трогаем
+        for telegram_id, at in batch.items():
+            self._statuses.setdefault(telegram_id, at)
 
 # ------------------ DATABASE MANAGER ------------------
 class DatabaseManager:
-    def __init__(self, db_url: str):
+    def __init__(self, db_url: str, pool_max_size: int = 10):
         self.db_url = db_url
+        # Под супервизором (serve.py) — доля общего бюджета DB_POOL_BUDGET на воркер
+        self.pool_max_size = pool_max_size
+        # Несколько процессов на одной БД (serve.py): кеши в памяти процесса
+        # не видят чужих записей, поэтому снимки не кешируются, а счетчики
+        # пользователей пишутся сразу (просмотры видео по-прежнему копятся)
+        self.multi_process = False
         self.pool = None
         self.users_db = None
         self.videos_db = None
@@ -388,38 +2286,114 @@ class DatabaseManager:
         self.counters_db = None
         self.daily_stats = None
         self.cpa_db = None
+        self.jobs_db = None
+        self.schedules_db = None
+        self.counter_buffer = None
+        self.mailing_stats_sink = None
+        self.user_events_buffer = None
+        self.user_status_buffer = None
+        self.video_catalog = None
+        self.segments = None
+        self.queries = queries
+        self.snapshot_cache = SnapshotCache()
+        self._maintenance_task = None
 
     async def connect(self):
         if not self.pool:
-            self.pool = await asyncpg.create_pool(self.db_url, min_size=1, max_size=10)
-        self.users_db = UsersDBManager(self.db_url, self.pool)
-        self.videos_db = VideosDBManager(self.db_url, self.pool)
-        self.mailing_db = MailingDBManager(self.db_url, self.pool)
-        self.quests_db = QuestStatusDBManager(self.db_url, self.pool)
-        self.counters_db = CountersDBManager(self.db_url, self.pool)
+            # init готовит все зарегистрированные запросы на каждом новом соединении пула
+            self.pool = await asyncpg.create_pool(self.db_url, min_size=1, max_size=self.pool_max_size,
+                                                  connection_class=RegistryConnection,
+                                                  init=queries.init_connection)
+        if self.multi_process:
+            self.snapshot_cache = None
+        if not self.counter_buffer:
+            self.counter_buffer = CounterBuffer(self.pool, snapshot_cache=self.snapshot_cache)
+            self.counter_buffer.start()
+        if not self.mailing_stats_sink:
+            self.mailing_stats_sink = MailingStatsSink(self.pool)
+            self.mailing_stats_sink.start()
+        if not self.user_events_buffer:
+            self.user_events_buffer = UserEventsBuffer(self.pool)
+            self.user_events_buffer.start()
+        if not self.user_status_buffer:
+            self.user_status_buffer = UserStatusBuffer(self.pool)
+            self.user_status_buffer.start()
+        if not self.video_catalog:
+            self.video_catalog = VideoCatalog(self.db_url, self.pool)
+        if not self.segments:
+            self.segments = SegmentIndex(self.pool)
+        # Счетчики пользователей в буфере — base из кеша процесса + несброшенные дельты
+        user_counters = None if self.multi_process else self.counter_buffer
+        self.users_db = UsersDBManager(self.db_url, self.pool, events_buffer=self.user_events_buffer,
+                                       snapshot_cache=self.snapshot_cache, counter_buffer=user_counters,
+                                       status_buffer=self.user_status_buffer)
+        self.videos_db = VideosDBManager(self.db_url, self.pool, counter_buffer=self.counter_buffer,
+                                         catalog=self.video_catalog)
+        self.mailing_db = MailingDBManager(self.db_url, self.pool, stats_sink=self.mailing_stats_sink)
+        self.quests_db = QuestStatusDBManager(self.db_url, self.pool, snapshot_cache=self.snapshot_cache)
+        self.counters_db = CountersDBManager(self.db_url, self.pool, counter_buffer=user_counters)
         self.daily_stats = DailyStatsManager(self)
         self.cpa_db = CpaDBManager(self.pool)
+        self.jobs_db = BroadcastJobsDBManager(self.pool)
+        self.schedules_db = ScheduleDBManager(self.pool)
 
-    async def setup(self):
+    async def setup(self, primary: bool = True):
+        """primary=False — дополнительный воркер: без миграций и фонового обслуживания"""
         await self.connect()
-        await self.users_db.create_users_table()
-        await self.videos_db.create_videos_table()
-        await self.mailing_db.create_mailing_table()
-        await self.quests_db.create_quest_statuses_table()
-        await self.counters_db.create_user_counters_table()
-        # Таблица статистики
-        async with self.pool.acquire() as conn:
-            await conn.execute("""CREATE TABLE IF NOT EXISTS daily_statistics (
-                stat_date DATE PRIMARY KEY, new_users BIGINT DEFAULT 0, videos_watched BIGINT DEFAULT 0,
-                total_balance NUMERIC(18,2) DEFAULT 0, quests_done BIGINT DEFAULT 0, cash_outs BIGINT DEFAULT 0
-            );""")
+        if primary:
+            # Схема: только недостающие миграции, на теплом старте — один SELECT
+            await MigrationRunner(self.pool).run()
+            await self.run_maintenance()
+        # Каталог видео в памяти: первая загрузка сразу, дальше по NOTIFY
+        await self.video_catalog.reload()
+        self.video_catalog.start()
+        # Битмапы сегментов не строим заранее: под serve.py каждый воркер держал бы
+        # свою полную копию. Сборка стартует при первом обращении (SegmentIndex.ready)
+        if primary and not self._maintenance_task:
+            self._maintenance_task = asyncio.create_task(self._maintenance_loop())
 
-    async def get_all_user_ids(self) -> list[int]:
+    async def run_maintenance(self):
+        """Периодическое обслуживание: партиции и срок хранения статистики"""
+        await self.mailing_db.maintain_partitions()
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT telegram_id FROM tg_users WHERE is_alive = TRUE;")
-            return [row['telegram_id'] for row in rows]
+            await ensure_monthly_partitions(conn, "user_events", "created_at", date.today())
+
+    async def _maintenance_loop(self, interval: float = 6 * 3600):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_maintenance()
+            except Exception:
+                logger.exception("Ошибка обслуживания БД")
+
+    async def get_all_user_ids(self) -> list[int]:
+        return await self.users_db.get_all_alive_user_ids()
+
+    async def close_buffers(self):
+        """Сбрасывает в БД все отложенные записи (вызывается при остановке)"""
+        if self.counter_buffer:
+            await self.counter_buffer.close()
+        if self.mailing_stats_sink:
+            await self.mailing_stats_sink.close()
+        if self.user_events_buffer:
+            await self.user_events_buffer.close()
+        if self.user_status_buffer:
+            await self.user_status_buffer.close()
 
     async def close(self):
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        await self.close_buffers()
+        if self.video_catalog:
+            await self.video_catalog.stop()
+        if self.segments:
+            await self.segments.stop()
         if self.pool: await self.pool.close()
 
+for _manager in (UsersDBManager, VideosDBManager, MailingDBManager, QuestStatusDBManager,
+                 CountersDBManager, CpaDBManager, ScheduleDBManager, BroadcastJobsDBManager,
+                 CounterBuffer, UserStatusBuffer, VideoCatalog, SegmentIndex):
+    queries.register(_manager.QUERIES)
+
 db_manager = DatabaseManager(DB_URL)
\ No newline at end of file
@@ -0,0 +1,141 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных тестов рассылки и вебхука.
+Отвечает на /bot{token}/{method} в формате Bot API и имитирует задержку,
+flood limit (429), заблокировавших бота (403) и прочие ошибки (400):
+
+    python fake_bot_api.py --port 8081 --latency 40 --jitter 20 --p429 0.001 --p403 0.05 --p400 0.002
+
+Бот направляется сюда через TelegramAPIServer.from_base("http://127.0.0.1:8081")
+(см. bench_broadcast.py). Счетчики запросов — GET /stats, сброс — POST /stats/reset.
+"""
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import Counter
+from aiohttp import web
+
+SEND_METHODS = {"sendmessage", "sendphoto", "sendvideo", "sendanimation", "senddocument"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 30.0, jitter_ms: float = 10.0, p429: float = 0.0,
+                 p403: float = 0.0, p400: float = 0.0, retry_after: int = 1, limit: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.p429 = p429
+        self.p403 = p403
+        self.p400 = p400
+        self.retry_after = retry_after
+        # Жесткий лимит сообщений в секунду, как у Telegram; 0 — без лимита
+        self.limit = limit
+        self.stats = Counter()
+        self._message_ids = itertools.count(1)
+        self._window_started = time.monotonic()
+        self._window_count = 0
+
+    def is_blocked(self, chat_id: int) -> bool:
+        # Детерминированно по chat_id: повторная отправка тому же юзеру снова даст 403
+        return (chat_id * 2654435761) % 10000 < self.p403 * 10000
+
+    def over_limit(self) -> bool:
+        if not self.limit:
+            return False
+        now = time.monotonic()
+        if now - self._window_started >= 1.0:
+            self._window_started = now
+            self._window_count = 0
+        self._window_count += 1
+        return self._window_count > self.limit
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def error(code: int, description: str, **parameters):
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    async def read_params(self, request: web.Request) -> dict:
+        # aiogram шлет multipart/form-data, curl и прочие — JSON или urlencoded
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    def message(self, chat_id: int, text: str | None = None) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text or "",
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        params = await self.read_params(request)
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+        if method == "getme":
+            return self.ok({"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"})
+        if method in ("setwebhook", "deletewebhook", "answercallbackquery"):
+            return self.ok(True)
+
+        chat_id = int(params.get("chat_id") or 0)
+        if method in SEND_METHODS or method in ("copymessage", "editmessagetext"):
+            if self.over_limit() or random.random() < self.p429:
+                self.stats[f"{method}:429"] += 1
+                return self.error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                  retry_after=self.retry_after)
+            if method != "editmessagetext" and self.is_blocked(chat_id):
+                self.stats[f"{method}:403"] += 1
+                return self.error(403, "Forbidden: bot was blocked by the user")
+            if random.random() < self.p400:
+                self.stats[f"{method}:400"] += 1
+                return self.error(400, "Bad Request: chat not found")
+            self.stats[f"{method}:200"] += 1
+            if method == "copymessage":
+                return self.ok({"message_id": next(self._message_ids)})
+            return self.ok(self.message(chat_id, params.get("text") or params.get("caption")))
+
+        self.stats[f"{method}:200"] += 1
+        return self.ok(True)
+
+    async def get_stats(self, request: web.Request):
+        return web.json_response(dict(self.stats))
+
+    async def reset_stats(self, request: web.Request):
+        self.stats.clear()
+        return web.json_response({"ok": True})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_post("/stats/reset", self.reset_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=30.0, help="средняя задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=10.0, help="разброс задержки, мс")
+    parser.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--p403", type=float, default=0.0, help="доля заблокировавших бота")
+    parser.add_argument("--p400", type=float, default=0.0, help="доля ответов 400")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--limit", type=float, default=0.0, help="лимит сообщений в секунду (429 сверх него)")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(args.latency, args.jitter, args.p429, args.p403, args.p400, args.retry_after, args.limit)
+    web.run_app(api.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from utils.fsm_storage import PgStorage
 from aiogram.types import (
     KeyboardButton, 
     ReplyKeyboardMarkup, 
@@ -108,9 +108,9 @@ class DB:
         )
 
 db = DB()
-# Инициализация с MemoryStorage, чтобы состояния не терялись
+# Черновики заявок и ответы админа переживают рестарт: состояния FSM в Postgres
 bot = Bot(token=FAQ_BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=PgStorage())
 
 # --- Клавиатуры ---
 def kb_open(lang: str):
@@ -267,7 +267,12 @@ async def adm_send_final(message: types.Message, state: FSMContext):
 
 async def main():
     await db.connect()
-    await dp.start_polling(bot)
+    # Миграции основного приложения здесь не запускаются — таблицу создаем сами
+    await dp.storage.attach(db.pool, DATABASE_DSN, create_table=True)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await dp.storage.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,24 +1,32 @@
+import time
 import logging
 from aiogram import Router, F, types
 import asyncio
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from aiogram.filters import Command, StateFilter
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramAPIError
 from aiogram.fsm.context import FSMContext
 
 # Локальные импорты
 from init_bot import bot, dp # Импортируем наш объект бота
 from db import db_manager
+from utils.broadcast import BroadcastEngine, ProgressReporter
 from utils.helpers import (
-    is_admin, fetch_bot_stats, create_broadcast, send_broadcast
+    is_admin, fetch_bot_stats, create_broadcast, run_broadcast, build_broadcast_report,
+    parse_segment_filters
 )
-from states.FSM_states import BroadcastStates
+from utils.scheduler import parse_schedule_input, create_schedule
+from states.FSM_states import BroadcastStates, ScheduleStates, SegmentStates
 from keyboards.inline import admin_keyboard
+from config import BROADCAST_MODE, DEFAULT_TIMEZONE
 
 # Создаем роутер для админ-панели
 router = Router()
 logger = logging.getLogger(__name__)
 
+# Прогоны рассылок, которые выполняются в этом процессе: run_id -> Task.
+# Между процессами (serve.py) прогон делят через аренду mailing_db.run_lease
+active_runs: dict[int, asyncio.Task] = {}
+
 
 @router.callback_query(F.data == "admin_main")
 async def admin_main_menu(callback_query: types.CallbackQuery, state: FSMContext):
@@ -56,49 +64,20 @@ async def admin_stats_callback(callback_query: types.CallbackQuery, state: FSMCo
 
 async def start_broadcast(user_ids, message_text, db_manager, run_id):
     """
-    Безопасная рассылка:
+    Рассылка текста по готовому списку ID через BroadcastEngine:
     - Помечает заблокировавших пользователей
-    - Обрабатывает Flood Limit (Retry-After)
+    - Flood limit и сетевые ошибки уходят в очередь повторов, не блокируя остальных
     - Не падает при ошибках
     """
-    success_count = 0
-    blocked_count = 0
-    error_count = 0
+    async def send(user_id: int):
+        await bot.send_message(user_id, message_text)
 
-    for user_id in user_ids:
-        try:
-            # Отправляем сообщение
-            await bot.send_message(user_id, message_text)
-            
-            # Логируем успех в базу (для статистики в админке)
-            await db_manager.mailing_db.log_stat(run_id, user_id, 'success')
-            success_count += 1
-            
-            # Маленькая пауза, чтобы не триггерить лимиты (30 сообщений в секунду - лимит ТГ)
-            await asyncio.sleep(0.05) 
-
-        except TelegramForbiddenError:
-            # Юзер заблокировал бота — помечаем его в базе, чтобы больше не слать
-            logger.info(f"User {user_id} blocked the bot.")
-            await db_manager.users_db.update_user_status(user_id, is_alive=False)
-            await db_manager.mailing_db.log_stat(run_id, user_id, 'blocked')
-            blocked_count += 1
-
-        except TelegramRetryAfter as e:
-            # Если всё же поймали Flood Limit — ждем сколько просит ТГ
-            logger.warning(f"Flood limit! Sleeping for {e.retry_after} seconds.")
-            await asyncio.sleep(e.retry_after)
-            # Повторная попытка после паузы
-            await bot.send_message(user_id, message_text)
-            success_count += 1
-
-        except TelegramAPIError as e:
-            # Любая другая ошибка (неверный ID и т.д.)
-            logger.error(f"API Error for {user_id}: {e}")
-            await db_manager.mailing_db.log_stat(run_id, user_id, 'error')
-            error_count += 1
-
-    return success_count, blocked_count, error_count
+    async def chunks():
+        yield list(user_ids)
+
+    result = await BroadcastEngine(bot, db_manager).run(run_id, chunks(), send)
+    counts = result.counts
+    return counts['sent'], counts['blocked'], counts['error'] + counts['failed']
 
 
 @router.callback_query(F.data == "start_broadcast")
@@ -124,7 +103,8 @@ async def start_broadcast_menu(callback_query: types.CallbackQuery):
     for m in mailings:
         # m['name'] - техническое имя рассылки
         kb.inline_keyboard.append([
-            InlineKeyboardButton(text=f"🚀 {m['name']}", callback_data=f"run_broadcast:{m['id']}")
+            InlineKeyboardButton(text=f"🚀 {m['name']}", callback_data=f"run_broadcast:{m['id']}"),
+            InlineKeyboardButton(text="🎯 сегмент", callback_data=f"segment_broadcast:{m['id']}")
         ])
     
     kb.inline_keyboard.append([InlineKeyboardButton(text="« Назад", callback_data="admin_main")])
@@ -135,6 +115,103 @@ async def start_broadcast_menu(callback_query: types.CallbackQuery):
     )
     await callback_query.answer()
 
+def run_control_keyboard(run_id: int, paused: bool = False) -> InlineKeyboardMarkup:
+    if paused:
+        button = InlineKeyboardButton(text=f"▶️ Продолжить #{run_id}", callback_data=f"resume_run:{run_id}")
+    else:
+        button = InlineKeyboardButton(text=f"⏸ Пауза #{run_id}", callback_data=f"pause_run:{run_id}")
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+
+async def report_broadcast(admin_id: int | None, result):
+    """Отправляет админу отчет по прогону (или сообщение о паузе)"""
+    if not admin_id:
+        return
+    run_id = result.run_id
+    if result.stopped:
+        await bot.send_message(
+            admin_id,
+            f"⏸ Рассылка #{run_id} на паузе. Отправлено за этот заход: {result.counts['sent']}",
+            reply_markup=run_control_keyboard(run_id, paused=True)
+        )
+        return
+
+    report = await build_broadcast_report(run_id, db_manager, result)
+    await bot.send_message(admin_id, report, parse_mode="HTML")
+
+
+def spawn_broadcast_run(run_id: int, admin_id: int | None, progress_message: Message | None = None,
+                        announce: bool = True) -> bool:
+    """
+    Запускает прогон с его курсора фоновой задачей.
+    progress_message — сообщение админу, которое превратится в живой прогресс
+    (если не передано и announce, будет отправлено новое; без announce — без прогресса,
+    админ получит только итоговый отчет).
+    Прогон, упавший с ошибкой, ставится на паузу: продолжить его может только админ.
+    Возвращает False, если этот прогон уже выполняется в процессе. Если он
+    выполняется в другом процессе, задача завершится, не взяв аренду.
+    """
+    task = active_runs.get(run_id)
+    if task and not task.done():
+        return False
+
+    async def background_run():
+        try:
+            async with db_manager.mailing_db.run_lease(run_id) as leased:
+                if not leased:
+                    # Прежняя задача (здесь или в другом воркере) еще не дошла до чекпоинта и продолжит сама
+                    logger.info(f"Рассылка #{run_id} уже выполняется в другом процессе")
+                    return
+                progress = None
+                if admin_id and (progress_message or announce):
+                    message = progress_message or await bot.send_message(admin_id, f"⏳ Рассылка #{run_id} запускается...")
+                    progress = ProgressReporter(bot, admin_id, message.message_id,
+                                                reply_markup=run_control_keyboard(run_id))
+                result = await run_broadcast(run_id, bot, db_manager, progress=progress)
+            if result:
+                await report_broadcast(admin_id, result)
+        except Exception as e:
+            logger.exception(f"Критическая ошибка в фоновой рассылке #{run_id}")
+            # Пауза вместо running: иначе тик планировщика перезапускал бы прогон и слал ошибку снова
+            try:
+                paused = await db_manager.mailing_db.pause_run(run_id)
+            except Exception:
+                logger.exception(f"Не удалось поставить рассылку #{run_id} на паузу")
+                paused = False
+            if admin_id:
+                await bot.send_message(
+                    admin_id,
+                    f"⚠️ Рассылка #{run_id} прервана ошибкой: {e}" + ("\nПрогон на паузе." if paused else ""),
+                    reply_markup=run_control_keyboard(run_id, paused=True) if paused else None
+                )
+        finally:
+            active_runs.pop(run_id, None)
+
+    active_runs[run_id] = asyncio.create_task(background_run())
+    return True
+
+
+async def resume_unfinished_broadcasts(announce: bool = False):
+    """
+    Продолжает прогоны в state='running', которые никто не выполняет: прерванные
+    рестартом или падением воркера. Прогоны с занятой арендой идут в других процессах.
+    Вызывается при старте (announce — с сообщением о прогрессе) и на каждом тике
+    планировщика (без нового сообщения админу).
+    Для режима queue это только дораскладка заданий: разложенные (planned) прогоны
+    остаются running, пока их дорабатывают воркеры, и не трогаются.
+    """
+    runs = [run for run in await db_manager.mailing_db.get_runs_by_state('running')
+            if run['id'] not in active_runs and not (run['mode'] == 'queue' and run['planned'])]
+    if not runs:
+        return
+    leased = await db_manager.mailing_db.get_leased_runs([run['id'] for run in runs])
+    for run in runs:
+        if run['id'] in leased:
+            continue
+        logger.info(f"Возобновляем рассылку #{run['id']} ({run['name']}): ее никто не выполняет")
+        spawn_broadcast_run(run['id'], run['admin_id'], announce=announce)
+
+
 @router.callback_query(F.data.startswith("run_broadcast:"))
 async def run_broadcast_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
@@ -144,33 +221,255 @@ async def run_broadcast_callback(callback_query: types.CallbackQuery):
         return
         
     id = int(callback_query.data.split(":")[1])
-    await callback_query.message.edit_text(f"⏳ Рассылка  запущена в фоне.\nВы получите отчет сразу по завершении.")
+    run_id = await db_manager.mailing_db.start_new_run(id, user_id, mode=BROADCAST_MODE)
 
-    # Обертка для фоновой задачи, чтобы собрать статистику ПОСЛЕ завершения
-    async def background_mailing():
-        try:
-            run_id = await send_broadcast({"id": id}, bot, db_manager)
-            if run_id:
-                stats = await db_manager.mailing_db.get_stats(run_id)
-                mailing_data = await db_manager.mailing_db.get_mailing_by_run_id(run_id)
-                
-                title = mailing_data['title'] if mailing_data else "Mailing"
-                report = (
-                    f"🎉 <b>Рассылка #{run_id} завершена!</b>\n"
-                    f"<b>Шаблон:</b> <code>{title}</code>\n"
-                    f"—————————————————————\n"
-                    f"✅ Успешно: <b>{stats.get('sent', 0)}</b>\n"
-                    f"🚫 Блоки: <b>{stats.get('blocked', 0)}</b>\n"
-                    f"⚠️ Ошибки: <b>{stats.get('error', 0)}</b>\n"
-                    f"🖱 Клики: <b>{stats.get('clicked', 0)}</b>"
-                )
-                await bot.send_message(user_id, report, parse_mode="HTML")
-        except Exception as e:
-            logger.exception(f"Критическая ошибка в фоновой рассылке ")
-            await bot.send_message(user_id, f"⚠️ Рассылка прервана ошибкой: {e}")
+    await callback_query.message.edit_text(
+        f"⏳ Рассылка #{run_id} запущена в фоне.\nВы получите отчет сразу по завершении.",
+        reply_markup=run_control_keyboard(run_id)
+    )
+    spawn_broadcast_run(run_id, user_id, progress_message=callback_query.message)
+    await callback_query.answer()
+
+
+@router.callback_query(F.data.startswith("segment_broadcast:"))
+async def segment_broadcast_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    await state.update_data(mailing_id=int(callback_query.data.split(":")[1]))
+    await state.set_state(SegmentStates.waiting_filters)
+    await callback_query.message.edit_text(
+        "Отправьте фильтры сегмента через пробел:\n"
+        "<code>lang=ru,en</code> <code>premium=1</code> <code>signup=2026-01-01..2026-06-30</code>\n"
+        "<code>ref=any</code> / <code>ref=none</code> / <code>ref=ID</code> <code>videos>=5</code> "
+        "<code>quest=ID</code> <code>!quest=ID</code>",
+        parse_mode="HTML"
+    )
+    await callback_query.answer()
+
+@router.message(StateFilter(SegmentStates.waiting_filters))
+async def process_segment_filters(message: Message, state: FSMContext):
+    try:
+        spec = parse_segment_filters(message.text or "")
+    except ValueError as e:
+        await message.answer(f"⚠️ {e}")
+        return
+
+    started = time.perf_counter()
+    count = await db_manager.segments.count(spec)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    await state.update_data(segment=spec)
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🚀 Запустить на {count}", callback_data="run_segment")],
+        [InlineKeyboardButton(text="« Отмена", callback_data="admin_main")],
+    ])
+    await message.answer(
+        f"🎯 В сегменте <b>{count}</b> живых пользователей (подсчет {elapsed_ms:.1f} мс).\n"
+        "Можно отправить другие фильтры или запустить рассылку.",
+        reply_markup=kb,
+        parse_mode="HTML"
+    )
+
+@router.callback_query(F.data == "run_segment", StateFilter(SegmentStates.waiting_filters))
+async def run_segment_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    user_id = callback_query.from_user.id
+    if not is_admin(user_id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    data = await state.get_data()
+    if not data.get("segment"):
+        await callback_query.answer("Сначала отправьте фильтры", show_alert=True)
+        return
+    await state.clear()
+
+    run_id = await db_manager.mailing_db.start_new_run(
+        data["mailing_id"], user_id, mode=BROADCAST_MODE, segment=data["segment"]
+    )
+    await callback_query.message.edit_text(
+        f"⏳ Рассылка #{run_id} по сегменту запущена в фоне.\nВы получите отчет сразу по завершении.",
+        reply_markup=run_control_keyboard(run_id)
+    )
+    spawn_broadcast_run(run_id, user_id, progress_message=callback_query.message)
+    await callback_query.answer()
+
+
+@router.callback_query(F.data.startswith("pause_run:"))
+async def pause_run_callback(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    run_id = int(callback_query.data.split(":")[1])
+    # Прогон увидит новое состояние на ближайшем чекпоинте и остановится
+    if not await db_manager.mailing_db.pause_run(run_id):
+        run = await db_manager.mailing_db.get_run(run_id)
+        if run and run['state'] == 'paused':
+            await callback_query.answer(f"Рассылка #{run_id} уже на паузе")
+        else:
+            await callback_query.message.edit_reply_markup(reply_markup=None)
+            await callback_query.answer("Рассылка уже завершена", show_alert=True)
+        return
+    await callback_query.message.edit_reply_markup(reply_markup=run_control_keyboard(run_id, paused=True))
+    await callback_query.answer(f"Рассылка #{run_id} будет остановлена на ближайшем чекпоинте")
+
+
+@router.callback_query(F.data.startswith("resume_run:"))
+async def resume_run_callback(callback_query: types.CallbackQuery):
+    user_id = callback_query.from_user.id
+    if not is_admin(user_id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    run_id = int(callback_query.data.split(":")[1])
+    if not await db_manager.mailing_db.resume_run(run_id):
+        run = await db_manager.mailing_db.get_run(run_id)
+        if run and run['state'] == 'running':
+            await callback_query.answer(f"Рассылка #{run_id} уже выполняется")
+        else:
+            await callback_query.message.edit_reply_markup(reply_markup=None)
+            await callback_query.answer("Рассылка уже завершена", show_alert=True)
+        return
+
+    # Если пауза еще не успела сработать, прогон просто продолжится сам
+    spawn_broadcast_run(run_id, user_id)
+    await callback_query.message.edit_reply_markup(reply_markup=run_control_keyboard(run_id))
+    await callback_query.answer(f"Рассылка #{run_id} продолжается")
+
+
+@router.callback_query(F.data == "active_broadcasts")
+async def active_broadcasts_callback(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    runs = await db_manager.mailing_db.get_runs_by_state('running', 'paused')
+    if not runs:
+        await callback_query.message.edit_text("Незавершенных рассылок нет.", reply_markup=admin_keyboard())
+        await callback_query.answer()
+        return
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    for run in runs:
+        paused = run['state'] == 'paused'
+        kb.inline_keyboard.append([InlineKeyboardButton(
+            text=f"{'▶️' if paused else '⏸'} #{run['id']} {run['name']}",
+            callback_data=f"{'resume_run' if paused else 'pause_run'}:{run['id']}"
+        )])
+    kb.inline_keyboard.append([InlineKeyboardButton(text="« Назад", callback_data="admin_main")])
+
+    await callback_query.message.edit_text("Незавершенные рассылки (нажмите, чтобы поставить на паузу или продолжить):", reply_markup=kb)
+    await callback_query.answer()
+
+
+# --- ОТЛОЖЕННЫЕ РАССЫЛКИ ---
+
+@router.callback_query(F.data == "schedule_broadcast")
+async def schedule_broadcast_menu(callback_query: types.CallbackQuery, state: FSMContext):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+    await state.clear()
+
+    mailings = await db_manager.mailing_db.get_all_broadcast_names()
+    if not mailings:
+        await callback_query.message.edit_text(
+            "❌ У вас еще нет созданных шаблонов рассылок.",
+            reply_markup=admin_keyboard()
+        )
+        return
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    for m in mailings:
+        kb.inline_keyboard.append([
+            InlineKeyboardButton(text=f"🕒 {m['name']}", callback_data=f"schedule_mailing:{m['id']}")
+        ])
+    kb.inline_keyboard.append([InlineKeyboardButton(text="« Назад", callback_data="admin_main")])
+
+    await callback_query.message.edit_text("Выберите шаблон для отложенной рассылки:", reply_markup=kb)
+    await callback_query.answer()
+
+@router.callback_query(F.data.startswith("schedule_mailing:"))
+async def schedule_mailing_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    await state.update_data(mailing_id=int(callback_query.data.split(":")[1]))
+    await state.set_state(ScheduleStates.waiting_time)
+    await callback_query.message.edit_text(
+        "Когда отправить? Формат:\n"
+        "<code>ДД.ММ.ГГГГ ЧЧ:ММ [local] [окно_в_минутах]</code>\n\n"
+        f"• без <code>local</code> — время по {DEFAULT_TIMEZONE}\n"
+        "• <code>local</code> — в это время по часам каждого пользователя\n"
+        "• окно — растянуть отправку на столько минут\n\n"
+        "Например: <code>20.10.2026 18:00 local 60</code>",
+        parse_mode="HTML"
+    )
+    await callback_query.answer()
+
+@router.message(StateFilter(ScheduleStates.waiting_time))
+async def process_schedule_time(message: Message, state: FSMContext):
+    try:
+        when, local, spread = parse_schedule_input(message.text or "")
+    except ValueError as e:
+        await message.answer(f"⚠️ Не понял время ({e}). Пример: <code>20.10.2026 18:00 local 60</code>", parse_mode="HTML")
+        return
+
+    data = await state.get_data()
+    try:
+        schedule_id, slots, skipped = await create_schedule(
+            db_manager, data["mailing_id"], message.from_user.id, when, local=local, spread_minutes=spread
+        )
+    except ValueError as e:
+        await message.answer(f"⚠️ Не запланировано: {e}. Укажите время в будущем.")
+        return
+    await state.clear()
+
+    first = min(slot[0] for slot in slots)
+    await message.answer(
+        f"✅ Рассылка запланирована (#{schedule_id}).\n"
+        f"Запусков: <b>{len(slots)}</b>, первый — <b>{first:%d.%m.%Y %H:%M} UTC</b>"
+        + (f", окно {spread} мин." if spread else "")
+        + (f"\n⏭ Пропущено пользователей, у которых это время уже прошло: <b>{skipped}</b>" if skipped else ""),
+        reply_markup=admin_keyboard(),
+        parse_mode="HTML"
+    )
+
+@router.callback_query(F.data == "scheduled_broadcasts")
+async def scheduled_broadcasts_callback(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
+
+    schedules = await db_manager.schedules_db.get_pending()
+    if not schedules:
+        await callback_query.message.edit_text("Запланированных рассылок нет.", reply_markup=admin_keyboard())
+        await callback_query.answer()
+        return
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    for s in schedules:
+        kb.inline_keyboard.append([InlineKeyboardButton(
+            text=f"❌ #{s['id']} {s['name']} — {s['next_fire_at']:%d.%m %H:%M} UTC ({s['slots']})",
+            callback_data=f"cancel_schedule:{s['id']}"
+        )])
+    kb.inline_keyboard.append([InlineKeyboardButton(text="« Назад", callback_data="admin_main")])
+
+    await callback_query.message.edit_text("Запланированные рассылки (нажмите, чтобы отменить):", reply_markup=kb)
+    await callback_query.answer()
+
+@router.callback_query(F.data.startswith("cancel_schedule:"))
+async def cancel_schedule_callback(callback_query: types.CallbackQuery):
+    if not is_admin(callback_query.from_user.id):
+        await callback_query.answer("У вас нет прав", show_alert=True)
+        return
 
-    # Запускаем как независимую задачу
-    asyncio.create_task(background_mailing())
+    schedule_id = int(callback_query.data.split(":")[1])
+    await db_manager.schedules_db.cancel(schedule_id)
+    await callback_query.message.edit_text(f"Рассылка #{schedule_id} отменена.", reply_markup=admin_keyboard())
     await callback_query.answer()
 
 
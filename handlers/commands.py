@@ -1,7 +1,7 @@
 import logging
 from aiogram import Router, F, types
-from aiogram.types import Message
-from aiogram.filters import Command
+from aiogram.types import Message, ChatMemberUpdated
+from aiogram.filters import Command, ChatMemberUpdatedFilter, KICKED, MEMBER
 
 # Импортируем роутер, а не dp
 router = Router()
@@ -50,4 +50,16 @@ async def cmd_admin(message: Message):
     if not is_admin(message.from_user.id):
         await message.reply("Доступ только для админа.")
         return
-    await message.reply("Админ меню:", reply_markup=admin_keyboard())
\ No newline at end of file
+    await message.reply("Админ меню:", reply_markup=admin_keyboard())
+
+
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=KICKED))
+async def user_blocked_bot(event: ChatMemberUpdated):
+    """Юзер заблокировал бота: помечаем "мертвым" (пачкой через буфер статусов)"""
+    await db_manager.users_db.update_user_status(event.from_user.id, is_alive=False)
+
+
+@router.my_chat_member(F.chat.type == "private", ChatMemberUpdatedFilter(member_status_changed=MEMBER))
+async def user_unblocked_bot(event: ChatMemberUpdated):
+    """Юзер разблокировал бота: снова получает рассылки"""
+    await db_manager.users_db.update_user_status(event.from_user.id, is_alive=True)
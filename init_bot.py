@@ -1,10 +1,10 @@
 import os
 import logging
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from config import BOT_TOKEN
+from utils.fsm_storage import PgStorage
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,4 +22,5 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 
-dp = Dispatcher(storage=MemoryStorage())
\ No newline at end of file
+# Состояния FSM в Postgres; пул подключается в main.start_app после db_manager.setup()
+dp = Dispatcher(storage=PgStorage())
\ No newline at end of file
@@ -30,6 +30,9 @@ def admin_keyboard():
         inline_keyboard=[
             [InlineKeyboardButton(text="Статистика бота", callback_data="admin_stats")],
             [InlineKeyboardButton(text="начать рассылку", callback_data="start_broadcast")],
+            [InlineKeyboardButton(text="активные рассылки", callback_data="active_broadcasts")],
+            [InlineKeyboardButton(text="запланировать рассылку", callback_data="schedule_broadcast")],
+            [InlineKeyboardButton(text="запланированные рассылки", callback_data="scheduled_broadcasts")],
             [InlineKeyboardButton(text="создать новую рассылку", callback_data="create_broadcast")],
             [
             InlineKeyboardButton(
@@ -1,4 +1,5 @@
 import os
+import signal
 import asyncio
 import pathlib
 import aiohttp
@@ -9,11 +10,15 @@ from aiohttp import web
 from init_bot import bot, dp, logger
 from config import (
     WEBHOOK_URL_FINAL, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, 
-    PORT, PROJ_ROOT
+    PORT, PROJ_ROOT, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_DEDUP_WINDOW
 )
 from db import db_manager
 from handlers.commands import router as commands_router
-from handlers.admin_menu import router as admin_router
+from handlers.admin_menu import router as admin_router, resume_unfinished_broadcasts, spawn_broadcast_run
+from utils.scheduler import BroadcastScheduler
+from utils.fastjson import json_response
+from utils.update_queue import UpdateQueue, UpdateDeduplicator, extract_update_id
+from aiogram.types import Update
 
 # Импорт актуальных обработчиков API
 from api.routes import (
@@ -28,19 +33,42 @@ from api.routes import (
     cpa_postback_handler
 )
 
+update_queue = UpdateQueue(dp, bot, workers=WEBHOOK_WORKERS, maxsize=WEBHOOK_QUEUE_SIZE)
+# Повторные доставки одного апдейта отсекаются до разбора модели и любой работы с БД
+update_dedup = UpdateDeduplicator(window=WEBHOOK_DEDUP_WINDOW)
+
 # ---------- Жизненный цикл приложения ----------
 
 async def on_startup(app):
     app['http_session'] = aiohttp.ClientSession()
     app['db_manager'] = db_manager
     app['bot'] = bot
+    update_queue.start()
     logger.info("Application startup: HTTP session and Bot objects are ready.")
 
 async def on_shutdown(app):
     logger.info("Shutting down application...")
+    # Планировщик останавливаем первым: его тик ходит в пул и запускает рассылки
+    if app.get('scheduler'):
+        await app['scheduler'].stop()
+    # Сначала дорабатываем принятые апдейты: им еще нужны пул и буферы
+    await update_queue.stop()
+    # Дописываем несброшенные данные FSM
+    try:
+        await dp.storage.close()
+    except Exception as e:
+        logger.error(f"Failed to flush FSM storage: {e}")
+    # Дописываем в БД отложенные счетчики просмотров до закрытия пула
     try:
-        await bot.delete_webhook()
-    except: pass
+        await db_manager.close_buffers()
+    except Exception as e:
+        logger.error(f"Failed to flush write-behind buffers: {e}")
+
+    # Вебхук один на всех воркеров — снимает его только основной
+    if app['primary']:
+        try:
+            await bot.delete_webhook()
+        except: pass
     
     # Закрываем сессию aiohttp приложения
     if 'http_session' in app:
@@ -61,17 +89,31 @@ async def handle_webhook(request: web.Request):
     if secret != WEBHOOK_SECRET_TOKEN and header_secret != WEBHOOK_SECRET_TOKEN:
         return web.Response(status=403, text="Forbidden")
 
+    raw = await request.read()
+    update_id = extract_update_id(raw)
+    if update_id is not None and update_dedup.seen(update_id):
+        return web.Response(status=200, text="OK")
+
     try:
-        from aiogram.types import Update
-        body = await request.json()
-        update = Update.model_validate(body, context={"bot": bot})
-        await dp.feed_update(bot=bot, update=update)
+        # pydantic разбирает байты сам, без промежуточного dict от json.loads
+        update = Update.model_validate_json(raw, context={"bot": bot})
     except Exception as e:
-        logger.error(f"Error processing update: {e}")
-        return web.Response(status=500)
-    
+        # Повторная доставка битый апдейт не исправит — подтверждаем и забываем
+        logger.error(f"Invalid update payload: {e}")
+        return web.Response(status=200, text="OK")
+
+    # Обработка идет в воркерах очереди, Telegram получает ответ сразу
+    if not update_queue.put(update):
+        update_dedup.forget(update.update_id)
+        return web.Response(status=503, text="Busy", headers={"Retry-After": "1"})
     return web.Response(status=200, text="OK")
 
+async def handle_webhook_stats(request: web.Request):
+    """Глубина очереди апдейтов и задержки обработки (тот же секрет, что у вебхука)"""
+    if request.match_info.get("secret") != WEBHOOK_SECRET_TOKEN:
+        return web.Response(status=403, text="Forbidden")
+    return json_response({**update_queue.stats(), "duplicates": update_dedup.duplicates})
+
 async def setup_telegram():
     """
     Настройка вебхука. 
@@ -87,7 +129,9 @@ async def setup_telegram():
     await bot.set_webhook(
         url=full_webhook_url,
         secret_token=WEBHOOK_SECRET_TOKEN,
-        drop_pending_updates=True
+        drop_pending_updates=True,
+        # Явно: иначе Telegram оставит прежний список и не пришлет my_chat_member
+        allowed_updates=dp.resolve_used_update_types()
     )
     logger.info(f"✅ Webhook successfully set to: {full_webhook_url}")
 
@@ -108,15 +152,32 @@ async def cors_middleware(request, handler):
 # ---------- Запуск сервера ----------
 
 
-async def start_app():
-    # 1. БД
-    await db_manager.setup()
+async def start_app(worker_index: int | None = None, pool_size: int | None = None):
+    """
+    Запуск веб-приложения. Без аргументов — единственный процесс.
+    Под супервизором (serve.py) worker_index — номер воркера: все слушают порт
+    через SO_REUSEPORT, а вебхук, обслуживание БД, возобновление рассылок и
+    планировщик — только у основного (worker_index == 0).
+    """
+    primary = not worker_index
+    if pool_size:
+        db_manager.pool_max_size = pool_size
+    db_manager.multi_process = worker_index is not None
+
+    # 1. БД (миграции под супервизором уже накатил serve.py)
+    await db_manager.setup(primary=primary)
+    await dp.storage.attach(db_manager.pool, db_manager.db_url, cleanup=primary)
 
     dp.include_router(commands_router)
     dp.include_router(admin_router)
 
     # 2. Приложение
     app = web.Application(middlewares=[cors_middleware])
+    app['primary'] = primary
+    # Состояние приложения задаем до runner.setup(): после старта app заморожен
+    app['scheduler'] = BroadcastScheduler(
+        db_manager, spawn_broadcast_run, resume=resume_unfinished_broadcasts
+    ) if primary else None
     app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
 
@@ -137,6 +198,7 @@ async def start_app():
 
     # Вебхук
     app.router.add_post(f"{WEBHOOK_PATH}/telegram/{{secret}}", handle_webhook)
+    app.router.add_get(f"{WEBHOOK_PATH}/stats/{{secret}}", handle_webhook_stats)
 
     # 4. Статика
     app.router.add_static('/assets', path=str(pathlib.Path(PROJ_ROOT) / "miniapp"), show_index=False)
@@ -147,11 +209,27 @@ async def start_app():
     # 5. Старт
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, host="0.0.0.0", port=PORT)
+    site = web.TCPSite(runner, host="0.0.0.0", port=PORT, reuse_port=worker_index is not None)
     await site.start()
-    
-    await setup_telegram()
-    await asyncio.Event().wait()
+
+    if primary:
+        await setup_telegram()
+        # 6. Рассылки, прерванные рестартом, продолжаем с последнего чекпоинта
+        # (дальше брошенные упавшими воркерами подхватывает тик планировщика)
+        await resume_unfinished_broadcasts(announce=True)
+        # 7. Отложенные рассылки
+        app['scheduler'].start()
+
+    # 8. Ждем SIGTERM/SIGINT и останавливаемся штатно, чтобы on_shutdown дописал буферы
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await stop.wait()
+    await runner.cleanup()
 
 if __name__ == "__main__":
     try:
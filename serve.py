@@ -0,0 +1,118 @@
+"""
+Супервизор веб-приложения: N процессов main.start_app на одном порту (SO_REUSEPORT),
+ядро распределяет между ними входящие соединения. Только Linux/BSD:
+
+    python serve.py --workers 4 --pool-budget 40
+
+Супервизор один раз накатывает миграции и форкает воркеров; каждому достается
+пул на pool_budget // workers соединений. Воркер 0 — основной: регистрирует
+вебхук, обслуживает партиции, возобновляет рассылки и ведет планировщик.
+Упавший воркер перезапускается с тем же номером. SIGTERM/SIGINT — штатная
+остановка всех воркеров.
+"""
+import os
+import time
+import signal
+import asyncio
+import asyncpg
+import argparse
+import logging
+
+from config import WEB_WORKERS, DB_POOL_BUDGET
+from db import DB_URL, MigrationRunner
+
+logger = logging.getLogger("serve")
+
+MIN_POOL_SIZE = 2
+
+
+async def migrate():
+    """Миграции до форка: воркеры готовят запросы на соединениях и ждут готовую схему"""
+    pool = await asyncpg.create_pool(DB_URL, min_size=1, max_size=1)
+    try:
+        await MigrationRunner(pool).run()
+    finally:
+        await pool.close()
+
+
+def run_worker(index: int, pool_size: int):
+    # Импорт после fork: бот, диспетчер, буферы и их сессии создаются в процессе воркера
+    import main
+    asyncio.run(main.start_app(worker_index=index, pool_size=pool_size))
+
+
+class Supervisor:
+    def __init__(self, workers: int, pool_size: int, restart_delay: float = 1.0):
+        self.workers = workers
+        self.pool_size = pool_size
+        self.restart_delay = restart_delay
+        self.children: dict[int, int] = {}  # pid -> номер воркера
+        self.stopping = False
+
+    def spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            # Воркер ставит свои обработчики сигналов в start_app
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(index, self.pool_size)
+            except BaseException:
+                logger.exception(f"Воркер {index} завершился с ошибкой")
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+        logger.info(f"Воркер {index}{' (основной)' if index == 0 else ''} запущен, pid {pid}")
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            logger.warning(f"Воркер {index} (pid {pid}) завершился: {os.waitstatus_to_exitcode(status)}, перезапуск")
+            time.sleep(self.restart_delay)
+            if not self.stopping:
+                self.spawn(index)
+        logger.info("Все воркеры остановлены")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Несколько процессов веб-приложения на одном порту")
+    parser.add_argument("--workers", type=int, default=WEB_WORKERS)
+    parser.add_argument("--pool-budget", type=int, default=DB_POOL_BUDGET,
+                        help="соединений с БД на все пулы воркеров вместе")
+    args = parser.parse_args()
+
+    workers = max(1, args.workers)
+    pool_size = max(MIN_POOL_SIZE, args.pool_budget // workers)
+    if pool_size * workers > args.pool_budget:
+        logger.warning(f"Бюджет {args.pool_budget} меньше {MIN_POOL_SIZE} соединений на воркер, "
+                       f"всего будет до {pool_size * workers}")
+    # Сверх пулов: LISTEN каталога видео и FSM (по два на воркер) и по одному
+    # соединению на каждую выполняемую рассылку (аренда прогона)
+    logger.info(f"Воркеров: {workers}, пул на воркер: {pool_size}")
+
+    asyncio.run(migrate())
+    Supervisor(workers, pool_size).run()
+
+
+if __name__ == "__main__":
+    main()
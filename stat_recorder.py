@@ -48,7 +48,7 @@ class DailyStatsManager:
             self.stats["total_balance"] = float(await conn.fetchval(query_balance) or 0.0)
 
         # квесты выполненные
-        query_quests = "SELECT SUM(array_length(quests_done,1)) FROM tg_users;"
+        query_quests = "SELECT COUNT(*) FROM user_quests_done;"
         async with self.db.pool.acquire() as conn:
             self.stats["quests_done"] = await conn.fetchval(query_quests) or 0
 
@@ -6,4 +6,10 @@ class BroadcastStates(StatesGroup):
     waiting_title = State()
     waiting_text = State()
     waiting_button = State()
-    waiting_button_link = State()
\ No newline at end of file
+    waiting_button_link = State()
+
+class ScheduleStates(StatesGroup):
+    waiting_time = State()
+
+class SegmentStates(StatesGroup):
+    waiting_filters = State()
\ No newline at end of file
@@ -0,0 +1,421 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import contextlib
+from collections import deque
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramRetryAfter, TelegramAPIError,
+    TelegramNetworkError, TelegramServerError
+)
+
+from config import (
+    BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_CHECKPOINT_EVERY, BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_MAX_ATTEMPTS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Общий для всех отправителей лимитер скорости (сообщений в секунду).
+    На TelegramRetryAfter ставит всех на паузу и снижает скорость,
+    после успешных отправок постепенно возвращает ее к базовой.
+    """
+    def __init__(self, rate: float, burst: float | None = None, min_rate: float = 1.0,
+                 backoff: float = 0.7, recovery: float = 0.002):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(rate / 5, 1.0)
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.recovery = recovery
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        # Лок дает очередь FIFO: токены раздаются в порядке запроса
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def penalize(self, retry_after: float):
+        """
+        Telegram попросил подождать: пауза для всех и снижение скорости.
+        429 от остальных отправителей, пришедшие во время уже идущей паузы, — та же
+        волна: продлевают паузу, но скорость повторно не режут.
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._paused_until = max(self._paused_until, now + retry_after)
+            return
+        self._paused_until = now + retry_after
+        self._tokens = 0
+        self._updated = now
+        self.rate = max(self.min_rate, self.rate * self.backoff)
+        logger.warning(f"Flood limit: пауза {retry_after} с, скорость снижена до {self.rate:.1f} msg/s")
+
+    def set_base_rate(self, rate: float):
+        """Новая базовая скорость (лимит отложенного прогона); текущее снижение после flood limit сохраняется"""
+        if rate == self.base_rate:
+            return
+        penalty = self.rate / self.base_rate
+        self.base_rate = rate
+        self.rate = min(rate, max(self.min_rate, rate * penalty))
+        self.capacity = max(rate / 5, 1.0)
+        self._tokens = min(self._tokens, self.capacity)
+
+    def reward(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.recovery)
+
+
+class RetryQueue:
+    """
+    Отложенные повторы доставки: куча по времени готовности. pump() переносит
+    созревшие элементы обратно в рабочую очередь, поэтому ожидание повтора
+    не занимает отправителя и не тормозит остальных получателей.
+    Элемент считается незавершенным от push() до task_done() после его попытки.
+    """
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._changed = asyncio.Event()
+        self._pending = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная пауза с джиттером ±50%, чтобы повторы не шли пачкой"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.5)
+
+    def push(self, item, delay: float):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), item))
+        self._pending += 1
+        self._idle.clear()
+        self._changed.set()
+
+    def task_done(self):
+        self._pending -= 1
+        if self._pending <= 0:
+            self._idle.set()
+
+    async def join(self):
+        """Ждет, пока все повторы не получат окончательный результат"""
+        await self._idle.wait()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def pump(self, queue: asyncio.Queue):
+        while True:
+            self._changed.clear()
+            if not self._heap:
+                await self._changed.wait()
+                continue
+            wait = self._heap[0][0] - time.monotonic()
+            if wait > 0:
+                # Просыпаемся по сроку ближайшего повтора или по новому, более раннему
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._changed.wait(), wait)
+                continue
+            _, _, item = heapq.heappop(self._heap)
+            await queue.put(item)
+
+
+class BroadcastResult:
+    """Итоги прогона рассылки и фактическая скорость"""
+    def __init__(self, run_id: int):
+        self.run_id = run_id
+        self.counts = {"sent": 0, "blocked": 0, "error": 0, "failed": 0}
+        self.started_at = time.monotonic()
+        self.finished_at: float | None = None
+        # True, если прогон остановлен на чекпоинте (пауза), а не дошел до конца
+        self.stopped = False
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Достигнутая скорость, сообщений в секунду"""
+        return self.total / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ProgressReporter:
+    """
+    Живое сообщение о ходе рассылки. Читает только счетчики BroadcastResult в
+    памяти (без запросов в БД) и редактирует сообщение не чаще раза в interval
+    секунд и только если что-то изменилось, так что на лимит отправки не влияет.
+    total — оценка аудитории для ETA, можно задать после создания.
+    """
+    def __init__(self, bot, chat_id: int, message_id: int, title: str = "",
+                 total: int | None = None, interval: float = BROADCAST_PROGRESS_INTERVAL,
+                 reply_markup=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.title = title
+        self.total = total
+        self.interval = interval
+        self.reply_markup = reply_markup
+        self._last_text = None
+        self._task: asyncio.Task | None = None
+
+    def render(self, result: BroadcastResult, final: bool = False) -> str:
+        counts = result.counts
+        if final:
+            header = "⏸ на паузе" if result.stopped else "✅ завершена"
+        else:
+            header = "⏳ идет"
+        lines = [
+            f"📨 <b>Рассылка #{result.run_id} {header}</b>" + (f"\n<code>{self.title}</code>" if self.title else ""),
+            f"✅ Отправлено: <b>{counts['sent']}</b>",
+            f"🚫 Блоки: <b>{counts['blocked']}</b>",
+            f"⚠️ Ошибки: <b>{counts['error'] + counts['failed']}</b>",
+            f"⚡️ Скорость: <b>{result.rate:.1f}</b> сообщ./с",
+        ]
+        if self.total:
+            done = min(result.total, self.total)
+            lines.append(f"📊 Прогресс: <b>{done}/{self.total}</b> ({done * 100 // self.total}%)")
+            if not final and result.rate > 0:
+                eta = (self.total - done) / result.rate
+                lines.append(f"⏱ Осталось: ~<b>{int(eta // 60)} мин {int(eta % 60)} с</b>")
+        return "\n".join(lines)
+
+    def start(self, result: BroadcastResult):
+        if not self._task:
+            self._task = asyncio.create_task(self._loop(result))
+
+    async def stop(self, result: BroadcastResult):
+        """Останавливает обновления и выводит итоговое состояние"""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self._edit(self.render(result, final=True), reply_markup=self.reply_markup if result.stopped else None)
+
+    async def _loop(self, result: BroadcastResult):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._edit(self.render(result), reply_markup=self.reply_markup)
+
+    async def _edit(self, text: str, reply_markup=None):
+        if text == self._last_text:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=text, chat_id=self.chat_id, message_id=self.message_id,
+                reply_markup=reply_markup, parse_mode="HTML"
+            )
+            self._last_text = text
+        except TelegramRetryAfter as e:
+            # Не ждем: следующая попытка будет на следующем тике
+            logger.debug(f"Прогресс рассылки: flood limit {e.retry_after} с, пропускаем обновление")
+        except TelegramAPIError as e:
+            logger.debug(f"Прогресс рассылки не обновлен: {e}")
+
+
+class BroadcastEngine:
+    """
+    Рассылка в concurrency параллельных отправителей, которые берут токены
+    из одного TokenBucket. Аудитория приходит потоком чанков (по возрастанию ID)
+    в ограниченную очередь, поэтому память не зависит от числа получателей.
+    send(user_id) — корутина, отправляющая одно сообщение.
+
+    Чекпоинт не останавливает подачу: отдельная задача раз в checkpoint_every
+    обработанных получателей сбрасывает статистику и вызывает checkpoint(last_id),
+    где last_id — нижняя граница: все получатели до него включительно обработаны.
+    Если checkpoint вернул False, прогон останавливается (пауза) с result.stopped = True:
+    еще не взятые из очереди получатели отбрасываются, а курсор после отправки
+    начатых сохраняется по последнему из них (очередь FIFO, дыр нет).
+    progress (ProgressReporter) показывает ход прогона по счетчикам в памяти.
+
+    Временные сбои (flood limit, сеть, 5xx) уходят в RetryQueue с
+    экспоненциальной паузой; после max_attempts получатель считается failed.
+    """
+    def __init__(self, bot, db_manager, rate: float = BROADCAST_RATE,
+                 concurrency: int = BROADCAST_CONCURRENCY, max_attempts: int = BROADCAST_MAX_ATTEMPTS,
+                 checkpoint_every: int = BROADCAST_CHECKPOINT_EVERY):
+        self.bot = bot
+        self.db = db_manager
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.checkpoint_every = checkpoint_every
+
+    async def run(self, run_id: int, user_id_chunks, send, checkpoint=None,
+                  progress: ProgressReporter | None = None) -> BroadcastResult:
+        result = BroadcastResult(run_id)
+        if progress:
+            progress.start(result)
+        # Элементы очереди — (user_id, номер попытки, порядковый номер свежего получателя).
+        # Нижняя граница учитывает только свежих: ушедшие на повтор не держат курсор, но
+        # при падении процесса в момент ожидания повтора такой получатель может не получить сообщение
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        retries = RetryQueue()
+        issued: deque[int] = deque()  # user_id свежих получателей после нижней границы, по порядку
+        completed: set[int] = set()   # обработанные порядковые номера выше границы
+        seqs = itertools.count()
+        low = 0                       # сколько свежих обработано подряд с начала
+        low_id: int | None = None     # последний из них
+        saved = 0                     # low на последнем чекпоинте
+        checkpoint_due = asyncio.Event()
+        checkpoint_lock = asyncio.Lock()
+
+        def mark_done(seq: int):
+            nonlocal low, low_id
+            completed.add(seq)
+            while low in completed:
+                completed.remove(low)
+                low_id = issued.popleft()
+                low += 1
+            if low - saved >= self.checkpoint_every:
+                checkpoint_due.set()
+
+        async def save_checkpoint():
+            nonlocal saved
+            if not checkpoint or low == saved:
+                return
+            target, target_id = low, low_id
+            # Статистика получателей до границы уже в буфере: пишем ее раньше курсора
+            await self.db.mailing_db.flush_stats()
+            if await checkpoint(target_id) is False:
+                result.stopped = True
+            saved = target
+
+        async def checkpointer():
+            while True:
+                await checkpoint_due.wait()
+                checkpoint_due.clear()
+                async with checkpoint_lock:
+                    await save_checkpoint()
+
+        async def produce():
+            async for chunk in user_id_chunks:
+                for user_id in chunk:
+                    if result.stopped:
+                        return
+                    if checkpoint_task.done():
+                        # Сбой записи чекпоинта прерывает прогон, как и раньше
+                        await checkpoint_task
+                    issued.append(user_id)
+                    await queue.put((user_id, 0, next(seqs)))
+
+        def drop_fresh():
+            """Пауза: не взятых свежих получателей не отправляем, повторы оставляем"""
+            kept = []
+            while not queue.empty():
+                item = queue.get_nowait()
+                queue.task_done()
+                if item[1]:
+                    kept.append(item)
+            for item in kept:
+                queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                user_id, attempt, seq = await queue.get()
+                try:
+                    status, delay = await self._deliver(user_id, send)
+                    if status == "retry":
+                        if attempt + 1 < self.max_attempts:
+                            retries.push((user_id, attempt + 1, None), delay or retries.backoff(attempt + 1))
+                            continue
+                        status = "failed"
+                    result.counts[status] += 1
+                    await self.db.mailing_db.log_stat(run_id, user_id, status)
+                except Exception:
+                    logger.exception(f"Рассылка #{run_id}: сбой отправителя на {user_id}")
+                finally:
+                    if seq is not None:
+                        mark_done(seq)
+                    queue.task_done()
+                    if attempt:
+                        retries.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        workers.append(asyncio.create_task(retries.pump(queue)))
+        checkpoint_task = asyncio.create_task(checkpointer())
+        workers.append(checkpoint_task)
+        try:
+            try:
+                await produce()
+            finally:
+                # Останов на паузе: закрываем генератор, чтобы отменить подгрузку следующего чанка
+                if hasattr(user_id_chunks, "aclose"):
+                    await user_id_chunks.aclose()
+            if result.stopped:
+                drop_fresh()
+            await queue.join()
+            await retries.join()
+            # Последний чекпоинт — по всем обработанным; задачу останавливаем не посреди записи
+            async with checkpoint_lock:
+                checkpoint_task.cancel()
+                await save_checkpoint()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            result.finished_at = time.monotonic()
+            if progress:
+                await progress.stop(result)
+
+        await self.db.mailing_db.flush_stats()
+        await self.db.users_db.flush_statuses()
+        logger.info(
+            f"Рассылка #{run_id} {'на паузе' if result.stopped else 'завершена'}: {result.counts}, "
+            f"{result.rate:.1f} msg/s за {result.elapsed:.1f} с"
+        )
+        return result
+
+    async def _deliver(self, user_id: int, send) -> tuple[str, float | None]:
+        """
+        Одна попытка доставки. Возвращает (статус, пауза до повтора):
+        статус "retry" — временный сбой, пауза None — взять из backoff.
+        """
+        await self.bucket.acquire()
+        try:
+            await send(user_id)
+            self.bucket.reward()
+            return "sent", None
+        except TelegramForbiddenError:
+            # Помечаем юзера "мертвым", чтобы не слать ему в следующий раз (пачкой через буфер)
+            await self.db.users_db.update_user_status(user_id, is_alive=False)
+            return "blocked", None
+        except TelegramRetryAfter as e:
+            # Общая пауза всех отправителей в бакете, сам получатель — в очередь повторов
+            self.bucket.penalize(e.retry_after)
+            return "retry", float(e.retry_after)
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+            logger.warning(f"Временный сбой доставки {user_id}: {e}")
+            return "retry", None
+        except TelegramAPIError as e:
+            logger.error(f"Ошибка API для {user_id}: {e}")
+            return "error", None
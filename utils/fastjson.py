@@ -0,0 +1,77 @@
+"""
+Быстрый JSON для API и вебхука: orjson или msgspec, если установлены,
+иначе stdlib json. Бэкенд можно зафиксировать переменной JSON_BACKEND
+(orjson / msgspec / json), текущий — в BACKEND.
+"""
+import os
+import json
+
+from aiohttp import web
+
+_requested = os.getenv("JSON_BACKEND", "").lower()
+
+
+def _load_orjson():
+    import orjson
+    # Ключи-числа stdlib json превращает в строки, orjson без флага падает
+    options = orjson.OPT_NON_STR_KEYS
+
+    def dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj, option=options)
+
+    # orjson.JSONDecodeError наследует json.JSONDecodeError
+    return "orjson", orjson.loads, dumps_bytes
+
+
+def _load_msgspec():
+    import msgspec
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+
+    def loads(data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as e:
+            # Вызывающий код ловит ValueError, как у stdlib
+            raise ValueError(str(e)) from e
+
+    return "msgspec", loads, encoder.encode
+
+
+def _load_stdlib():
+    def dumps_bytes(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    return "json", json.loads, dumps_bytes
+
+
+_LOADERS = {"orjson": _load_orjson, "msgspec": _load_msgspec, "json": _load_stdlib}
+
+
+def _select_backend():
+    order = [_requested] if _requested in _LOADERS else []
+    order += [name for name in ("orjson", "msgspec", "json") if name not in order]
+    for name in order:
+        try:
+            return _LOADERS[name]()
+        except ImportError:
+            continue
+
+
+BACKEND, loads, dumps_bytes = _select_backend()
+
+
+def dumps(obj) -> str:
+    """JSON строкой (для web.json_response(dumps=...) и логов)"""
+    return dumps_bytes(obj).decode()
+
+
+def json_response(data, status: int = 200, headers=None) -> web.Response:
+    """Замена web.json_response: тело кодируется сразу в байты, без промежуточной строки"""
+    return web.Response(body=dumps_bytes(data), status=status, headers=headers,
+                        content_type="application/json")
+
+
+async def read_json(request: web.Request):
+    """Замена await request.json(): разбор сырых байт тела выбранным бэкендом"""
+    return loads(await request.read())
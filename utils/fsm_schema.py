@@ -0,0 +1,12 @@
+# Схема состояний FSM aiogram (utils/fsm_storage.PgStorage) — миграция 12 в db.py
+# и create_table у ботов, которые не гоняют миграции приложения. Текст не менять:
+# по нему считается контрольная сумма примененной миграции
+FSM_STATES_DDL = """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data JSONB NOT NULL DEFAULT '{}'::jsonb,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS fsm_states_updated_idx ON fsm_states (updated_at);
+    """
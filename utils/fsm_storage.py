@@ -0,0 +1,245 @@
+import copy
+import uuid
+import asyncio
+import logging
+import contextlib
+from datetime import timedelta
+from collections import OrderedDict
+from typing import Any
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder, KeyBuilder
+
+from utils import fastjson
+from utils.fsm_schema import FSM_STATES_DDL
+from utils.write_behind import WriteBehindBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class _FsmDataBuffer(WriteBehindBuffer):
+    """Несброшенные записи FSM: последняя пара (state, data) на ключ, сброс — одной транзакцией"""
+    def __init__(self, storage: "PgStorage", flush_interval: float, max_pending: int = 500):
+        super().__init__(None, flush_interval, max_pending)
+        self.storage = storage
+        self._rows: dict[str, tuple[str | None, dict]] = {}
+
+    def add(self, key: str, state: str | None, data: dict):
+        self._rows[key] = (state, data)
+        self._maybe_flush()
+
+    def get(self, key: str):
+        return self._rows.get(key)
+
+    async def write_now(self, key: str, state: str | None, data: dict):
+        """
+        Пишет один ключ мимо очереди, не сбрасывая чужие записи. Под замком буфера,
+        чтобы не обогнать уже начатый сброс со старой записью этого ключа.
+        Ошибку БД не пробрасывает: запись остается в буфере до следующего сброса.
+        """
+        async with self._lock:
+            self._rows.pop(key, None)
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self.storage._write_rows(conn, {key: (state, data)})
+            except Exception:
+                logger.exception(f"Не удалось записать состояние FSM {key}, повторим при сбросе буфера")
+                self._rows.setdefault(key, (state, data))
+
+    def _pending_count(self) -> int:
+        return len(self._rows)
+
+    def _take_pending(self):
+        rows, self._rows = self._rows, {}
+        return rows
+
+    async def _write(self, conn, batch):
+        await self.storage._write_rows(conn, batch)
+
+    def _restore(self, batch):
+        for key, row in batch.items():
+            self._rows.setdefault(key, row)
+
+
+class PgStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram в Postgres (таблица fsm_states) для нескольких процессов.
+    Пул подключается позже через attach(), потому что Dispatcher создается раньше БД.
+
+    - чтения идут из LRU-кеша в памяти (cache_size записей, не дольше cache_ttl);
+    - set_state пишется сразу (write-through, только свой ключ; при ошибке БД — через буфер),
+      set_data/update_data копятся и уходят пачкой раз в flush_interval;
+    - каждая запись шлет NOTIFY fsm_states, остальные процессы выкидывают ключ из кеша;
+    - состояния, не менявшиеся дольше ttl, считаются пустыми и удаляются
+      (чистит один процесс: attach(..., cleanup=True)).
+
+    Пока data лежит в буфере (до flush_interval), другой процесс видит прежние
+    данные; переход состояния сбрасывает данные ключа вместе с ним.
+    """
+    CHANNEL = "fsm_states"
+
+    def __init__(self, key_builder: KeyBuilder | None = None, cache_size: int = 10000,
+                 cache_ttl: float = 300.0, ttl: timedelta = timedelta(days=7),
+                 flush_interval: float = 0.5, cleanup_interval: float = 3600.0,
+                 reconnect_delay: float = 5.0):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.reconnect_delay = reconnect_delay
+        self.pool: asyncpg.pool.Pool | None = None
+        self.db_url: str | None = None
+        # key -> (state, data, загружено в loop.time())
+        self._cache: OrderedDict[str, tuple[str | None, dict, float]] = OrderedDict()
+        self._buffer = _FsmDataBuffer(self, flush_interval)
+        self._instance = uuid.uuid4().hex
+        # Растет на каждой инвалидации: чтение, во время которого она пришла, не кешируется
+        self._invalidations = 0
+        self._tasks: list[asyncio.Task] = []
+
+    async def attach(self, pool: asyncpg.pool.Pool, db_url: str, create_table: bool = False,
+                     cleanup: bool = True):
+        """
+        Подключает пул, запускает сброс буфера, LISTEN и чистку просроченных состояний.
+        Под супервизором (serve.py) чистку запускает только основной процесс: cleanup=False в остальных.
+        """
+        self.pool = pool
+        self.db_url = db_url
+        self._buffer.pool = pool
+        if create_table:
+            async with pool.acquire() as conn:
+                await conn.execute(FSM_STATES_DDL)
+        self._buffer.start()
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._listen())]
+            if cleanup:
+                self._tasks.append(asyncio.create_task(self._cleanup_loop()))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self._tasks = []
+        if self.pool:
+            await self._buffer.close()
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self.key_builder.build(key)
+        _, data = await self._load(storage_key)
+        new_state = state.state if isinstance(state, State) else state
+        self._remember(storage_key, new_state, data)
+        # Переход состояния пишем сразу, но только этот ключ (несброшенные data ключа — в нем же)
+        await self._buffer.write_now(storage_key, new_state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise TypeError(f"Data must be a dict, got {type(data).__name__}")
+        storage_key = self.key_builder.build(key)
+        state, _ = await self._load(storage_key)
+        data = copy.deepcopy(data)
+        self._remember(storage_key, state, data)
+        self._buffer.add(storage_key, state, data)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self.key_builder.build(key))
+        return copy.deepcopy(data)
+
+    # --- кеш и БД ---
+
+    def _remember(self, storage_key: str, state: str | None, data: dict):
+        self._cache[storage_key] = (state, data, asyncio.get_running_loop().time())
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, storage_key: str) -> tuple[str | None, dict]:
+        # Несброшенная запись новее любого кеша и БД
+        pending = self._buffer.get(storage_key)
+        if pending is not None:
+            return pending
+        cached = self._cache.get(storage_key)
+        if cached and asyncio.get_running_loop().time() - cached[2] < self.cache_ttl:
+            self._cache.move_to_end(storage_key)
+            return cached[0], cached[1]
+        invalidations = self._invalidations
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                "SELECT state, data FROM fsm_states WHERE key = $1 AND updated_at > now() - $2::interval;",
+                storage_key, self.ttl
+            )
+        state, data = (row['state'], fastjson.loads(row['data'])) if row else (None, {})
+        # NOTIFY, пришедший во время запроса, мог касаться этого ключа: прочитанное может быть уже старым
+        if invalidations == self._invalidations:
+            self._remember(storage_key, state, data)
+        return state, data
+
+    async def _write_rows(self, conn, rows: dict[str, tuple[str | None, dict]]):
+        """Пустые записи удаляем, остальные upsert'им одним запросом; NOTIFY уйдет при коммите"""
+        keep = {key: row for key, row in rows.items() if row[0] is not None or row[1]}
+        empty = [key for key in rows if key not in keep]
+        if keep:
+            await conn.execute(
+                """
+                INSERT INTO fsm_states (key, state, data, updated_at)
+                SELECT k, s, d::jsonb, now() FROM unnest($1::text[], $2::text[], $3::text[]) AS t(k, s, d)
+                ON CONFLICT (key) DO UPDATE
+                SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at;
+                """,
+                list(keep), [row[0] for row in keep.values()], [fastjson.dumps(row[1]) for row in keep.values()]
+            )
+        if empty:
+            await conn.execute("DELETE FROM fsm_states WHERE key = ANY($1::text[]);", empty)
+        await conn.execute(
+            "SELECT pg_notify($1, $2 || ' ' || k) FROM unnest($3::text[]) AS k;",
+            self.CHANNEL, self._instance, list(rows)
+        )
+
+    def _on_notify(self, conn, pid, channel, payload):
+        instance, _, storage_key = payload.partition(" ")
+        if instance != self._instance:
+            self._invalidations += 1
+            self._cache.pop(storage_key, None)
+
+    async def _listen(self):
+        """Отдельное соединение под LISTEN (не из пула), переподключение при обрыве"""
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(self.db_url)
+                await conn.add_listener(self.CHANNEL, self._on_notify)
+                # Пока соединения не было, инвалидации могли потеряться
+                self._invalidations += 1
+                self._cache.clear()
+                while True:
+                    await asyncio.sleep(60)
+                    await conn.execute("SELECT 1;")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"LISTEN {self.CHANNEL} прерван: {e}")
+            finally:
+                if conn and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    deleted = await conn.execute(
+                        "DELETE FROM fsm_states WHERE updated_at < now() - $1::interval;", self.ttl
+                    )
+                logger.info(f"Просроченные состояния FSM удалены: {deleted}")
+            except Exception:
+                logger.exception("Не удалось удалить просроченные состояния FSM")
+            await asyncio.sleep(self.cleanup_interval)
@@ -1,11 +1,16 @@
+import json
 import asyncio
 import logging
+from datetime import date
 from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramAPIError, TelegramBadRequest
 
 # Импортируем конфиг для получения списка админов
-from config import ADMIN_IDS
+from config import (
+    ADMIN_IDS, AUDIENCE_CHUNK_SIZE, BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_COPY_MODE,
+    BROADCAST_SOURCE_CHAT_ID
+)
+from utils.broadcast import BroadcastEngine
 
 # Настройка логгера
 logger = logging.getLogger(__name__)
@@ -36,27 +41,33 @@ async def save_referral(new_user_id: int, ref_payload: str, db_manager):
     except Exception as e:
         logger.error(f"Ошибка при сохранении реферала: {e}")
 
-async def send_broadcast(data: dict, bot: Bot, db_manager):
+async def send_broadcast(data: dict, bot: Bot, db_manager, admin_id: int | None = None):
     """
     Безопасная рассылка с поддержкой медиа и фоновым выполнением.
+    Создает новый прогон и выполняет его через run_broadcast.
+    Возвращает BroadcastResult (run_id, счетчики, фактическая скорость) или None.
     """
     id = data.get("id")
     if not id:
         logger.error("send_broadcast: В данных отсутствует 'id'")
         return None
     
-    run_id = await db_manager.mailing_db.start_new_run(id)
+    run_id = await db_manager.mailing_db.start_new_run(id, admin_id)
+    return await run_broadcast(run_id, bot, db_manager)
 
-    mailing_data = await db_manager.mailing_db.get_mailing_by_run_id(id)
-    if not mailing_data:
-        return None
-    
 
+def build_broadcast_sender(mailing_data: dict, bot: Bot, source_chat_id: int | None = None,
+                           source_message_id: int | None = None):
+    """
+    Готовит подпись и клавиатуру один раз и возвращает корутину send(user_id).
+    Если задано исходное сообщение, send — это copy_message с заранее
+    собранными параметрами: медиа и подпись берет Telegram, в том числе на ретраях.
+    """
     media_file_id = mailing_data.get('media_url')
     media_type = mailing_data.get('media_type')
     caption = f"<b>{mailing_data['title']}</b>\n\n{mailing_data['text']}" if mailing_data.get('title') else mailing_data.get('text', '')
     
-    link = mailing_data['button_link']
+    link = mailing_data['button_link'] or ''
 
     if link.startswith('@'):
             link = f"https://t.me/{link[1:]}"
@@ -67,46 +78,187 @@ async def send_broadcast(data: dict, bot: Bot, db_manager):
             InlineKeyboardButton(text=mailing_data['button_text'], url=link)
         ]])
 
-    # Берем только тех, кто не заблокировал бота (is_alive=True)
-    user_ids = await db_manager.users_db.get_all_alive_user_ids() 
-    
-    for user_id in user_ids:
-        try:
-            if media_file_id and media_type:
-                if media_type == 'photo':
-                    await bot.send_photo(user_id, photo=media_file_id, caption=caption, reply_markup=markup)
-                elif media_type == 'video':
-                    await bot.send_video(user_id, video=media_file_id, caption=caption, reply_markup=markup)
-                elif media_type == 'animation':
-                    await bot.send_animation(user_id, animation=media_file_id, caption=caption, reply_markup=markup)
-                else:
-                    await bot.send_document(user_id, document=media_file_id, caption=caption, reply_markup=markup)
+    if source_message_id:
+        # Клавиатуру copy_message не переносит, передаем ее вместе с остальным payload
+        payload = {"from_chat_id": source_chat_id, "message_id": source_message_id, "reply_markup": markup}
+
+        async def copy(user_id: int):
+            return await bot.copy_message(user_id, **payload)
+
+        return copy
+
+    async def send(user_id: int):
+        if media_file_id and media_type:
+            if media_type == 'photo':
+                return await bot.send_photo(user_id, photo=media_file_id, caption=caption, reply_markup=markup)
+            elif media_type == 'video':
+                return await bot.send_video(user_id, video=media_file_id, caption=caption, reply_markup=markup)
+            elif media_type == 'animation':
+                return await bot.send_animation(user_id, animation=media_file_id, caption=caption, reply_markup=markup)
             else:
-                await bot.send_message(user_id, text=caption, reply_markup=markup)
+                return await bot.send_document(user_id, document=media_file_id, caption=caption, reply_markup=markup)
+        else:
+            return await bot.send_message(user_id, text=caption, reply_markup=markup)
 
-            await db_manager.mailing_db.log_stat(run_id, user_id, "sent")
-            # Пауза 0.05 сек = ~20 сообщений в сек (безопасно для TG)
-            await asyncio.sleep(0.05) 
+    return send
 
-        except TelegramForbiddenError:
-            # Помечаем юзера "мертвым", чтобы не слать ему в следующий раз
-            await db_manager.users_db.update_user_status(user_id, is_alive=False)
-            await db_manager.mailing_db.log_stat(run_id, user_id, "blocked")
-        
-        except TelegramRetryAfter as e:
-            # Если словили лимит — ждем и пробуем еще раз ОДИН раз
-            await asyncio.sleep(e.retry_after)
-            try:
-                await bot.send_message(user_id, text=caption, reply_markup=markup)
-                await db_manager.mailing_db.log_stat(run_id, user_id, "sent")
-            except:
-                await db_manager.mailing_db.log_stat(run_id, user_id, "failed")
-        
-        except (TelegramBadRequest, TelegramAPIError) as e:
-            logger.error(f"Ошибка API для {user_id}: {e}")
-            await db_manager.mailing_db.log_stat(run_id, user_id, "error")
-            
-    return run_id
+
+async def ensure_source_message(run, mailing_data: dict, bot: Bot, db_manager) -> tuple[int, int] | None:
+    """
+    Один раз рендерит рассылку в чат-источник (BROADCAST_SOURCE_CHAT_ID или
+    чат админа) и запоминает сообщение в прогоне. Возвращает (chat_id, message_id)
+    или None, если copy_message не используется — тогда рассылаем напрямую.
+    """
+    if run['source_message_id']:
+        return run['source_chat_id'], run['source_message_id']
+    chat_id = BROADCAST_SOURCE_CHAT_ID or run['admin_id']
+    if not BROADCAST_COPY_MODE or not chat_id:
+        return None
+    try:
+        message = await build_broadcast_sender(mailing_data, bot)(chat_id)
+    except Exception as e:
+        logger.warning(f"Рассылка #{run['id']}: не удалось отрендерить исходное сообщение в {chat_id}: {e}")
+        return None
+    await db_manager.mailing_db.set_source_message(run['id'], chat_id, message.message_id)
+    return chat_id, message.message_id
+
+
+def audience_chunks(run, db_manager, after_id: int | None = None):
+    """Аудитория прогона чанками по возрастанию telegram_id: сегмент или все живые, с учетом поясов"""
+    if run['segment']:
+        return db_manager.segments.iter_member_chunks(
+            json.loads(run['segment']), AUDIENCE_CHUNK_SIZE, after_id=after_id, timezones=run['tz_filter']
+        )
+    return db_manager.users_db.iter_alive_user_id_chunks(
+        chunk_size=AUDIENCE_CHUNK_SIZE, after_id=after_id, timezones=run['tz_filter']
+    )
+
+
+async def count_audience(run, db_manager, after_id: int | None = None) -> int:
+    if run['segment']:
+        return await db_manager.segments.count_members(json.loads(run['segment']), after_id=after_id)
+    return await db_manager.users_db.count_alive_user_ids(after_id=after_id, timezones=run['tz_filter'])
+
+
+def parse_segment_filters(text: str) -> dict:
+    """
+    Разбирает фильтры сегмента из сообщения админа, через пробел:
+    lang=ru,en  premium=1|0  signup=2026-01-01..2026-06-30  ref=any|none|<telegram_id>
+    videos>=5  quest=<id>  !quest=<id>
+    """
+    spec = {}
+    for token in text.split():
+        if token.startswith("videos>="):
+            spec["min_videos"] = int(token[len("videos>="):])
+            continue
+        key, sep, value = token.partition("=")
+        if not sep or not value:
+            raise ValueError(f"непонятный фильтр: {token}")
+        if key == "lang":
+            spec["language"] = [v.strip().lower() for v in value.split(",") if v.strip()]
+        elif key == "premium":
+            spec["premium"] = value in ("1", "yes", "да", "true")
+        elif key == "signup":
+            date_from, _, date_to = value.partition("..")
+            # Проверяем формат сразу, чтобы не сохранить битый сегмент
+            for d in (date_from, date_to):
+                if d:
+                    date.fromisoformat(d)
+            if date_from:
+                spec["signup_from"] = date_from
+            if date_to:
+                spec["signup_to"] = date_to
+        elif key == "ref":
+            if value in ("any", "none"):
+                spec["has_referrer"] = value == "any"
+            else:
+                spec["referrer"] = int(value)
+        elif key == "quest":
+            spec["quest"] = value
+        elif key == "!quest":
+            spec["no_quest"] = value
+        else:
+            raise ValueError(f"неизвестный фильтр: {key}")
+    if not spec:
+        raise ValueError("фильтры не заданы")
+    return spec
+
+
+async def run_broadcast(run_id: int, bot: Bot, db_manager, progress=None, concurrency: int | None = None):
+    """
+    Выполняет прогон рассылки с сохраненного курсора: после рестарта
+    или паузы продолжает со следующего за последним чекпоинтом получателя.
+    Для прогонов в режиме queue только раскладывает аудиторию по заданиям
+    (отправляют процессы broadcast_worker.py) и возвращает None.
+    progress (ProgressReporter) — живое сообщение о ходе inline-прогона,
+    concurrency — число отправителей вместо BROADCAST_CONCURRENCY.
+    Возвращает BroadcastResult (result.stopped=True, если прогон поставлен на паузу) или None.
+    """
+    run = await db_manager.mailing_db.get_run(run_id)
+    mailing_data = await db_manager.mailing_db.get_mailing_by_run_id(run_id)
+    if not run or not mailing_data:
+        return None
+
+    # Рендерим до раскладки по заданиям, чтобы воркеры сразу получили исходное сообщение
+    source = await ensure_source_message(run, mailing_data, bot, db_manager)
+
+    if run['mode'] == 'queue':
+        if not run['planned']:
+            await db_manager.jobs_db.plan_run(run_id, audience_chunks(run, db_manager, after_id=run['cursor']))
+            logger.info(f"Рассылка #{run_id}: аудитория разложена по заданиям для воркеров")
+        # Воркеры могли разобрать все задания раньше, чем закончилась раскладка
+        closed, admin_id = await db_manager.jobs_db.finish_run(run_id)
+        if closed and admin_id:
+            await bot.send_message(admin_id, await build_broadcast_report(run_id, db_manager), parse_mode="HTML")
+        return None
+
+    send = build_broadcast_sender(mailing_data, bot, *(source or ()))
+
+    async def checkpoint(last_id: int) -> bool:
+        # Курсор пишем после каждого батча; если админ поставил паузу — останавливаемся
+        state = await db_manager.mailing_db.save_checkpoint(run_id, last_id)
+        return state == 'running'
+
+    if run['cursor'] is not None:
+        logger.info(f"Рассылка #{run_id}: продолжаем после пользователя {run['cursor']}")
+    # Состояние не трогаем: в running прогон переводят создание и resume_run, а не запуск
+
+    if progress:
+        # Один COUNT на старте для ETA, дальше прогресс считается только в памяти
+        progress.title = progress.title or mailing_data.get('title') or ''
+        progress.total = await count_audience(run, db_manager, after_id=run['cursor'])
+
+    # Берем только тех, кто не заблокировал бота (is_alive=True), потоком по чанкам
+    user_chunks = audience_chunks(run, db_manager, after_id=run['cursor'])
+
+    # Параллельные отправители под общим лимитом скорости (см. BROADCAST_RATE);
+    # у отложенных рассылок своя скорость, растянутая на окно отправки
+    engine = BroadcastEngine(bot, db_manager, rate=run['rate'] or BROADCAST_RATE,
+                             concurrency=concurrency or BROADCAST_CONCURRENCY)
+    result = await engine.run(run_id, user_chunks, send, checkpoint=checkpoint, progress=progress)
+    if not result.stopped:
+        await db_manager.mailing_db.set_run_state(run_id, 'done')
+    return result
+
+
+async def build_broadcast_report(run_id: int, db_manager, result=None) -> str:
+    """Текст итогового отчета по прогону; result (BroadcastResult) добавляет строку скорости"""
+    stats = await db_manager.mailing_db.get_stats(run_id)
+    mailing_data = await db_manager.mailing_db.get_mailing_by_run_id(run_id)
+    
+    title = mailing_data['title'] if mailing_data else "Mailing"
+    report = (
+        f"🎉 <b>Рассылка #{run_id} завершена!</b>\n"
+        f"<b>Шаблон:</b> <code>{title}</code>\n"
+        f"—————————————————————\n"
+        f"✅ Успешно: <b>{stats.get('sent', 0)}</b>\n"
+        f"🚫 Блоки: <b>{stats.get('blocked', 0)}</b>\n"
+        f"⚠️ Ошибки: <b>{stats.get('error', 0)}</b>\n"
+        f"🖱 Клики: <b>{stats.get('clicked', 0)}</b>"
+    )
+    if result:
+        report += f"\n⚡️ Скорость: <b>{result.rate:.1f}</b> сообщ./с за {result.elapsed:.0f} с"
+    return report
 
 
 async def create_broadcast(data: dict, db_manager):
@@ -129,11 +281,17 @@ async def fetch_bot_stats(db_manager) -> str:
     async with db_manager.users_db.pool.acquire() as conn:
         users_count = await conn.fetchval("SELECT count(*) FROM tg_users") or 0
         today_users = await conn.fetchval("SELECT count(*) FROM tg_users WHERE created_at::date = current_date") or 0
-        refs_count = await conn.fetchval("SELECT count(*) FROM tg_users WHERE referrer_id IS NOT NULL") or 0
+        refs_count = await conn.fetchval("SELECT count(*) FROM user_referrals") or 0
         total_watched = await conn.fetchval("SELECT COALESCE(SUM(watched), 0) FROM videos") or 0
         today_watched = await conn.fetchval(
             "SELECT videos_watched FROM daily_statistics WHERE stat_date = current_date"
         ) or 0
+    # Просмотры, которые еще лежат в буфере отложенной записи
+    if db_manager.counter_buffer:
+        total_watched += db_manager.counter_buffer.pending_watched()
+    query_stats = db_manager.queries.get_stats().values()
+    prepared_calls = sum(q["calls"] for q in query_stats)
+    saved_ms = sum(q["saved_ms"] for q in query_stats)
         
     stats_text = (
         f"📊 <b>ОБЩАЯ СТАТИСТИКА БОТА</b>\n"
@@ -144,7 +302,10 @@ async def fetch_bot_stats(db_manager) -> str:
         f"— Рефералов: <b>{refs_count}</b>\n\n"
         f"🎥 <b>ВИДЕО / РЕКЛАМА</b>\n"
         f"— Просмотров всего: <b>{total_watched}</b>\n"
-        f"— Просмотров сегодня: <b>{today_watched}</b>"
+        f"— Просмотров сегодня: <b>{today_watched}</b>\n\n"
+        f"⚙️ <b>БД</b>\n"
+        f"— Вызовов подготовленных запросов: <b>{prepared_calls}</b>\n"
+        f"— Сэкономлено на разборе: <b>{saved_ms / 1000:.1f} с</b>"
     )
     return stats_text
 
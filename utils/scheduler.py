@@ -0,0 +1,165 @@
+import re
+import asyncio
+import logging
+import contextlib
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from config import DEFAULT_TIMEZONE, BROADCAST_MODE, BROADCAST_RATE, SCHEDULER_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+_OFFSET_RE = re.compile(r"^(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+
+def resolve_timezone(name: str | None):
+    """
+    Часовой пояс из tg_users.timezone: имя IANA ('Europe/Moscow') или смещение
+    ('+3', 'UTC+03:00'). Пустые и нераспознанные значения — DEFAULT_TIMEZONE.
+    """
+    if name:
+        match = _OFFSET_RE.match(name.strip())
+        if match:
+            sign = -1 if match.group(1) == "-" else 1
+            offset = timedelta(hours=int(match.group(2)), minutes=int(match.group(3) or 0))
+            return timezone(sign * offset)
+        try:
+            return ZoneInfo(name.strip())
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def zone_fire_time(tz_name: str | None, local_time: datetime) -> datetime:
+    """Момент (UTC), когда в поясе tz_name наступает local_time"""
+    return local_time.replace(tzinfo=resolve_timezone(tz_name)).astimezone(timezone.utc)
+
+
+def plan_local_slots(buckets: dict[str, int], local_time: datetime) -> list[tuple[datetime, list[str], int]]:
+    """
+    Разворачивает «local_time по часам пользователя» в слоты: сырые значения
+    поясов группируются по моменту срабатывания, так что пояса с одинаковым
+    смещением на эту дату уходят одним прогоном.
+    """
+    slots: dict[datetime, tuple[list[str], int]] = {}
+    for tz_name, users in buckets.items():
+        fire_at = zone_fire_time(tz_name, local_time)
+        names, total = slots.get(fire_at, ([], 0))
+        names.append(tz_name)
+        slots[fire_at] = (names, total + users)
+    return [(fire_at, names, total) for fire_at, (names, total) in sorted(slots.items())]
+
+
+def slot_zones(buckets: dict[str, int], local_time: datetime, slot_times: list[datetime],
+               fire_at: datetime, created_at: datetime) -> tuple[list[str], int]:
+    """
+    Пояса local-слота fire_at по аудитории на момент срабатывания, а не создания:
+    значение пояса, впервые появившееся позже, попадает в свой слот или, если
+    слота с его смещением нет, в ближайший следующий (в последний, если следующих нет).
+    Пояса, где local_time прошло еще до создания расписания, пропускаются.
+    """
+    names, total = [], 0
+    for tz_name, users in buckets.items():
+        own = zone_fire_time(tz_name, local_time)
+        if own <= created_at:
+            continue
+        target = next((t for t in slot_times if t >= own), slot_times[-1])
+        if target == fire_at:
+            names.append(tz_name)
+            total += users
+    return names, total
+
+
+def parse_schedule_input(text: str) -> tuple[datetime, bool, int]:
+    """
+    Разбирает ввод админа: 'ДД.ММ.ГГГГ ЧЧ:ММ [local] [окно_в_минутах]'.
+    Возвращает (время без пояса, по местному времени пользователей, окно).
+    """
+    parts = text.split()
+    if len(parts) < 2:
+        raise ValueError("нужны дата и время")
+    when = datetime.strptime(f"{parts[0]} {parts[1]}", "%d.%m.%Y %H:%M")
+    local = False
+    spread = 0
+    for part in parts[2:]:
+        if part.lower() == "local":
+            local = True
+        elif part.isdigit():
+            spread = int(part)
+        else:
+            raise ValueError(f"непонятный параметр: {part}")
+    return when, local, spread
+
+
+async def create_schedule(db_manager, mailing_id: int, admin_id: int | None, when: datetime,
+                          local: bool = False, spread_minutes: int = 0):
+    """
+    Создает расписание. absolute — один слот на when в DEFAULT_TIMEZONE,
+    local — по слоту на каждое смещение, когда у пользователей наступает when.
+    Прошедшее время absolute — ValueError; у local слоты, где when уже прошло,
+    отбрасываются (иначе все они сработали бы разом на ближайшем тике).
+    Возвращает (schedule_id, slots, skipped) — skipped: пользователей в отброшенных слотах.
+    """
+    now = datetime.now(timezone.utc)
+    buckets = await db_manager.users_db.get_timezone_buckets()
+    skipped = 0
+    if local:
+        slots = plan_local_slots(buckets, when)
+        skipped = sum(total for fire_at, _, total in slots if fire_at <= now)
+        slots = [slot for slot in slots if slot[0] > now]
+        if not slots:
+            raise ValueError("это время уже прошло во всех поясах")
+    else:
+        fire_at = when.replace(tzinfo=ZoneInfo(DEFAULT_TIMEZONE)).astimezone(timezone.utc)
+        if fire_at <= now:
+            raise ValueError("это время уже прошло")
+        slots = [(fire_at, None, sum(buckets.values()))]
+    schedule_id = await db_manager.schedules_db.add_schedule(
+        mailing_id, admin_id, "local" if local else "absolute", slots,
+        local_time=when if local else None, spread_minutes=spread_minutes
+    )
+    return schedule_id, slots, skipped
+
+
+class BroadcastScheduler:
+    """
+    Раз в interval секунд запускает прогоны наступивших слотов.
+    start_run(run_id, admin_id) — как запускать созданный прогон (фоновой задачей),
+    resume() — необязательная корутина того же тика: подхватить брошенные прогоны.
+    """
+    def __init__(self, db_manager, start_run, interval: float = SCHEDULER_INTERVAL, resume=None):
+        self.db = db_manager
+        self.start_run = start_run
+        self.resume = resume
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if not self._task:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def tick(self):
+        def resolve_local(slot, buckets):
+            return slot_zones(buckets, slot['local_time'], slot['slot_times'], slot['fire_at'], slot['created_at'])
+
+        due = await self.db.schedules_db.start_due_runs(BROADCAST_MODE, BROADCAST_RATE, resolve_local)
+        for run_id, admin_id in due:
+            logger.info(f"Запуск отложенной рассылки: прогон #{run_id}")
+            self.start_run(run_id, admin_id)
+        if self.resume:
+            await self.resume()
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Ошибка планировщика рассылок")
+            await asyncio.sleep(self.interval)
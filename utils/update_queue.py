@@ -0,0 +1,175 @@
+import re
+import time
+import asyncio
+import logging
+from array import array
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(samples, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+_UPDATE_ID_RE = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+
+def extract_update_id(raw: bytes) -> int | None:
+    """update_id из сырого тела запроса без разбора JSON (Telegram пишет его первым ключом)"""
+    match = _UPDATE_ID_RE.search(raw, 0, 64) or _UPDATE_ID_RE.search(raw)
+    return int(match.group(1)) if match else None
+
+
+class UpdateDeduplicator:
+    """
+    Скользящее окно последних window update_id: кольцевой буфер + set для
+    проверки за O(1) и high-water mark. ID старше окна от максимума считаются
+    повторами, кроме сильного отката: Telegram выбирает update_id заново после
+    недели без апдейтов, тогда окно сбрасывается.
+    """
+    def __init__(self, window: int = 10000, reset_gap: int = 1_000_000):
+        self.window = window
+        self.reset_gap = reset_gap
+        self._ring = array("q", [-1]) * window
+        self._pos = 0
+        self._ids: set[int] = set()
+        self._high = -1
+        self.duplicates = 0
+
+    def seen(self, update_id: int) -> bool:
+        """True — апдейт уже принимали; иначе запоминает его и возвращает False"""
+        if update_id in self._ids:
+            self.duplicates += 1
+            return True
+        if update_id <= self._high - self.window:
+            if self._high - update_id < self.reset_gap:
+                self.duplicates += 1
+                return True
+            self._reset()
+        evicted = self._ring[self._pos]
+        if evicted >= 0:
+            self._ids.discard(evicted)
+        self._ring[self._pos] = update_id
+        self._pos = (self._pos + 1) % self.window
+        self._ids.add(update_id)
+        self._high = max(self._high, update_id)
+        return False
+
+    def forget(self, update_id: int):
+        """Апдейт не принят (очередь полна) — повторная доставка должна пройти"""
+        if update_id not in self._ids:
+            return
+        self._ids.discard(update_id)
+        # Освобождаем и его слот: иначе вытеснение этого слота позже выкинуло бы
+        # из _ids повторно принятый id, пока тот еще внутри окна
+        last = (self._pos - 1) % self.window
+        if self._ring[last] == update_id:
+            # Обычный случай: forget сразу после seen — слот возвращаем
+            self._ring[last] = -1
+            self._pos = last
+            return
+        for i, ring_id in enumerate(self._ring):
+            if ring_id == update_id:
+                self._ring[i] = -1
+                break
+
+    def _reset(self):
+        self._ring = array("q", [-1]) * self.window
+        self._pos = 0
+        self._ids.clear()
+        self._high = -1
+
+
+class UpdateQueue:
+    """
+    Очередь апдейтов вебхука: handle_webhook только кладет апдейт и сразу
+    отвечает 200, а workers задач прогоняют их через dp.feed_update.
+    Очередь ограничена maxsize: если она полна, put возвращает False и вебхук
+    отвечает 503, чтобы Telegram доставил апдейт позже, а не копил его в памяти.
+    """
+    def __init__(self, dp, bot, workers: int = 8, maxsize: int = 1000, samples: int = 1000):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks: list[asyncio.Task] = []
+        # Последние замеры, мс: ожидание в очереди и обработка
+        self._wait_ms: deque[float] = deque(maxlen=samples)
+        self._handle_ms: deque[float] = deque(maxlen=samples)
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.in_flight = 0
+
+    def start(self):
+        """Запускает воркеров (нужен работающий event loop)"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10.0):
+        """Дорабатывает принятые апдейты (не дольше timeout) и останавливает воркеров"""
+        # join ждет и апдейты, которые воркеры уже взяли, даже если очередь пуста:
+        # Telegram получил на них 200, прерванный хендлер уже не повторится
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано апдейтов при остановке: в очереди {self._queue.qsize()}, "
+                           f"в обработке {self.in_flight}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, update) -> bool:
+        """Кладет апдейт без ожидания; False — очередь полна, апдейт не принят"""
+        try:
+            self._queue.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"Очередь апдейтов полна ({self._queue.maxsize}), отклонено всего: {self.dropped}")
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    async def _worker(self):
+        while True:
+            enqueued_at, update = await self._queue.get()
+            started = time.perf_counter()
+            self._wait_ms.append((started - enqueued_at) * 1000)
+            self.in_flight += 1
+            try:
+                await self.dp.feed_update(bot=self.bot, update=update)
+                self.processed += 1
+            except Exception:
+                # Ответ Telegram уже отправлен: ошибка хендлера не вызывает повторной доставки
+                self.failed += 1
+                logger.exception(f"Ошибка обработки апдейта {update.update_id}")
+            finally:
+                self.in_flight -= 1
+                self._handle_ms.append((time.perf_counter() - started) * 1000)
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize(),
+            "in_flight": self.in_flight,
+            "max_depth": self.max_depth,
+            "maxsize": self._queue.maxsize,
+            "workers": len(self._tasks),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "wait_ms_p50": round(_percentile(self._wait_ms, 0.50), 2),
+            "wait_ms_p99": round(_percentile(self._wait_ms, 0.99), 2),
+            "handle_ms_p50": round(_percentile(self._handle_ms, 0.50), 2),
+            "handle_ms_p99": round(_percentile(self._handle_ms, 0.99), 2),
+        }
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import contextlib
+from abc import ABC, abstractmethod
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(ABC):
+    """
+    Базовый буфер отложенной записи: копит изменения в памяти и сбрасывает их
+    в БД одной транзакцией по таймеру или при достижении порога max_pending.
+    Наследники обязаны реализовать _pending_count, _take_pending, _write и _restore
+    (иначе класс не создастся), _on_flushed — по необходимости.
+    """
+    def __init__(self, pool: asyncpg.pool.Pool, flush_interval: float = 1.0, max_pending: int = 1000):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = asyncio.Lock()
+        self._timer_task: asyncio.Task | None = None
+        self._flush_task: asyncio.Task | None = None
+
+    def start(self):
+        """Запускает фоновый таймер сброса (нужен работающий event loop)"""
+        if not self._timer_task:
+            self._timer_task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self._flush_quietly()
+
+    async def _flush_quietly(self) -> bool:
+        try:
+            await self.flush()
+            return True
+        except Exception:
+            logger.exception(f"{type(self).__name__}: ошибка сброса, повторим позже")
+            return False
+
+    def _maybe_flush(self):
+        """Досрочный сброс, если накопилось слишком много изменений"""
+        if self._pending_count() >= self.max_pending and (not self._flush_task or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_quietly())
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending_count():
+                return
+            batch = self._take_pending()
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        await self._write(conn, batch)
+                    # Отмечаем до возврата соединения в пул, чтобы чтения не посчитали дельту дважды
+                    self._on_flushed(batch)
+            except BaseException:
+                self._restore(batch)
+                raise
+
+    async def close(self):
+        """Останавливает таймер и сбрасывает все, что осталось в памяти"""
+        if self._timer_task:
+            self._timer_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._timer_task
+            self._timer_task = None
+        if self._flush_task:
+            await self._flush_task
+        await self.flush()
+
+    @abstractmethod
+    def _pending_count(self) -> int:
+        ...
+
+    @abstractmethod
+    def _take_pending(self):
+        ...
+
+    @abstractmethod
+    async def _write(self, conn, batch):
+        ...
+
+    def _on_flushed(self, batch):
+        pass
+
+    @abstractmethod
+    def _restore(self, batch):
+        ...